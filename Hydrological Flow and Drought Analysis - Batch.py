@@ -0,0 +1,50 @@
+"""
+UKCP18 Flow Statistics - Batch Runs
+Newcastle University
+
+--- NOTES -------------------------------
+Runs the scenarios listed in Scenarios.csv (those with run set to True), one after another, in one job. Each row names
+the analysis script that runs it and the settings to use in place of those in the script (output_root_name,
+master_folder_UKCP18, the calculate_ switches, ...) so the scripts do not need editing between scenarios.
+
+The scenarios are run in this process, so anything that they share is only done once: the catchment lists, the
+historical thresholds (for scenarios using the same historical simulations) and the return period fit cache. The
+checkpoints of each scenario are used as usual, so a batch that stops part way through can be restarted.
+The results of each scenario are written to Outputs/Results - run "Hydrological Flow and Drought Analysis - Export
+Excel.py" to make the Excel workbooks from these.
+
+Run this on Blade 4 using:
+conda activate \ProgramData\Water_Blade_Programs\BenSmith\env_lmoments
+I:
+cd "SHETRAN_GB_2021\08_Analysis\03 - Flow Analysis"
+python "Hydrological Flow and Drought Analysis - Batch.py"
+"""
+
+# --- IMPORT PACKAGES ----------------------
+from Hydrological_Flow_and_Drought_Analysis_Functions import *
+
+# --- USER INPUTS ------------------------
+
+# --- Set the scenario manifest:
+manifest_path = "Scenarios.csv"
+
+# --- Set the folder of the analysis scripts:
+script_folder = os.path.dirname(os.path.abspath(__file__))
+
+# --- END USER INPUTS --------------------
+
+# --- RUN SCENARIOS ----------------------
+
+# The worker processes of each scenario import its script, not this one:
+if __name__ == "__main__":
+
+    scenarios = read_scenario_manifest(os.path.join(script_folder, manifest_path))
+    print(f"Running {sum(scenario['run'] for scenario in scenarios)} of the {len(scenarios)} scenarios in "
+          f"{manifest_path}.")
+    test_time = time.time()
+
+    summary = run_scenarios(scenarios, script_folder)
+
+    print("=== Batch summary:")
+    print(summary.to_string(index=False))
+    print("TIME: ", round(time.time() - test_time, 1))
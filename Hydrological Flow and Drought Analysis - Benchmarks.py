@@ -0,0 +1,436 @@
+"""
+Flow Analysis Benchmarks
+Newcastle University
+
+--- NOTES -------------------------------
+Times the flow readers against the pandas calls that they replaced, on synthetic 36,000 day outputs in each of the
+model formats (SHETRAN regular timestep txt, HBV dat and LSTM csv). The flows read by each are also compared, so the
+benchmark fails if a reader does not match pandas. Also checks that adding an RCM to a checkpointed run only analyses
+the new RCM (the checkpoints of the others are kept).
+
+Then times each stage of the analysis (reading, quantiles, threshold exceedances, return periods, droughts and
+writing the results) at several scales - the number of series analysed together, as for the river cells of a
+catchment. The synthetic flows have a seasonal cycle, persistent wet and dry spells (so there are long droughts) and
+storm peaks, and some are ephemeral (mostly zero flows, like catchment 33023). The river cell flows are read from h5
+files in the layout of the SHETRAN _shegraph.h5 outputs.
+
+The stage times are added to benchmark_results_path with the commit being benchmarked, and compared with those of the
+last commit benchmarked on the same machine, so regressions can be found between commits.
+
+The synthetic files are written to a temporary folder and removed afterwards, so this can be run anywhere (offline,
+on a CPU) and does not need the I:/ drive. Each reader and stage is run several times and the quickest time is
+reported.
+
+Run using:
+python "Hydrological Flow and Drought Analysis - Benchmarks.py"
+"""
+
+# --- IMPORT PACKAGES ----------------------
+import io
+import platform
+import subprocess
+import tempfile
+from contextlib import redirect_stdout
+from scipy.signal import lfilter
+
+from Hydrological_Flow_and_Drought_Analysis_Functions import *
+
+# --- SET FILE PATHS ----------------------
+
+convex = "I:/SHETRAN_GB_2021/"
+analysis_path = convex + "08_Analysis/03 - Flow Analysis/"
+
+# --- SETTINGS ----------------------------
+
+# Length of the synthetic outputs (the length of the climate data):
+days = 36000
+
+# Number of times to run each reader:
+repeats = 20
+
+# Numbers of series (e.g. river cells) to time the analysis stages at, and the number of times to run each stage:
+scales = [1, 10, 100]
+stage_repeats = 3
+
+# Fraction of the synthetic series that are ephemeral (mostly zero flows):
+ephemeral_fraction = 0.1
+
+# File that the stage times are added to, to compare them between commits (None to not record them). This is with the
+# other outputs when the I:/ drive is available, else in the home folder (next to the fit cache), so that nothing is
+# written into the code folder:
+benchmark_folder = analysis_path + "Outputs/Benchmarks/" if os.path.isdir(analysis_path) else \
+    os.path.join(os.path.expanduser("~"), "Flow_Analysis_Cache")
+benchmark_results_path = os.path.join(benchmark_folder, "benchmark_results.csv")
+
+# Periods to analyse (as in the analysis scripts):
+fixed_periods = {"1985-2000": [360 * 5, 360 * 20], "1985-2010": [360 * 5, 360 * 30], "2010-2040": [360 * 30, 360 * 60],
+                 "2020-2050": [360 * 40, 360 * 70], "2030-2060": [360 * 50, 360 * 80],
+                 "2040-2070": [360 * 60, 360 * 90], "2050-2080": [360 * 70, 360 * 100]}
+warming_levels = ["WL1.5", "WL2.0", "WL2.5", "WL3.0", "WL3.5", "WL4.0"]
+warming_levels_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Warming_levels_stripped.csv")
+return_periods = [2, 3, 5, 10, 25, 50, 100]
+
+# --- FUNCTIONS ---------------------------
+
+# Create a function for making a synthetic daily flow series with a seasonal cycle:
+def synthetic_flows(days, seed=0):
+    """
+    :param days: Length of the series.
+    :param seed: Seed for the random numbers.
+    :return: Array of flows (rounded to 4 decimal places, as in the model outputs).
+    """
+    rng = np.random.default_rng(seed)
+    season = 1.5 + np.sin(2 * np.pi * np.arange(days) / 360)
+    return np.round(np.exp(rng.normal(0, 0.8, days)) * season * 10, 4)
+
+
+# Create a function for writing the synthetic flows in each of the model output formats:
+def write_model_outputs(folder, flows):
+    """
+    :param folder: Folder to write the outputs to.
+    :param flows: Array of flows.
+    :return: Dictionary of the path of each model output.
+    """
+    paths = {"SHETRAN": os.path.join(folder, "output_1001_discharge_sim_regulartimestep.txt"),
+             "HBV": os.path.join(folder, "1001.dat"),
+             "LSTM": os.path.join(folder, "1001.csv")}
+
+    pd.DataFrame({"flow": flows}).to_csv(paths["SHETRAN"], index=False)
+
+    # HBV outputs are whitespace separated with the date in the first three columns:
+    days = np.arange(len(flows))
+    with open(paths["HBV"], "w") as hbv_file:
+        for day, year, month, flow in zip(days % 30 + 1, 1980 + days // 360, days // 30 % 12 + 1, flows):
+            hbv_file.write(f"{year:6d}{month:4d}{day:4d}{flow:12.4f}{flow * 0.9:12.4f}\n")
+
+    pd.DataFrame({"date": [f"{1980 + d // 360}-{d // 30 % 12 + 1:02d}-{d % 30 + 1:02d}" for d in days],
+                  "Discharge_mmd": flows, "Observed_mmd": flows * 0.9}).to_csv(paths["LSTM"], index=False)
+    return paths
+
+
+# Create a function for timing a reader:
+def time_reader(read_function, path, repeats):
+    """
+    :param read_function: Function that reads the flows from the path.
+    :param path: Path to the flow output.
+    :param repeats: Number of times to run the reader.
+    :return: The quickest time (seconds) and the flows that were read.
+    """
+    best = np.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        flows = read_function(path)
+        best = min(best, time.perf_counter() - start)
+    return best, flows
+
+
+# Create a function for making realistic synthetic daily discharges for many catchments or river cells:
+def synthetic_discharges(n_series, days, ephemeral_fraction=0.1, seed=0):
+    """
+    Each series has a seasonal cycle (highest in the winter - the climate year starts in December), persistent wet and
+    dry spells (an autocorrelated anomaly, so there are droughts lasting months to years), storm peaks and a different
+    size. The first of the series are ephemeral - dry for most of the year, so most of their flows are 0.
+    :param n_series: Number of series.
+    :param days: Length of each series (360 days per year).
+    :param ephemeral_fraction: Fraction of the series that are ephemeral.
+    :param seed: Seed for the random numbers.
+    :return: Array of flows in cumecs (series x days), rounded to 3 decimal places.
+    """
+    rng = np.random.default_rng(seed)
+    season = 1 + 0.6 * np.cos(2 * np.pi * np.arange(days) / 360)
+
+    # Log flow anomalies that persist over weeks, plus a slower anomaly that persists over years:
+    anomaly = lfilter([1], [1, -0.97], rng.normal(0, 0.12, (n_series, days)), axis=1)
+    anomaly += lfilter([1], [1, -0.9995], rng.normal(0, 0.01, (n_series, days)), axis=1)
+
+    # Storm peaks on about 1 day in 30:
+    storms = np.where(rng.random((n_series, days)) < 1 / 30, rng.exponential(2, (n_series, days)), 0)
+
+    sizes = np.exp(rng.uniform(np.log(0.5), np.log(500), (n_series, 1)))
+    flows = sizes * season * np.exp(anomaly) * (1 + storms)
+
+    # Ephemeral series only flow when they are above about their 75th percentile:
+    ephemeral = int(round(n_series * ephemeral_fraction))
+    if ephemeral > 0:
+        flows[:ephemeral] = np.maximum(flows[:ephemeral] - np.quantile(flows[:ephemeral], 0.75, axis=1)[:, None], 0)
+
+    return np.round(flows, 3)
+
+
+# Create a function for writing river cell flows in the layout of a SHETRAN _shegraph.h5 output:
+def write_shegraph(path, flows, seed=0):
+    """
+    The flows are written to a '  4 ovr_flow' dataset (element x face x time step). Each cell flows out of one
+    random face (negative on the south and west faces), with smaller flows on the other faces.
+    :param path: Path to write the h5 file to.
+    :param flows: Array of the flows of each river cell (cell x days).
+    :param seed: Seed for the random numbers.
+    :return: Array of the face that each cell flows out of (0=north, 1=east, 2=south, 3=west).
+    """
+    rng = np.random.default_rng(seed)
+    n_cells = flows.shape[0]
+    faces = rng.integers(0, 4, n_cells)
+
+    values = (flows[:, None, :] * rng.uniform(0, 0.2, (n_cells, 4, 1))).astype(np.float32)
+    values[np.arange(n_cells), faces] = flows
+    values[:, 2:] *= -1
+
+    with h5py.File(path, "w") as hf:
+        hf.create_dataset("VARIABLES/  4 ovr_flow/value", data=values)
+    return faces
+
+
+# Create a function for timing a stage of the analysis:
+def time_stage(stage_function, repeats):
+    """
+    :param stage_function: Function that runs the stage (without any arguments).
+    :param repeats: Number of times to run the stage.
+    :return: The quickest time (seconds) and the result of the stage.
+    """
+    best = np.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = stage_function()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+# Create a function for timing each stage of the analysis of a number of series:
+def time_analysis_stages(folder, n_series, period_table, repeats):
+    """
+    :param folder: Folder to write the synthetic outputs and results to.
+    :param n_series: Number of series to analyse together.
+    :param period_table: Period table from create_period_table (the first RCM's periods are used).
+    :param repeats: Number of times to run each stage.
+    :return: Dictionary of the quickest time (seconds) of each stage.
+    """
+    flows = synthetic_discharges(n_series, days, ephemeral_fraction, seed=n_series)
+    historical = synthetic_discharges(n_series, 11324, ephemeral_fraction, seed=n_series + 1)
+    period_days, period_years = period_table["days"][0], period_table["years"][0]
+    times = {}
+
+    # Read the flows of the river cells from a shegraph h5 output, and the same number of catchment outputs, as the
+    # analysis scripts do (with the adapters of their models):
+    river_adapter = get_model_adapter("SHETRAN-RiverNet", os.path.join(folder, "bcm_"))
+    river_path = river_adapter["flow_path"].format(rcm="01", catchment=str(n_series))
+    os.makedirs(os.path.dirname(river_path), exist_ok=True)
+    write_shegraph(river_path, flows)
+    times["read h5"], _ = time_stage(partial(load_site_flows, river_adapter, str(n_series), ["01"],
+                                             cells=list(range(n_series)), steps=days), repeats)
+
+    catchment_adapter = get_model_adapter("SHETRAN", os.path.join(folder, "bcm_"))
+    catchments = [f"{n_series}_{i}" for i in range(n_series)]
+    for catchment, series in zip(catchments, flows):
+        path = catchment_adapter["flow_path"].format(rcm="01", catchment=catchment)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        pd.DataFrame({"flow": series}).to_csv(path, index=False)
+    times["read txt"], _ = time_stage(
+        lambda: [load_site_flows(catchment_adapter, catchment, ["01"]) for catchment in catchments], repeats)
+
+    # Quantiles of every period (from one sort), then the days under/over the historical thresholds:
+    thresholds = calculate_quantiles(historical[:, 365 * 5:], [0.01, 0.05, 0.95, 0.99])[:, None, :]
+    times["quantiles"], _ = time_stage(lambda: calculate_quantiles(
+        sort_period_flows(flows, period_days), [0.01, 0.05, 0.50, 0.95, 0.99], is_sorted=True), repeats)
+    sorted_flows = sort_period_flows(flows, period_days)
+    times["exceedances"], _ = time_stage(lambda: count_threshold_exceedances(
+        sorted_flows, thresholds, [False, False, True, True]) / period_years[:, None], repeats)
+
+    # Return periods of every period, fitted without the fit cache:
+    times["return periods"], _ = time_stage(lambda: calculate_period_return_events(
+        calculate_annual_extremes(flows, minimums=False)[0], period_days, return_periods=return_periods), repeats)
+
+    # Standardised monthly flow anomalies and the droughts of every period:
+    baseline_months = period_table["months"][0, period_table["periods"].index("1985-2010")]
+    times["droughts"], _ = time_stage(lambda: calculate_period_drought_stats(
+        standardise_monthly_flows(flows, baseline_months)[-1], period_table["months"][0],
+        thirty_year_factors=period_table["thirty_year_factors"][0]), repeats)
+
+    # The whole analysis of the series, as run by the analysis scripts:
+    output_names = ["Q99", "Q95", "Q50", "Q05", "Q01", "LTQ95", "LTQ99", "GTQ05", "GTQ01"] + \
+        [f"ReturnPeriod_{years}yr" for years in return_periods] + drought_output_names
+    settings = {"outputs": output_names, "periods": period_table, "rcms": ["01"],
+                "drought_periods": period_table["periods"], "drought_baseline_date": "1985-2010",
+                "threshold_above": [False, False, True, True], "return_periods": return_periods,
+                "count_decimals": 3, "absolute_flows": True, "skip_zero_flows": False, "days": days}
+    site_flows = {"flows": flows[None], "lengths": np.array([days]), "errors": {}, "signs": None}
+    with redirect_stdout(io.StringIO()):
+        times["analysis"], (values, _) = time_stage(lambda: analyse_site_flows(
+            "benchmark", site_flows, [0], thresholds[:, 0], settings), repeats)
+
+    # Write the results:
+    results = create_result_store(output_names, [f"{n_series}.{i:03d}" for i in range(n_series)], ["01"],
+                                  period_table["periods"])
+    results["values"][:] = values
+    times["write"], _ = time_stage(partial(write_results, results, os.path.join(folder, "Results"), "Benchmark"),
+                                   repeats)
+
+    return times
+
+
+# Create a function for checking that adding an RCM to a run keeps the checkpoints of the other RCMs:
+def check_checkpoint_resume(folder):
+    """
+    Analyses synthetic catchment outputs of two RCMs with checkpoints, as the catchment scripts do, then adds a third
+    RCM (which adds its warming level periods to the period table of the run) and analyses them again.
+    :param folder: Folder to write the synthetic outputs and checkpoints to.
+    :return: List of the positions of the RCMs analysed for each catchment when the third RCM is added, and whether
+             the results match those of a run without checkpoints.
+    """
+    adapter = get_model_adapter("SHETRAN", os.path.join(folder, "bcm_"))
+    catchments, rcms = ["1001", "1002"], ["01", "04", "05"]
+    for c, catchment in enumerate(catchments):
+        for r, rcm in enumerate(rcms):
+            path = adapter["flow_path"].format(rcm=rcm, catchment=catchment)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            pd.DataFrame({"flow": synthetic_flows(days, seed=len(rcms) * c + r)}).to_csv(path, index=False)
+
+    output_names = [f"ReturnPeriod_{years}yr" for years in return_periods] + drought_output_names
+    checkpoints = open_checkpoints(os.path.join(folder, "Checkpoints"))
+
+    def run(run_rcm_list, checkpoints):
+        period_table = create_period_table(fixed_periods, run_rcm_list, warming_levels_path, warming_levels,
+                                           days=days)
+        settings = {"outputs": output_names, "periods": period_table, "rcms": run_rcm_list,
+                    "drought_periods": period_table["periods"], "drought_baseline_date": "1985-2010",
+                    "threshold_above": [], "return_periods": return_periods, "count_decimals": 2,
+                    "absolute_flows": False, "skip_zero_flows": True, "days": days}
+        config = {"model": adapter["model"], "fit_version": fit_version, "periods": period_table["periods"],
+                  **{name: value for name, value in settings.items() if name not in ["periods", "rcms"]}}
+        identities = [[get_file_identity(adapter["flow_path"].format(rcm=rcm, catchment=catchment))
+                       for rcm in run_rcm_list] for catchment in catchments]
+        configs = [hash_rcm_configs(period_table, config) for _ in catchments]
+        run_rcms = find_rcms_to_run(checkpoints, catchments, run_rcm_list, identities, configs)
+
+        values = []
+        for c, catchment in enumerate(catchments):
+            site_flows = load_site_flows(adapter, catchment, [run_rcm_list[r] for r in run_rcms[c]])
+            with redirect_stdout(io.StringIO()):
+                catchment_values, failed_rcms = analyse_site_flows(catchment, site_flows, run_rcms[c], None, settings)
+            if checkpoints is not None:
+                catchment_values = merge_checkpoints(checkpoints, catchment, run_rcm_list, run_rcms[c], failed_rcms,
+                                                     identities[c], configs[c], catchment_values)
+            values.append(catchment_values)
+        return run_rcms, np.array(values)
+
+    run(rcms[:2], checkpoints)
+    resumed_rcms, resumed_values = run(rcms, checkpoints)
+    _, values = run(rcms, None)
+    return resumed_rcms, np.array_equal(resumed_values, values, equal_nan=True)
+
+
+# Create a function for getting the commit that is being benchmarked:
+def get_commit(folder):
+    """
+    :param folder: Folder of the git repository.
+    :return: Short hash of the commit (with "+changes" if there are uncommitted changes), or "unknown" if this is
+             not a git repository.
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=folder, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        changes = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=folder,
+                                 capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return commit + "+changes" if changes else commit
+
+
+# Create a function for recording the stage times and comparing them with those of the last commit benchmarked:
+def record_stage_times(stage_times, results_path):
+    """
+    :param stage_times: DataFrame of the stage times (columns "stage", "series", "seconds").
+    :param results_path: Path to the csv of the recorded stage times (None to not record them).
+    :return: DataFrame of the stage times with the commit they are compared with ("previous_commit") and its times
+             ("previous_seconds"), or NaN if there is no earlier commit on this machine.
+    """
+    stage_times = stage_times.assign(date=time.strftime("%Y-%m-%d %H:%M:%S"),
+                                      commit=get_commit(os.path.dirname(os.path.abspath(__file__))),
+                                      machine=platform.node(), python=platform.python_version(),
+                                      numpy=np.__version__)
+    compared = stage_times.assign(previous_commit=pd.NA, previous_seconds=np.nan)
+    if results_path is None:
+        return compared
+
+    # Compare with the most recently recorded commit on this machine (other than this one):
+    if os.path.exists(results_path):
+        recorded = pd.read_csv(results_path)
+        recorded = recorded[(recorded["machine"] == platform.node()) &
+                            (recorded["commit"] != stage_times["commit"].iloc[0])]
+        if len(recorded) > 0:
+            previous_commit = recorded.sort_values("date")["commit"].iloc[-1]
+            previous = recorded[recorded["commit"] == previous_commit].groupby(["stage", "series"])["seconds"].min()
+            compared["previous_commit"] = previous_commit
+            compared["previous_seconds"] = previous.reindex(
+                pd.MultiIndex.from_frame(stage_times[["stage", "series"]])).to_numpy()
+
+    os.makedirs(os.path.dirname(results_path), exist_ok=True)
+    stage_times.to_csv(results_path, mode="a", header=not os.path.exists(results_path), index=False)
+    return compared
+
+
+# --- RUN BENCHMARKS ----------------------
+
+if __name__ == "__main__":
+
+    # The pandas calls that were used to read each model output:
+    pandas_readers = {
+        "SHETRAN": lambda path: pd.read_csv(path).squeeze(),
+        "HBV": lambda path: pd.read_csv(path, header=None, sep=r"\s+", usecols=[3]).squeeze(),
+        "LSTM": lambda path: pd.read_csv(path, usecols=["Discharge_mmd"]).squeeze(),
+    }
+    flow_readers = {"SHETRAN": read_shetran_discharge, "HBV": read_hbv_discharge, "LSTM": read_lstm_discharge}
+
+    print(f"Reading {days} day flow outputs (quickest of {repeats}):")
+
+    with tempfile.TemporaryDirectory() as folder:
+        paths = write_model_outputs(folder, synthetic_flows(days))
+
+        for model, path in paths.items():
+            pandas_time, pandas_flows = time_reader(pandas_readers[model], path, repeats)
+            reader_time, reader_flows = time_reader(flow_readers[model], path, repeats)
+
+            if not np.array_equal(pandas_flows.to_numpy(dtype=float), reader_flows.to_numpy()):
+                raise ValueError(f"The {model} reader does not match pandas.")
+
+            print(f"- {model}: pandas {pandas_time * 1000:.1f} ms, reader {reader_time * 1000:.1f} ms "
+                  f"({pandas_time / reader_time:.1f}x)")
+
+        # LSTM conversion to cumecs - converting the read series, or converting the array in place as it is read:
+        separate_time, separate_flows = time_reader(
+            lambda path: convert_mm_per_day_to_cumecs(read_lstm_discharge(path), 250.0), paths["LSTM"], repeats)
+        in_place_time, in_place_flows = time_reader(partial(read_lstm_discharge, catchment_area=250.0),
+                                                    paths["LSTM"], repeats)
+        if not np.array_equal(separate_flows.to_numpy(), in_place_flows.to_numpy()):
+            raise ValueError("The in place LSTM conversion does not match.")
+        print(f"- LSTM in cumecs: converted after reading {separate_time * 1000:.1f} ms, "
+              f"converted in place {in_place_time * 1000:.1f} ms")
+
+    # --- Checkpoints:
+    # Adding an RCM to a run only analyses the new RCM, and gives the same results as a run without checkpoints:
+    with tempfile.TemporaryDirectory() as folder:
+        resumed_rcms, resumed_match = check_checkpoint_resume(folder)
+    if resumed_rcms != [[2], [2]] or not resumed_match:
+        raise ValueError(f"Adding an RCM to a checkpointed run analysed RCMs {resumed_rcms} (only the new RCM, 2, "
+                         f"should be analysed) and its results {'match' if resumed_match else 'do not match'}.")
+    print("Adding an RCM to a checkpointed run only analysed the new RCM.")
+
+    # --- Analysis stages:
+    print(f"Timing the analysis stages of {days} day flows (quickest of {stage_repeats}):")
+    period_table = create_period_table(fixed_periods, ["01"], warming_levels_path, warming_levels, days=days)
+
+    stage_times = []
+    with tempfile.TemporaryDirectory() as folder:
+        for n_series in scales:
+            times = time_analysis_stages(folder, n_series, period_table, stage_repeats)
+            print(f"- {n_series} series: " + ", ".join(f"{stage} {seconds:.3f} s" for stage, seconds in times.items()))
+            stage_times.extend({"stage": stage, "series": n_series, "seconds": seconds}
+                               for stage, seconds in times.items())
+
+    # Record the times and compare them with the last commit benchmarked on this machine:
+    compared = record_stage_times(pd.DataFrame(stage_times), benchmark_results_path)
+    if compared["previous_seconds"].notna().any():
+        print(f"Compared with {compared['previous_commit'].iloc[0]} (ratio of the times, > 1 is slower):")
+        compared["ratio"] = (compared["seconds"] / compared["previous_seconds"]).round(2)
+        print(compared.pivot(index="stage", columns="series", values="ratio").to_string())
+    if benchmark_results_path is not None:
+        print(f"Stage times added to {benchmark_results_path}")
@@ -13,6 +13,13 @@ eFlag -19??-2018
 For our paper it may be better to do 1985-2010
 
 Lower in the script you will need to add / uncomment the chosen output name and file paths.
+Catchments are analysed in parallel - set 'workers' to the number of processes to use (1 runs them in serial).
+The results of each catchment and RCM are saved to Outputs/Checkpoints as they are analysed, and are reused if the
+run is restarted. Delete the run's checkpoint folder to analyse everything again (e.g. after changing the code).
+The results are written to Outputs/Results as Parquet (or Feather) tables - run
+"Hydrological Flow and Drought Analysis - Export Excel.py" to make the Excel workbooks from these.
+The statistics are calculated by analyse_site_flows, which is shared by the model scripts - each script only sets
+how its flows are found and loaded (its model adapter, from get_model_adapter).
 
 If >90% of the Amax values are 0, and the lmoments cannot be calculated, then the return flow will be set at 0 cumecs.
 This is because many of the instances where the calculation fails is where the flows are 0, so 0 cumecs
@@ -50,14 +57,24 @@ from Hydrological_Flow_and_Drought_Analysis_Functions import *
 
 # --- BEGIN ANALYSIS ---------------------
 
-print("Beginning analysis - if you have an output worksheet open, close it now!")
-
 calculate_flow_stats = False
 calculate_return_periods = False
 calculate_drought_stats = True
 
-if not calculate_flow_stats and not calculate_drought_stats and not calculate_return_periods:
-    print("Check you are making outputs! 'Flow', 'Return Period' and 'Drought' stats are set to False.")
+# Number of processes used to analyse the catchments (1 runs them in serial):
+workers = max(1, os.cpu_count() - 1)
+
+# Number of RCM flow files that each process reads ahead of the calculations, and the most memory (bytes) that
+# these can use:
+prefetch_files = 4
+prefetch_memory = 256 * 1024 ** 2
+
+# Cache of the GEV distributions fitted for the return periods, so that the same annual maximums are not fitted again
+# (e.g. when re-running, or in scenarios that share a baseline). Keep this on a local disk. Set to None to not use it:
+fit_cache_path = os.path.join(os.path.expanduser("~"), "Flow_Analysis_Cache", "gev_fits.sqlite")
+fit_cache_size = 500000  # Most fits to keep - the least recently used are removed.
+fit_cache = get_shared_result(("fit cache", fit_cache_path), open_fit_cache, fit_cache_path,
+                              fit_cache_size) if fit_cache_path is not None else None
 
 # --- SET FILE PATHS ----------------------
 
@@ -67,12 +84,13 @@ analysis_path = convex + "08_Analysis/03 - Flow Analysis/"
 # Set the path to the APM_Historical_Outlet_Discharges:
 master_folder_historical = convex + "08_Analysis/01 - Collate Flow Datasets/Autocal_Historical_Outlet_Discharge/"  # APM_Historical_Outlet_Discharge
 
-# Read in warming level dates:  [entered manually later]
-# warming_levels_path = analysis_path + "Warming_levels_stripped.csv"
-# warming_levels = pd.read_csv(warming_levels_path)
+# Set the path to the warming level start years of each RCM:
+warming_levels_path = analysis_path + "Warming_levels_stripped.csv"
 
 # Get a list of the catchments we've modelled:  # (This contains the CAMELS bank-full data, though this is no longer used)
-master_df = pd.read_csv(analysis_path + "Catchments and Bankfull Data.csv", index_col=0)
+# (Read once for the scenarios of a batch run, and copied as the historical thresholds are added to it)
+master_df = get_shared_result(("catchments", analysis_path), pd.read_csv,
+                              analysis_path + "Catchments and Bankfull Data.csv", index_col=0).copy()
 
 # --- TEST ---
 # master_df = master_df[master_df.index>200000]
@@ -137,50 +155,57 @@ model_tab_name = 'SHETRAN-UK Autocalibrated'  # 'HBV' | 'SHETRAN-UK Autocalibrat
 # output_root_name = "06c_UKCP18_UDMbaseline_NFMbal"
 # master_folder_UKCP18 = convex + "05_Climate_Change_Simulations/06c_UKCP18_Autocal_UDM_baseline_NFMbal/bcm_"
 
-# --- END USER INPUTS --------------------
-
-# Print the name of the output and path as a final check for the user
-print(output_root_name)
-print(master_folder_UKCP18)
-sleep(2)
-
-
-# --- CALCULATE HISTORICAL STATISTICS -----
-if calculate_flow_stats:
-    # Extract flow stats from the historical simulations:
-    #   Historical simulations run from 01/01/1980 to 01/01/2011.
-    #   We will cut off the first 5 years of the simulation.
-    master_df[["hist_q99", "hist_q95", "hist_q05", "hist_q01"]] = pd.NA
-
-    counter = 0
-    for catchment in catchment_list:
-
-        counter += 1
+# --- Set scenario:
+# When run by "Hydrological Flow and Drought Analysis - Batch.py", the settings above (and the calculate_ and workers
+# settings) are replaced by those of the scenario in Scenarios.csv:
+scenario = apply_scenario_settings(globals(), convex)
+
+# --- Set flow store:
+# Read the flows from a flow store made by 'Hydrological Flow and Drought Analysis - Ingest.py', rather than from the
+# flow files. Set to None to read the flow files:
+flow_store_path = None  # analysis_path + "Flow_Stores/" + output_root_name + "_" + model
+
+# --- Set checkpoints:
+# Save the results of each catchment and RCM as they are analysed, so that a run that stops part way through (or is
+# re-run with more catchments or RCMs) only analyses what has not already been done. Set to None to not save them:
+checkpoint_folder = analysis_path + "Outputs/Checkpoints/" + output_root_name + "_" + model
+
+# --- Set historical thresholds:
+# The historical flow thresholds (hist_q99 etc.) are calculated once and stored in this table, which every later run
+# and scenario of the model reuses - they are only recalculated for catchments whose historical simulation changes.
+# Set to None to calculate them on every run:
+threshold_store_path = analysis_path + "Outputs/Historical_Thresholds/" + model + ".parquet"
+
+# --- Set profile:
+# Time each stage of the run (reading, quantiles, exceedances, return periods, droughts, writing) and count the flows
+# read and the return period fits (and their failures) of each catchment and RCM. The profile is written to
+# profile_path + ".json" (the totals) and ".csv" (each catchment and RCM). Set to None to not profile the run:
+profile_path = analysis_path + "Outputs/Profiles/" + output_root_name + "_" + model
+# Also run cProfile (written to profile_path + ".prof"). This only profiles the main process, so set workers to 1 to
+# profile the analysis of the catchments:
+use_cprofile = False
+
+# --- Set progress:
+# The progress of the run (catchments done, rate, estimated time of completion, worker utilisation and memory) is
+# printed, and written to this JSON file for other tools to poll, every progress_interval seconds. Set to None to only
+# print it:
+progress_path = analysis_path + "Outputs/Progress/" + output_root_name + "_" + model + ".json"
+progress_interval = 10
+
+# --- Set results:
+# The results are written as long tables (site, rcm, period, value), partitioned by metric and model, to this folder.
+# The Excel workbooks are made from these by "Hydrological Flow and Drought Analysis - Export Excel.py":
+results_folder = analysis_path + "Outputs/Results/" + output_root_name
+results_format = "parquet"  # "parquet" | "feather"
 
-        print(f"- {catchment} ({counter}/{len(catchment_list)})")
-
-        try:  # Try/Exception used to account for missing files.
-            path = master_folder_historical + "output_" + str(catchment) + "_discharge_sim_regulartimestep.txt"
-            sim_df = pd.read_csv(path).squeeze()
-
-            # Check that the simulation completed (within 10%), else pass:
-            if len(sim_df) < (11324 * 0.9):
-                continue
+# --- END USER INPUTS --------------------
 
-            if max(sim_df) == 0:
-                print(f"- Catchment {catchment} skipped as no values greater than 0.")
-                continue
+# Open the flow store (this is memory-mapped, so flows are only read from disk as they are used):
+flow_store = open_flow_store(flow_store_path) if flow_store_path is not None else None
 
-            # Calculate flow quantiles for the historical simulation:
-            master_df.loc[catchment, ["hist_q99"]] = round(sim_df[365 * 5:].quantile(0.01), 3)  # Low flow
-            master_df.loc[catchment, ["hist_q95"]] = round(sim_df[365 * 5:].quantile(0.05), 3)
-            master_df.loc[catchment, ["hist_q01"]] = round(sim_df[365 * 5:].quantile(0.99), 3)
-            master_df.loc[catchment, ["hist_q05"]] = round(sim_df[365 * 5:].quantile(0.95), 3)  # High flow
+# Get the adapter of the model, which finds and reads its flow outputs and historical simulations:
+adapter = get_model_adapter(model, master_folder_UKCP18, master_folder_historical)
 
-        except Exception as e:
-            print("EXCEPTION - Catchment: ", catchment, ":")
-            print(e)
-            continue
 
 # --- SETUP PERIODS & STATISTICS ----------
 
@@ -188,9 +213,9 @@ rcm_list = ["01", "04", "05", "06", "07", "08", "09", "10", "11", "12", "13", "1
 
 # period_list = ["1980-2000", "1980-2010", "1985-2000", "1985-2010", "1985-2015", "1990-2010",  # Baseline periods
 #                "2010-2040", "2020-2050", "2030-2060", "2040-2070", "2050-2080",  # Future periods
-#                "WL1.5", "WL2.0", "WL2.5", "WL3.0", "WL3.5", "WL4.0"]  # Warming periods - these will need looking up.
+#                "WL1.5", "WL2.0", "WL2.5", "WL3.0", "WL3.5", "WL4.0"]  # Warming periods - from warming_levels_path.
 
-date_indexes = {
+fixed_periods = {
     # Dates start 01/12/1980. There are 360 days in a climate year.
     # "1980-2000": [0, 360 * 20],
     # "1980-2010": [0, 360 * 30],
@@ -204,364 +229,200 @@ date_indexes = {
     "2030-2060": [360 * 50, 360 * 80],
     "2040-2070": [360 * 60, 360 * 90],
     "2050-2080": [360 * 70, 360 * 100],
+}
 
-    # Listed in order of RCP warming period start years.
-    # The code reads from the start of the listed year.
-    "WL1.5": [2006, 2003, 2007, 2005, 2005, 2006, 2004, 2008, 2004, 2010, 2005, 2006],
-    "WL2.0": [2016, 2013, 2018, 2016, 2017, 2018, 2014, 2018, 2015, 2020, 2016, 2019],
-    "WL2.5": [2026, 2023, 2028, 2025, 2027, 2029, 2023, 2027, 2025, 2030, 2026, 2030],
-    "WL3.0": [2034, 2031, 2037, 2034, 2036, 2038, 2030, 2036, 2034, 2038, 2035, 2038],
-    "WL3.5": [2042, 2039, 2044, 2042, 2043, 2047, 2037, 2045, 2042, 2045, 2043, 2046],
-    "WL4.0": [2049, 2046, 2051, 2049, 2050, 2055, 2044, 2052, 2050, 2052, 2050, 2054]
+# Warming periods - these start at the start of the year that each RCM reaches the warming level (read from
+# warming_levels_path) and are 30 years long, capped at 2080:
+warming_levels = ["WL1.5", "WL2.0", "WL2.5", "WL3.0", "WL3.5", "WL4.0"]
 
-}
+# Build the start and end day and month of every period of every RCM once, for the analysis to slice the flows with:
+period_table = create_period_table(fixed_periods, rcm_list, warming_levels_path, warming_levels)
+period_list = period_table["periods"]
 
 # Create a list of drought periods (as these won't use all the baseline periods:
 # >> IF YOU CHANGE THE PERIODS ABOVE, MAKE SURE YOU CHANGE THESE ACCORDINGLY! <<
-# drought_periods = [list(date_indexes.keys())[x] for x in range(len(date_indexes.keys())) if
+# drought_periods = [period_list[x] for x in range(len(period_list)) if
 #                    x in [2, 3, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16]]
-drought_periods = list(date_indexes.keys())
+drought_periods = list(period_list)
+
+# Thresholds from the HISTORICAL MODEL to count days under (LTQ99, LTQ95) and over (GTQ05, GTQ01).
+# Any column of master_df can be added here, e.g. "bankfull_flow" (above=True) for GTbankfull:
+threshold_columns = ["hist_q99", "hist_q95", "hist_q05", "hist_q01"]
+threshold_above = [False, False, True, True]
 
 # --- CREATE BLANK OUTPUTS ----------------
 
-output_list = []
 output_names = []
 
-tuples = [(r, p) for r in rcm_list for p in date_indexes.keys()]
-output_template = pd.DataFrame(columns=tuples, index=catchment_list)
-output_template.index.name = 'catchment'
-output_template.columns = pd.MultiIndex.from_tuples(tuples)
-# df = df.sort_index(1)
-
 if calculate_flow_stats:
-    output_Q99 = copy.deepcopy(output_template)
-    output_Q95 = copy.deepcopy(output_template)
-    output_Q50 = copy.deepcopy(output_template)
-    output_Q05 = copy.deepcopy(output_template)
-    output_Q01 = copy.deepcopy(output_template)
-    output_LTQ95 = copy.deepcopy(output_template)
-    output_LTQ99 = copy.deepcopy(output_template)
-    output_GTQ05 = copy.deepcopy(output_template)
-    output_GTQ01 = copy.deepcopy(output_template)
-
-    # Add outputs to a list for writing:
-    output_list.extend([output_Q99, output_Q95, output_Q50, output_Q05, output_Q01,
-                        output_LTQ95, output_LTQ99, output_GTQ05, output_GTQ01])  # output_GTbankfull
-    output_names.extend(["Q99", "Q95", "Q50", "Q05", "Q01", "LTQ95", "LTQ99", "GTQ05", "GTQ01"])
+    output_names.extend(["Q99", "Q95", "Q50", "Q05", "Q01", "LTQ95", "LTQ99", "GTQ05", "GTQ01"])  # "GTbankfull"
+
+# Return periods (years) of the ReturnPeriod_<years>yr outputs:
+return_periods = [2, 3, 5, 10, 25, 50, 100]
 
 if calculate_return_periods:
-    output_ReturnPeriod_2yr = copy.deepcopy(output_template)
-    output_ReturnPeriod_3yr = copy.deepcopy(output_template)
-    output_ReturnPeriod_5yr = copy.deepcopy(output_template)
-    output_ReturnPeriod_10yr = copy.deepcopy(output_template)
-    output_ReturnPeriod_25yr = copy.deepcopy(output_template)
-    output_ReturnPeriod_50yr = copy.deepcopy(output_template)
-    output_ReturnPeriod_100yr = copy.deepcopy(output_template)
-
-    # Add outputs to a list for writing:
-    output_list.extend([output_ReturnPeriod_2yr,
-                        output_ReturnPeriod_3yr, output_ReturnPeriod_5yr, output_ReturnPeriod_10yr,
-                        output_ReturnPeriod_25yr, output_ReturnPeriod_50yr, output_ReturnPeriod_100yr])
-    output_names.extend(["ReturnPeriod_2yr", "ReturnPeriod_3yr", "ReturnPeriod_5yr", "ReturnPeriod_10yr",
-                         "ReturnPeriod_25yr", "ReturnPeriod_50yr", "ReturnPeriod_100yr"])
+    output_names.extend([f"ReturnPeriod_{years}yr" for years in return_periods])
 
 if calculate_drought_stats:
-    # Using periods of interests to droughts, calculate standardised metrics of:
-    dps = [x for x in range(len(output_template.columns)) if output_template.columns[x][1] in drought_periods]
-
-    output_drought_duration_mean = copy.deepcopy(output_template.iloc[:, dps])  # (not affected by standardisation)
-    output_drought_months = copy.deepcopy(output_template.iloc[:, dps])  # (not affected by standardisation)
-
-    output_deficit_max = copy.deepcopy(output_template.iloc[:, dps])
-    output_deficit_mean = copy.deepcopy(output_template.iloc[:, dps])
-    output_deficit_total = copy.deepcopy(output_template.iloc[:, dps])
-
-    # Calculate the same [standardised] metrics for only the moderate and major droughts:
-    output_drought_duration_mean_severe = copy.deepcopy(output_template.iloc[:, dps])
-    output_drought_months_severe = copy.deepcopy(output_template.iloc[:, dps])
-    output_deficit_mean_severe = copy.deepcopy(output_template.iloc[:, dps])
-
-    # Add outputs to a list for writing:
-    output_list.extend([output_drought_duration_mean, output_drought_months, output_drought_months_severe,
-                        output_deficit_max, output_deficit_mean, output_deficit_total,
-                        output_drought_duration_mean_severe, output_deficit_mean_severe])
-    output_names.extend(["drought_duration_mean", "drought_months", "drought_months_severe",
-                         "drought_deficit_max", "drought_deficit_mean", "drought_deficit_total",
-                         "drought_duration_mean_severe", "drought_deficit_mean_severe"])
-
-# --- CALCULATE FLOW STATISTICS -----------
-
-print("Calculating statistics for catchments:")
-test_time = time.time()
-# # Create counter for tracking progress:
-counter = 0
-
-# Run through each of the catchments that we intended to model:
-for catchment in catchment_list:
-
-    counter += 1
-
-    print(f"- {catchment} ({counter}/{len(catchment_list)})")
-
-    # Run through each RCM run:
-    print("   rcm:")
-
-    for r in range(len(rcm_list)):
-
-        rcm = rcm_list[r]
-
-        print("   - ", rcm)
-
-        # Try to open the flow output:
-        try:
-            flow_path = os.path.join(master_folder_UKCP18 + rcm, str(catchment),
-                                     "output_" + str(catchment) + "_discharge_sim_regulartimestep.txt")
-            if os.path.exists(flow_path):
-                flow_df = pd.read_csv(flow_path).squeeze()
-
-                # Check that the simulation completed 100 years, else skip calculations:
-                if len(flow_df) < 36000:
-                    print("Catchment ", catchment, " skipped as incomplete.")
-                    continue
-
-                if max(flow_df) == 0:
-                    print(f"- Catchment {catchment} skipped as no values greater than 0.")
-                    continue
-
-                # Sometimes the model outputs are 100yrs x 365 days instead of 100x360.
-                # This end period has no driving data, so should be trimmed off.
-                flow_df = flow_df[0:min(36000, len(flow_df))]
-
-            else:
-                continue
-
-        except Exception as e:
-            print("Exception - Catchment: ", catchment, ":")
-            print("... ", e)
-            continue
-
-        # ---------------------------------------------------------
-        # CALCULATE FLOW QUANTILES AND COUNTS OVER/UNDER THRESHOLD:
-        # ---------------------------------------------------------
-
-        if calculate_flow_stats or calculate_return_periods:
-
-            # Run through each period:
-            for period in date_indexes.keys():
-
-                # print(r, rcm, catchment, period)
-
-                # Get the list of indexes/dates from the period dictionary:
-                date_index = date_indexes[period]
-
-                # If it is a warming period, calculate the correct dates for the period (capped at 2080):
-                if "WL" in period:
-                    date_index = np.arange(360 * (date_index[r] - 1980),
-                                           min(360 * (date_index[r] - 1980 + 30), 360 * 100))
-                else:
-                    # Translate the period string into a list of indexes for the period:
-                    date_index = np.arange(date_index[0], date_index[1], 1)
-
-                temp_data = flow_df[date_index]
-
-                if calculate_flow_stats:
-                    period_years = len(date_index) / 360
-
-                    # Calculate UKCP18 flow quantiles:
-                    output_Q99.loc[catchment, (rcm, period)] = round(temp_data.quantile(0.01), 3)  # Very low flow
-                    output_Q95.loc[catchment, (rcm, period)] = round(temp_data.quantile(0.05), 3)  # Low flow
-                    output_Q50.loc[catchment, (rcm, period)] = round(temp_data.quantile(0.50), 3)  # Median flow
-                    output_Q05.loc[catchment, (rcm, period)] = round(temp_data.quantile(0.95), 3)  # High flow
-                    output_Q01.loc[catchment, (rcm, period)] = round(temp_data.quantile(0.99), 3)  # Very high flow
-
-                    # Calculate counts under thresholds from HISTORICAL MODEL:
-                    output_LTQ99.loc[catchment, (rcm, period)] = round(remove_None(
-                        len(temp_data.loc[temp_data < master_df.loc[catchment, 'hist_q99']])) / period_years, 2)
-                    output_LTQ95.loc[catchment, (rcm, period)] = round(remove_None(
-                        len(temp_data.loc[temp_data < master_df.loc[catchment, 'hist_q95']])) / period_years, 2)
-
-                    # Calculate counts over thresholds from HISTORICAL MODEL:
-                    output_GTQ05.loc[catchment, (rcm, period)] = round(remove_None(
-                        len(temp_data.loc[temp_data > master_df.loc[catchment, 'hist_q05']])) / period_years, 2)
-                    output_GTQ01.loc[catchment, (rcm, period)] = round(remove_None(
-                        len(temp_data.loc[temp_data > master_df.loc[catchment, 'hist_q01']])) / period_years, 2)
-
-                    # Calculate counts under thresholds from OBSERVED DATASET if there is a value:
-                    # if not np.isnan(master_df.loc[catchment, 'bankfull_flow']):
-                    #     output_GTbankfull.loc[catchment, (rcm, period)] = remove_None(
-                    #         len(temp_data.loc[temp_data > master_df.loc[catchment, 'bankfull_flow']])) / period_years
-
-                if calculate_return_periods:
-                    # Calculate return periods UKCP18 Data:
-                    return_period_years, return_period_flows = calculate_return_events(
-                        temp_data, return_periods=[2, 3, 5, 10, 25, 50, 100])
-                    output_ReturnPeriod_2yr.loc[catchment, (rcm, period)] = return_period_flows[0]
-                    output_ReturnPeriod_3yr.loc[catchment, (rcm, period)] = return_period_flows[1]
-                    output_ReturnPeriod_5yr.loc[catchment, (rcm, period)] = return_period_flows[2]
-                    output_ReturnPeriod_10yr.loc[catchment, (rcm, period)] = return_period_flows[3]
-                    output_ReturnPeriod_25yr.loc[catchment, (rcm, period)] = return_period_flows[4]
-                    output_ReturnPeriod_50yr.loc[catchment, (rcm, period)] = return_period_flows[5]
-                    output_ReturnPeriod_100yr.loc[catchment, (rcm, period)] = return_period_flows[6]
-
-        # --------------------
-        # CEH Drought metrics:
-        # --------------------
-
-        if calculate_drought_stats:
-
-            # >>> STEP 1 & 3 <<<
-            # (Create long term standardised mean monthly flows)
-
-            # --- Aggregate to monthly:
-            monthly_flow = aggregate_to_monthly(flow_df[:36000])  # The Climate data length
-
-            baseline_start = int(date_indexes[drought_baseline_date][0] / 30)
-            baseline_stop = int(date_indexes[drought_baseline_date][1] / 30)
-
-            # Calculate the mean monthly flow (i.e. Jan-Dec) for the baseline period:
-            mean_monthly_flow_baseline, mean_monthly_flow_baseline_std = mean_baseline_flow(
-                monthly_flow[baseline_start:baseline_stop])
-
-            # Calculate flow anomaly by removing mean monthly baseline flow from the full record:
-            monthly_flow_anomaly = calculate_flow_anomaly(monthly_flow, mean_monthly_flow_baseline)
-
-            # Normalise the anomaly by dividing by the mean month's standard deviation:
-            monthly_flow_anomaly_normalised = normalise_anomaly(monthly_flow_anomaly, mean_monthly_flow_baseline_std)
-
-            # Create list of flow deficits (i.e. negative normalised anomalies):
-            monthly_flow_deficit_stnd = [1 if m < 0 else 0 for m in monthly_flow_anomaly_normalised]
-
-            # >>> STEP 2 <<<
-            # (Calculate duration, intensity and severity of deficit of standardised timeseries)
-
-            # --- Create data table to hold all the drought data ---
-
-            # Start with columns for lengths for droughts and non-droughts:
-            drought_count = [(i, len(list(g))) for i, g in groupby(monthly_flow_deficit_stnd)]
-            master_drought_table = pd.DataFrame(drought_count, columns=['drought', 'length'])
-
-            # Add a column with indexes of months when each drought/non-drought ends:
-            master_drought_table["month"] = master_drought_table["length"].cumsum()
-
-            # Add columns with indexes for using with Python sub-setting:
-            master_drought_table["start_index"] = master_drought_table["month"] - master_drought_table["length"]
-            master_drought_table["end_index"] = master_drought_table["start_index"] + master_drought_table["length"]
-
-            # Subset the dataset to only drought periods:
-            master_drought_table = master_drought_table[master_drought_table["drought"] == 1]
-            master_drought_table = master_drought_table.reset_index()
-
-            # Add columns for intensity and severity:
-            master_drought_table[["severity", "severity_class"]] = np.nan  # "intensity_total", "intensity_mean", 
-
-            # Run through each period for the catchment and calculate statistics:
-            for period in drought_periods:
-
-                # Get indexes from the date_index dictionary:
-                date_index = date_indexes[period]
-
-                # If it is a warming period, calculate the correct start/end months for the period.
-                # Capped at 2080, converting from days to months:
-                if "WL" in period:
-                    date_index = [360 / 30 * (date_index[r] - 1980),
-                                  min(360 / 30 * (date_index[r] - 1980 + 30), 12 * 100)]
-                else:
-                    # Translate the period string into a start and end month for the period:
-                    date_index = [date_index[0] / 30, date_index[1] / 30]
-
-                # Calculate a factor to multiply short periods by to normalise them up to 30 yrs:
-                # (For 30 yr periods, this will be 1).
-                thirty_yrs = 360/(date_index[1]-date_index[0])  # Note that this is calculated differently to previous.
-
-                # IMPORTANT: some of the droughts will cross over between periods. This creates terrible results.
-                # We need to crop all droughts at their periods, so we will take a subset of the
-                # data (only containing data for the period), edit the start and end droughts, if needed,
-                # and then do analysis on that.
-
-                # Subset 1. Use filter rows inclusive of those that overlap the thresholds (d_start<p_end + d_end>p_start):
-                period_drought_table = master_drought_table[
-                    (master_drought_table['start_index'] <= date_index[1]) &
-                    (master_drought_table['end_index'] >= date_index[0])
-                ].copy()
-
-                # Subset 2. Edit the start of the first drought and the end of the last:
-                period_drought_table.at[period_drought_table.index[0], 'start_index'] = max([period_drought_table['start_index'].iloc[0], date_index[0]])
-                period_drought_table.at[period_drought_table.index[-1], 'end_index'] = min([period_drought_table['end_index'].iloc[-1], date_index[1]])
-
-                # Subset 3. Calculate new drought durations for the edited rows.
-                period_drought_table.at[period_drought_table.index[0], 'length'] = period_drought_table['end_index'].iloc[0] - period_drought_table['start_index'].iloc[0]
-                period_drought_table.at[period_drought_table.index[-1], 'length'] = period_drought_table['end_index'].iloc[-1] - period_drought_table['start_index'].iloc[-1]
-
-                # If step 3 means that there is an initial drought with 0 length, remove this:
-                period_drought_table = period_drought_table[period_drought_table['length'] != 0]
-
-                # --- Calculate the intensities & severities ---
-
-                # Run through each drought instance:
-                for row in period_drought_table.index:
-
-                    # Create index for monthly flow time series based on the drought period:
-                    # subset the monthly flow time series based on the drought period:
-                    drought_instance = monthly_flow_anomaly_normalised[int(period_drought_table.loc[row, "start_index"]):
-                                                                       int(period_drought_table.loc[row, "end_index"])]
-
-                    # Calculate mean intensity (average deficit) and add this to the table:
-                    period_drought_table.loc[row, "intensity_mean"] = -drought_instance.mean()
-
-                    # Calculate Severity (total deficit) and add this to the table: (intensity total == mean intensity x duration):
-                    period_drought_table.loc[row, "severity"] = -drought_instance.sum()  # period_drought_table.loc[row, "intensity_mean"] * period_drought_table.loc[row, "length"]
-
-                    # Calculate Standardised Severity class:
-                    if period_drought_table.loc[row, "severity"] < 4:
-                        period_drought_table.loc[row, "severity_class"] = 0
-                    if period_drought_table.loc[row, "severity"] >= 4:
-                        period_drought_table.loc[row, "severity_class"] = 1
-                    if period_drought_table.loc[row, "severity"] >= 8:
-                        period_drought_table.loc[row, "severity_class"] = 2
-
-                # >>> STEP 4 & 5 <<<
-                # (Statistics; for droughts and severe droughts [Severity > 4 m3/s])
+    # Standardised drought metrics (duration and months are not affected by standardisation), and the same metrics
+    # for only the moderate and major droughts (severe). These are only output for the drought periods:
+    output_names.extend(drought_output_names)
+
+# Settings of the analysis of each catchment, which is shared by all of the models (see analyse_site_flows):
+analysis_settings = {"outputs": output_names, "periods": period_table, "rcms": rcm_list,
+                     "drought_periods": drought_periods, "drought_baseline_date": drought_baseline_date,
+                     "threshold_above": threshold_above, "return_periods": return_periods, "count_decimals": 2,
+                     "absolute_flows": False, "skip_zero_flows": True, "days": 36000}
+
+# Settings that affect the results - checkpoints are only used if these (with the periods of their RCM) and the flow
+# output have not changed. The RCMs of the run and their periods are hashed per RCM (see hash_rcm_configs), so adding
+# an RCM to the run keeps the checkpoints of the others:
+analysis_config = {"model": model, "fit_version": fit_version, "periods": period_list,
+                   **{name: value for name, value in analysis_settings.items() if name not in ["periods", "rcms"]}}
+
+# --- CATCHMENT ANALYSIS ------------------
+
+# Create a function for getting the path of the flow output of each RCM for a catchment:
+def get_flow_paths(catchment):
+    """
+    :param catchment: Catchment name.
+    :return: List of the flow output paths (in the order of rcm_list).
+    """
+    return [adapter["flow_path"].format(catchment=catchment, rcm=rcm) for rcm in rcm_list]
+
+
+# Create a function for calculating the statistics of a catchment. This is run by the worker processes, so
+# it returns the results of the catchment rather than writing them into the result store:
+def analyse_catchment(catchment, catchment_thresholds, run_rcms):
+    """
+    :param catchment: Catchment to analyse.
+    :param catchment_thresholds: Historical flow thresholds of the catchment (in the order of threshold_columns).
+    :param run_rcms: Positions of the RCMs to analyse (the others are left as NaN, e.g. as they are checkpointed).
+    :return: Array of the results of the catchment (output x rcm x period) and a list of the positions of the RCMs
+             that could not be analysed because of an error.
+    """
+    # Load the flows prefetch_files RCMs at a time - the next RCMs are read in background threads while these are
+    # analysed (or taken from the flow store):
+    rcm_batches = [run_rcms[start:start + prefetch_files] for start in range(0, len(run_rcms), prefetch_files)] or [[]]
+    batch_flows = stream_site_flows(adapter, catchment, [[rcm_list[r] for r in batch] for batch in rcm_batches],
+                                    flow_store=flow_store, ahead=prefetch_files, max_memory=prefetch_memory)
+
+    # Calculate the statistics of each batch of RCMs (the catchment outlet is the only series):
+    catchment_values, failed_rcms = None, []
+    for batch, site_flows in zip(rcm_batches, batch_flows):
+        catchment_values, batch_failed_rcms = analyse_site_flows(catchment, site_flows, batch, catchment_thresholds,
+                                                                 analysis_settings, fit_cache=fit_cache,
+                                                                 values=catchment_values)
+        failed_rcms.extend(batch_failed_rcms)
+
+    return catchment_values[:, 0], failed_rcms
+
+
+# --- RUN ANALYSIS -----------------------
+
+# The analysis is only run by the main process. The worker processes import the settings and functions above:
+if __name__ == "__main__":
+
+    print("Beginning analysis - if you have an output worksheet open, close it now!")
+
+    if not calculate_flow_stats and not calculate_drought_stats and not calculate_return_periods:
+        print("Check you are making outputs! 'Flow', 'Return Period' and 'Drought' stats are set to False.")
+
+    # Print the name of the output and path as a final check for the user
+    print(output_root_name)
+    print(master_folder_UKCP18)
+    sleep(2)
+
+    # Start profiling the stages of the run:
+    profile = start_profile(use_cprofile) if profile_path is not None else None
+
+    # --- CALCULATE HISTORICAL STATISTICS -----
+    if calculate_flow_stats:
+        # The thresholds of the catchments without stored thresholds are calculated in parallel and stored:
+        print("Finding the historical flow thresholds:")
+        master_df[threshold_names] = get_historical_thresholds(
+            threshold_store_path, adapter, catchment_list,
+            [adapter["historical_path"].format(catchment=catchment) for catchment in catchment_list],
+            workers=workers)
+
+    # Create a float array to hold all of the outputs (metric x catchment x rcm x period). The results of each
+    # catchment are added to this as they are returned and the output tables are only created when they are written:
+    results = create_result_store(output_names, catchment_list, rcm_list, period_list)
+    result_values = results["values"]
+
+    # Look up the historical thresholds of each catchment:
+    if calculate_flow_stats:
+        thresholds = [master_df.loc[catchment, threshold_columns].to_numpy(dtype=float, na_value=np.nan)
+                      for catchment in catchment_list]
+    else:
+        thresholds = [None] * len(catchment_list)
+
+    # --- CHECKPOINTS -------------------------
+    # Results saved by earlier runs are used where the flow output and the analysis settings have not changed:
+    if checkpoint_folder is not None:
+        checkpoints = open_checkpoints(checkpoint_folder)
+        if flow_store is None:
+            flow_identities = [[get_file_identity(path) for path in get_flow_paths(catchment)]
+                               for catchment in catchment_list]
+        else:
+            flow_identities = [[get_stored_flow_identity(flow_store, catchment, rcm) for rcm in rcm_list]
+                               for catchment in catchment_list]
+        configs = [hash_rcm_configs(period_table, analysis_config, catchment_thresholds)
+                   for catchment_thresholds in thresholds]
+    else:
+        checkpoints, flow_identities, configs = None, None, None
 
-                # --- Calculate Drought Statistics for Periods: ---
+    run_rcms = find_rcms_to_run(checkpoints, catchment_list, rcm_list, flow_identities, configs)
+    print(f"{sum(len(rcm_list) - len(rcms) for rcms in run_rcms)} catchment RCMs are already checkpointed.")
 
-                # Subset to severe droughts only:
-                period_drought_table_severe = period_drought_table[period_drought_table.severity_class > 0]
+    # --- CALCULATE FLOW STATISTICS -----------
 
-                # Add the duration to the output dataset:  [this is not normalised by period length]
-                output_drought_duration_mean.loc[catchment, (rcm, period)] = round(period_drought_table["length"].mean(skipna=True), 3)
-                output_drought_duration_mean_severe.loc[catchment, (rcm, period)] = round(period_drought_table_severe["length"].mean(skipna=True), 3)
+    print(f"Calculating statistics for catchments ({workers} workers):")
+    fit_cache_start = get_fit_cache_stats(fit_cache) if fit_cache is not None else None
+    test_time = time.time()
+    # Track the progress of the run in catchment RCMs, counting only the RCMs that are not checkpointed:
+    progress = start_progress(len(catchment_list), [len(rcms) for rcms in run_rcms], "catchment RCMs",
+                              progress_path, progress_interval, workers,
+                              {"output_root_name": output_root_name, "model": model_tab_name})
 
-                # Add the counts of drought months:  [these are normalised to 30 years]
-                output_drought_months.loc[catchment, (rcm, period)] = round(period_drought_table["length"].sum(skipna=True)*thirty_yrs, 3)
-                output_drought_months_severe.loc[catchment, (rcm, period)] = round(period_drought_table_severe["length"].sum(skipna=True)*thirty_yrs, 3)
+    # Run through each of the catchments that we intended to model. Results come back as each catchment finishes, and
+    # are stored by its position in the catchment list, so the outputs are the same as a serial run:
+    catchment_results = run_catchments(analyse_catchment, catchment_list, thresholds, run_rcms, workers=workers,
+                                       progress=progress)
 
-                # Add deficit statistics to output dataset:  [total deficit is normalised to 30 years]
-                output_deficit_total.loc[catchment, (rcm, period)] = round(period_drought_table["severity"].sum(skipna=True)*thirty_yrs, 3)
+    for c, (catchment_values, failed_rcms) in catchment_results:
+        catchment = catchment_list[c]
 
-                output_deficit_max.loc[catchment, (rcm, period)] = round(period_drought_table["severity"].max(skipna=True), 3)
-                output_deficit_mean.loc[catchment, (rcm, period)] = round(period_drought_table["severity"].mean(skipna=True), 3)
-                output_deficit_mean_severe.loc[catchment, (rcm, period)] = round(period_drought_table_severe["severity"].mean(skipna=True), 3)
+        # Save the newly analysed RCMs and fill in the others from their checkpoints:
+        if checkpoints is not None:
+            catchment_values = merge_checkpoints(checkpoints, catchment, rcm_list, run_rcms[c], failed_rcms,
+                                                 flow_identities[c], configs[c], catchment_values)
 
+        # Add the results of the catchment to the result store:
+        result_values[:, results["sites"][catchment]] = catchment_values
 
-print("TIME: ", time.time() - test_time)
+    finish_progress(progress)
+    print("TIME: ", time.time() - test_time)
+    if fit_cache is not None:
+        report_fit_cache_stats(fit_cache, fit_cache_start)
 
-# -----------------------------
-# WRITE FLOW/DROUGHT STATISTICS
-# -----------------------------
+    # -----------------------------
+    # WRITE FLOW/DROUGHT STATISTICS
+    # -----------------------------
 
-print("Writing Excel documents.")
+    print("Writing results.")
+    write_time = time.time()
 
+    # Drought outputs only contain the drought periods:
+    write_results(results, results_folder, model_tab_name, file_format=results_format,
+                  metric_periods={name: drought_periods for name in output_names if name.startswith("drought_")})
 
-for i in range(len(output_list)):
-    output_path = f"{analysis_path}Outputs/01_Catchments/{output_root_name}_{output_names[i]}.xlsx"
+    print("TIME: ", round(time.time() - write_time, 1))
 
-    # Check whether to append or write new file:
-    if os.path.exists(output_path):
-        # Append data. This will overwrite sheets with the same name:
-        with pd.ExcelWriter(output_path, mode='a', if_sheet_exists='replace') as writer:
-            output_list[i].to_excel(writer, sheet_name=model_tab_name)
-    else:
-        # Write data to new workbook:
-        with pd.ExcelWriter(output_path, mode='w') as writer:
-            output_list[i].to_excel(writer, sheet_name=model_tab_name)
+    # Write the profile of the run:
+    if profile is not None:
+        write_profile(profile, profile_path, {"output_root_name": output_root_name, "model": model_tab_name,
+                                              "workers": workers, "catchments": len(catchment_list),
+                                              "rcms": len(rcm_list)})
 
+    print('Run "Hydrological Flow and Drought Analysis - Export Excel.py" to write the Excel workbooks.')
@@ -0,0 +1,81 @@
+"""
+UKCP18 Flow Statistics - Excel Export
+Newcastle University
+
+--- NOTES -------------------------------
+Makes the Excel workbooks of the flow and drought statistics (one workbook for each metric, with a tab for each model)
+from the results written by the analysis scripts to Outputs/Results. This only needs running when the workbooks are
+wanted - the results can be read directly with read_results, which only loads the metrics, models and columns asked
+for, e.g.:
+    read_results(analysis_path + "Outputs/Results/01c_UKCP18_UDMbaseline", metrics=["Q99"], models=["HBV"])
+
+Each workbook is written in one pass with a constant memory writer, with a tab for each model in the results (so run
+the analysis of every model into the same results first). The workbooks are written in parallel processes.
+Set append_to_workbooks to instead add the tabs to the existing workbooks, as the analysis scripts used to - this keeps
+the tabs of models that are not in the results, but is much slower as every workbook is loaded and re-written.
+
+Run this on Blade 4 using:
+conda activate \ProgramData\Water_Blade_Programs\BenSmith\env_lmoments
+I:
+cd "SHETRAN_GB_2021\08_Analysis\03 - Flow Analysis"
+python "Hydrological Flow and Drought Analysis - Export Excel.py"
+"""
+
+# --- IMPORT PACKAGES ----------------------
+from Hydrological_Flow_and_Drought_Analysis_Functions import *
+
+# --- SET FILE PATHS ----------------------
+
+convex = "I:/SHETRAN_GB_2021/"
+analysis_path = convex + "08_Analysis/03 - Flow Analysis/"
+
+# --- USER INPUTS ------------------------
+
+# --- Set the results to export (the output_root_name of the analysis script):
+output_root_name = "01c_UKCP18_UDMbaseline"
+
+# --- Set whether these are the river network results (Rivers - SHETRAN) or the catchment results:
+river_network = False
+
+# --- Set the metrics and models (tab names) to export - None exports all of them:
+metrics = None  # e.g. ["Q99", "ReturnPeriod_10yr"]
+models = None  # e.g. ['HBV', 'SHETRAN-UK Autocalibrated', "LSTM"]
+
+# --- Crop the sites without results from the workbooks (the river network workbooks are very large, and take a long
+# time to write and open):
+reduce_export = False
+
+# --- Add the tabs to the existing workbooks rather than replacing the workbooks:
+append_to_workbooks = False
+
+# Number of workbooks to write at once (1 writes them in serial):
+export_workers = max(1, min(8, os.cpu_count() - 1))
+
+# --- END USER INPUTS --------------------
+
+if river_network:
+    results_folder = analysis_path + "Outputs/Results/" + output_root_name + "_RiverNet"
+    output_prefix = f"{analysis_path}Outputs/02_River_Network/{output_root_name}_RiverNet_"
+    index_name = 'Network_id'
+else:
+    results_folder = analysis_path + "Outputs/Results/" + output_root_name
+    output_prefix = f"{analysis_path}Outputs/01_Catchments/{output_root_name}_"
+    index_name = 'catchment'
+
+# --- EXPORT WORKBOOKS ---------------------
+
+if __name__ == "__main__":
+
+    print("Writing Excel documents.")
+    print(results_folder)
+    test_time = time.time()
+
+    if len(list_results(results_folder)) == 0:
+        raise FileNotFoundError(f"There are no results in {results_folder} - run the analysis script first.")
+
+    os.makedirs(os.path.dirname(output_prefix), exist_ok=True)
+    workbooks = export_results_to_excel(results_folder, output_prefix, index_name, metrics=metrics, models=models,
+                                        reduce_export=reduce_export, append=append_to_workbooks, workers=export_workers)
+
+    print(f"- {len(workbooks)} workbooks written.")
+    print("TIME: ", round(time.time() - test_time, 1))
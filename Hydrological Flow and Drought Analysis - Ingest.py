@@ -0,0 +1,97 @@
+"""
+UKCP18 Flow Store Ingest
+Newcastle University
+
+--- NOTES -------------------------------
+Converts the flow outputs of a scenario (one file for each catchment and RCM) into a single flow store, so that the
+catchment analysis scripts can memory-map the flows rather than parsing thousands of text files on every run.
+
+The flows are written to Flow_Stores/<output_root_name>_<model>.npy (catchment x rcm x day), with an index of the
+catchments, RCMs, the length of each series and the size and modification time of its flow output in
+Flow_Stores/<output_root_name>_<model>_index.csv. The analysis checkpoints use these, so after re-ingesting only the
+series whose flow outputs changed are analysed again.
+To use the store, set flow_store_path in the analysis script to the same path (without the extension).
+
+Flows are stored as they are read from the files - LSTM flows are in mm/day and are converted to cumecs by the
+analysis script. Flows after the end of the climate data (36,000 days) are not stored, as the analysis trims these.
+Re-run this if the model outputs change.
+
+Run this on Blade 4 using:
+conda activate \ProgramData\Water_Blade_Programs\BenSmith\env_lmoments
+I:
+cd "SHETRAN_GB_2021\08_Analysis\03 - Flow Analysis"
+python "Hydrological Flow and Drought Analysis - Ingest.py"
+"""
+
+# --- IMPORT PACKAGES ----------------------
+from Hydrological_Flow_and_Drought_Analysis_Functions import *
+
+# --- SET FILE PATHS ----------------------
+
+convex = "I:/SHETRAN_GB_2021/"
+analysis_path = convex + "08_Analysis/03 - Flow Analysis/"
+store_folder = analysis_path + "Flow_Stores/"
+
+# Number of flow files to read at once:
+read_ahead = 8
+
+# --- USER INPUTS ------------------------
+# --- Choose one of the setups to ingest - these should match the analysis script.
+
+# --- Set model type:
+model = "SHETRAN"  # "SHETRAN" | "HBV" | "LSTM"
+
+# --- Set model paths:
+
+# SHETRAN Autocalibration Baseline:
+output_root_name = "01c_UKCP18_UDMbaseline"
+master_folder_UKCP18 = convex + "05_Climate_Change_Simulations/01c_UKCP18rcm_Autocal_UDM_Baseline/bcm_"
+
+# # SHETRAN Calibrated UKCP18 NFM Max (02c):
+# output_root_name = "02c_UKCP18_UDMbaseline_NFMmax"
+# master_folder_UKCP18 = convex + "05_Climate_Change_Simulations/02c_UKCP18_Autocal_UDM_baseline_NFMmax/bcm_"
+
+# # HBV Autocalibration Baseline:
+# output_root_name = "01c_UKCP18_UDMbaseline"
+# master_folder_UKCP18 = convex + "08_Analysis/00 - HBV Outputs for Analysis/Final Models - Monthly Means/outputUDMcat/outputUDMcat/UK/bc"
+# UDM_Folder_name = 'Base'
+
+# # LSTM UKCP18 Baseline:
+# output_root_name = "01c_UKCP18_LSTM_UDMbaseline"
+# master_folder_UKCP18 = "I:/LSTM/001/output/lstm_001_cc/bcm_"
+
+# --- END USER INPUTS --------------------
+
+rcm_list = ["01", "04", "05", "06", "07", "08", "09", "10", "11", "12", "13", "15"]
+
+# Get the catchments of the model (as in the analysis scripts):
+if model == "SHETRAN":
+    catchment_list = pd.read_csv(analysis_path + "Catchments and Bankfull Data.csv", index_col=0).index
+else:
+    # HBV and LSTM use the list of HBV catchments:
+    master_folder_historical = convex + "08_Analysis/00 - HBV Outputs for Analysis/Final Models - Monthly Means/OB1980-2010/"
+    catchment_list = [str.split(c, ".")[0] for c in os.listdir(master_folder_historical)]
+
+# Get the flow paths and flow reader of the model:
+if model == "HBV":
+    adapter = get_model_adapter(model, master_folder_UKCP18, UDM_Folder_name=UDM_Folder_name)
+else:
+    adapter = get_model_adapter(model, master_folder_UKCP18)
+
+# Print the name of the output and path as a final check for the user
+print(output_root_name, model)
+print(master_folder_UKCP18)
+
+# --- INGEST FLOWS -------------------------
+
+print(f"Ingesting {len(catchment_list)} catchments x {len(rcm_list)} RCMs:")
+test_time = time.time()
+
+os.makedirs(store_folder, exist_ok=True)
+store_index = ingest_flow_store(store_folder + output_root_name + "_" + model, catchment_list, rcm_list,
+                                adapter["flow_path"], read_function=adapter["read"], ahead=read_ahead)
+
+print(f"- {(store_index['length'] >= 0).sum()}/{len(store_index)} flow outputs stored.")
+print(f"- {((store_index['length'] == -1) & (store_index['error'] == '')).sum()} flow outputs missing.")
+print(f"- {(store_index['error'] != '').sum()} flow outputs could not be read (see the error column of the index).")
+print("TIME: ", round(time.time() - test_time, 1))
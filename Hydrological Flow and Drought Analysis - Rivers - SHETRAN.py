@@ -9,6 +9,17 @@ All drought data is for the described period. It is not normalised to the length
 of the period (the baseline period is shorter than future periods).
 
 Lower in the script you will need to add / uncomment the chosen output name and file paths.
+Catchments are analysed in parallel - set 'workers' to the number of processes to use (1 runs them in serial).
+The flows use at most 'run_memory', shared between the workers. The river cells of the larger catchments are analysed
+in chunks that fit in each worker's share, and the results are held in a file ('result_store_path') until they are
+written, so the memory used stays the same whatever the number of workers, the size of the catchments and the length
+of the river network.
+The results of each catchment and RCM are saved to Outputs/Checkpoints as they are analysed, and are reused if the
+run is restarted. Delete the run's checkpoint folder to analyse everything again (e.g. after changing the code).
+The results are written to Outputs/Results as Parquet (or Feather) tables - run
+"Hydrological Flow and Drought Analysis - Export Excel.py" to make the Excel workbooks from these.
+The statistics are calculated by analyse_site_flows, which is shared by the model scripts - each script only sets
+how its flows are found and loaded (its model adapter, from get_model_adapter).
 
 Flows that cannot have lmoments (i.e. return periods) calculated will be set at 0 cumecs.
 This is because many of the instances where the calculation fails is where the flows are 0, so 0 cumecs
@@ -38,12 +49,11 @@ For water flow in Shetran: any flow in a northerly or easterly direction is +ve
 flow in a Southerly or westerly direction is -ve.
 
 --- TODO: -------------------------------
-        - DROUGHTS ARE WRONG AND NEED UPDATING FROM THE CATCHMENT CODE
         - Consider whether you should be calculating intensity and severity non-standardised and only using
             the standardised datasets to calculate Standardised Severity as an indicator for whether the
             drought is severe or not, rather than for its actual value.
-        - Very long droughts exist (i.e. 70 years). These are only recorded in the final period.
-            UPDATE THIS FROM THE CATCHMENT LEVEL CODE.
+        - Very long droughts exist (i.e. 70 years). These are only recorded in the final period. Consider
+            what to do here (as for the catchments).
         - Make sure that the river names are being read in without dropping trailing zeros. E.g. 1001.010 != 1001.01
         - Errors common with subtract issue in the return periods. Check cause and fix.
         - Add in check to skip temp_data that has no range in values (i.e. all 0 or all 0.16, for example)
@@ -55,15 +65,36 @@ from Hydrological_Flow_and_Drought_Analysis_Functions import *
 
 # --- BEGIN ANALYSIS ---------------------
 
-print("Beginning analysis - if you have an output worksheet open, close it now!")
-
 calculate_flow_stats = False
 calculate_return_periods = True
-calculate_drought_stats = False  # !! DO NOT USE THIS UNTIL YOU HAVE UPDATED FROM THE CATCHMENT LEVEL CODE !!
-reduce_export = False  # This will crop empty rows from the Excel Export - the reading and writing of these takes a long time when testing the code - you probably only want this when running tests.
+calculate_drought_stats = False  # The droughts of each river cell are calculated by the catchment code.
+
+# Number of processes used to analyse the catchments (1 runs them in serial):
+workers = max(1, os.cpu_count() - 1)
+
+# Number of RCM flow files that each process reads ahead of the calculations:
+prefetch_files = 4
+
+# Most memory (bytes) that the whole run uses for the flows of the river cells. This is shared between the worker
+# processes - each uses half of its share for the flows of the river cells it is analysing (chunk_memory) and half
+# for the flow files it reads ahead (prefetch_memory) - so the memory used does not grow with the number of workers:
+run_memory = 8 * 1024 ** 3
+
+# The river cells of the larger catchments are analysed in chunks that fit in chunk_memory, and the results of each
+# chunk are checkpointed and added to the result store as it finishes, so the memory used does not grow with the size
+# of the catchments. Set to False to analyse the river cells of each catchment at once:
+chunk_river_cells = True
 
-if not calculate_flow_stats and not calculate_drought_stats and not calculate_return_periods:
-    print("Check you are making outputs! 'Flow', 'Return Period' and 'Drought' stats are set to False.")
+# Cache of the GEV distributions fitted for the return periods, so that the same annual maximums are not fitted again
+# (e.g. when re-running, or in scenarios that share a baseline). Keep this on a local disk. Set to None to not use it:
+fit_cache_path = os.path.join(os.path.expanduser("~"), "Flow_Analysis_Cache", "gev_fits.sqlite")
+fit_cache_size = 500000  # Most fits to keep - the least recently used are removed.
+fit_cache = get_shared_result(("fit cache", fit_cache_path), open_fit_cache, fit_cache_path,
+                              fit_cache_size) if fit_cache_path is not None else None
+
+# Take the flow direction of each river cell from the direction index (which is made from the historical simulations
+# the first time it is needed), rather than finding it from the start of each RCM output:
+use_direction_index = True
 
 
 # --- SET FILE PATHS ----------------------
@@ -72,12 +103,11 @@ convex = "I:/SHETRAN_GB_2021/"
 analysis_path = convex + "08_Analysis/03 - Flow Analysis/"
 warming_levels_path = analysis_path + "Warming_levels_stripped.csv"
 cell_lookup = "08_Analysis/02 - UK River Network Creator/UK Catchment Rasters/SHETRAN_UK_River_Network_Autocal_AreaSorted_GT07NSE_Lookup_uniques_with5km.csv"
+direction_index_path = convex + cell_lookup.replace(".csv", "_Directions.csv")
 
-# Read in warming level dates:
-warming_levels = pd.read_csv(warming_levels_path)
-
-# Get a list of the catchments in our network:
-master_df = pd.read_csv(convex + cell_lookup, usecols=[0])
+# Get a list of the catchments in our network (read once for the scenarios of a batch run):
+master_df = get_shared_result(("river network", convex + cell_lookup), pd.read_csv, convex + cell_lookup,
+                              usecols=[0]).copy()
 master_df['Network_ID'] = master_df['Network_ID'].astype(str)
 
 # Split the ID into its component parts:
@@ -96,8 +126,8 @@ master_df = master_df.drop_duplicates()
 
 catchment_list = master_df["Catchment"].unique().astype("str")
 
-model_tracker = pd.read_csv(convex + "01_Scripts/SHETRAN_UK_Autocal_UKCP18_UDMbaseline/exe_list_all_catchments.csv",
-                            index_col=0)
+model_tracker_path = convex + "01_Scripts/SHETRAN_UK_Autocal_UKCP18_UDMbaseline/exe_list_all_catchments.csv"
+model_tracker = get_shared_result(("model tracker", model_tracker_path), pd.read_csv, model_tracker_path, index_col=0)
 
 # Set date to be used as a baseline for drought calculations:
 drought_baseline_date = "1985-2010"
@@ -161,13 +191,56 @@ master_folder_UKCP18 = convex + "05_Climate_Change_Simulations/01c_UKCP18rcm_Aut
 # output_root_name = "06c_UKCP18_UDMbaseline_NFMbal_woodland"
 # master_folder_UKCP18 = convex + "05_Climate_Change_Simulations/06c_UKCP18_Autocal_UDM_baseline_NFMbal_woodland/bcm_"
 
+# --- Set scenario:
+# When run by "Hydrological Flow and Drought Analysis - Batch.py", the settings above (and the calculate_ and workers
+# settings) are replaced by those of the scenario in Scenarios.csv:
+scenario = apply_scenario_settings(globals(), convex)
+
+# --- Set memory:
+# Share the memory of the run between the worker processes (after the scenario, as it can change the workers):
+prefetch_memory = run_memory // workers // 2
+chunk_memory = run_memory // workers - prefetch_memory if chunk_river_cells else None
+
+# --- Set checkpoints:
+# Save the results of each catchment and RCM as they are analysed, so that a run that stops part way through (or is
+# re-run with more catchments or RCMs) only analyses what has not already been done. Set to None to not save them:
+checkpoint_folder = analysis_path + "Outputs/Checkpoints/" + output_root_name + "_RiverNet"
+
+# --- Set historical thresholds:
+# The historical flow thresholds (hist_q99 etc.) of the river cells are calculated once and stored in this table, which
+# every later run and scenario reuses - they are only recalculated for catchments whose historical simulation (or
+# river cells) change. Set to None to calculate them on every run:
+threshold_store_path = analysis_path + "Outputs/Historical_Thresholds/" + model + "-RiverNet.parquet"
+
+# --- Set profile:
+# Time each stage of the run (reading, quantiles, exceedances, return periods, droughts, writing) and count the flows
+# read and the return period fits (and their failures) of each catchment and RCM. The profile is written to
+# profile_path + ".json" (the totals) and ".csv" (each catchment and RCM). Set to None to not profile the run:
+profile_path = analysis_path + "Outputs/Profiles/" + output_root_name + "_RiverNet"
+# Also run cProfile (written to profile_path + ".prof"). This only profiles the main process, so set workers to 1 to
+# profile the analysis of the catchments:
+use_cprofile = False
+
+# --- Set progress:
+# The progress of the run (catchments done, rate, estimated time of completion, worker utilisation and memory) is
+# printed, and written to this JSON file for other tools to poll, every progress_interval seconds. Set to None to only
+# print it:
+progress_path = analysis_path + "Outputs/Progress/" + output_root_name + "_RiverNet" + ".json"
+progress_interval = 10
+
+# --- Set results:
+# The results are written as long tables (site, rcm, period, value), partitioned by metric and model, to this folder.
+# The Excel workbooks are made from these by "Hydrological Flow and Drought Analysis - Export Excel.py":
+results_folder = analysis_path + "Outputs/Results/" + output_root_name + "_RiverNet"
+results_format = "parquet"  # "parquet" | "feather"
+# The results of the river cells are held in this file until they are written (it is then deleted), so the memory used
+# does not grow with the length of the river network. Set to None to hold them in memory:
+result_store_path = results_folder + "_store.npy"
 
 # --- END USER INPUTS --------------------
 
-# Print the name of the output and path as a final check for the user
-print(output_root_name)
-print(master_folder_UKCP18)
-# sleep(2)
+# Get the adapter of the river network, which finds and reads the flows of the river cells in the h5 outputs:
+adapter = get_model_adapter(model + "-RiverNet", master_folder_UKCP18)
 
 # --- TEST ---
 # catchment_list = catchment_list[2:4]
@@ -175,66 +248,15 @@ print(master_folder_UKCP18)
 # --- END ---
 
 
-# --- CALCULATE HISTORICAL STATISTICS -----
-if calculate_flow_stats:
-    # Extract flow stats from the historical simulations:
-    #   Historical simulations run from 01/01/1980 to 01/01/2011.
-    #   We will cut off the first 5 years of the simulation.
-    master_df[["hist_q99", "hist_q95", "hist_q05", "hist_q01"]] = pd.NA
-
-    counter = 0
-    for catchment in catchment_list:
-
-        counter += 1
-
-        print(f"- {catchment} ({counter}/{len(catchment_list)})")
-
-        try:  # Try/Exception used to account for missing files.
-
-            path = find_historical_simulation_path(catchment_name=catchment, catchment_tracker=model_tracker)
-            path = convex + path + catchment + "/output_" + catchment + "_shegraph.h5"
-
-            with h5py.File(path, 'r', driver='core') as hf:
-                flows = hf["VARIABLES"]['  4 ovr_flow']['value'][:]
-
-            # Check that the simulation completed (within 10%), else pass:
-            if flows.shape[2] < (11324 * 0.9):
-                continue
-
-            river_ids = master_df[master_df["Catchment"] == catchment].index
-            river_cells = [int(x) - 1 for x in master_df[master_df["Catchment"] == catchment]["River_Cell"]]
-
-            for cell in range(len(river_ids)):
-                # river_cell = river_cells.values[cell]-1
-                river_cell = river_cells[cell]
-                river_id = river_ids[cell]
-
-                # Get the flow direction: (0=north, 1=east, 2=south, 3=west)
-                direction = np.argmax(abs(np.sum(flows[river_cell, :, 0:1000], axis=1)))
-
-                # Calculate flow quantiles for the historical simulation:
-                master_df.loc[river_id, ["hist_q99"]] = form(
-                    np.quantile(flows[river_cell, direction, 365 * 5:], 0.01))  # Low flow
-                master_df.loc[river_id, ["hist_q95"]] = form(np.quantile(flows[river_cell, direction, 365 * 5:], 0.05))
-                master_df.loc[river_id, ["hist_q01"]] = form(np.quantile(flows[river_cell, direction, 365 * 5:], 0.99))
-                master_df.loc[river_id, ["hist_q05"]] = form(
-                    np.quantile(flows[river_cell, direction, 365 * 5:], 0.95))  # High flow
-
-        except Exception as e:
-            print("EXCEPTION - Network ID: ", catchment, ":")
-            print(e)
-            continue
-
-
 # --- SETUP PERIODS & STATISTICS ----------
 
 rcm_list = ["01", "04", "05", "06", "07", "08", "09", "10", "11", "12", "13", "15"]
 
 # period_list = ["1985-2010",  "1985-2080", # Baseline periods "1980-2000", "1980-2010", "1985-2000", "1985-2015", "1990-2010",
 #                "2010-2040", "2020-2050", "2030-2060", "2040-2070", "2050-2080",  # Future periods
-#                "WL1.5", "WL2.0", "WL2.5", "WL3.0", "WL3.5", "WL4.0"]  # Warming periods - these will need looking up.
+#                "WL1.5", "WL2.0", "WL2.5", "WL3.0", "WL3.5", "WL4.0"]  # Warming periods - from warming_levels_path.
 
-date_indexes = {
+fixed_periods = {
     # Dates start 01/12/1980. There are 360 days in a climate year.
     # "1980-2000": [0, 360 * 20],
     # "1980-2010": [0, 360 * 30],
@@ -249,434 +271,300 @@ date_indexes = {
     "2030-2060": [360 * 50, 360 * 80],
     "2040-2070": [360 * 60, 360 * 90],
     "2050-2080": [360 * 70, 360 * 100],
+}
 
-    # Listed in order of RCP warming period start years.
-    # The code reads from the start of the listed year.
-    "WL1.5": [2006, 2003, 2007, 2005, 2005, 2006, 2004, 2008, 2004, 2010, 2005, 2006],
-    "WL2.0": [2016, 2013, 2018, 2016, 2017, 2018, 2014, 2018, 2015, 2020, 2016, 2019],
-    "WL2.5": [2026, 2023, 2028, 2025, 2027, 2029, 2023, 2027, 2025, 2030, 2026, 2030],
-    "WL3.0": [2034, 2031, 2037, 2034, 2036, 2038, 2030, 2036, 2034, 2038, 2035, 2038],
-    "WL3.5": [2042, 2039, 2044, 2042, 2043, 2047, 2037, 2045, 2042, 2045, 2043, 2046],
-    "WL4.0": [2049, 2046, 2051, 2049, 2050, 2055, 2044, 2052, 2050, 2052, 2050, 2054]
+# Warming periods - these start at the start of the year that each RCM reaches the warming level (read from
+# warming_levels_path) and are 30 years long, capped at 2080:
+warming_levels = ["WL1.5", "WL2.0", "WL2.5", "WL3.0", "WL3.5", "WL4.0"]
 
-}
+# Build the start and end day and month of every period of every RCM once, for the analysis to slice the flows with:
+period_table = create_period_table(fixed_periods, rcm_list, warming_levels_path, warming_levels)
+period_list = period_table["periods"]
 
 # Create a list of drought periods (as these won't use all the baseline periods:
-drought_periods = list(date_indexes.keys())  # [list(date_indexes.keys())[x] for x in range(len(date_indexes.keys())) if x in [3, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16]]
+drought_periods = list(period_list)  # [period_list[x] for x in range(len(period_list)) if x in [3, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16]]
+
+# Thresholds from the HISTORICAL MODEL to count days under (LTQ99, LTQ95) and over (GTQ05, GTQ01).
+# Any column of master_df can be added here, e.g. "bankfull_flow" (above=True) for GTbankfull:
+threshold_columns = ["hist_q99", "hist_q95", "hist_q05", "hist_q01"]
+threshold_above = [False, False, True, True]
 
 # --- CREATE BLANK OUTPUTS ----------------
 
-output_list = []
 output_names = []
 
-tuples = [(r, p) for r in rcm_list for p in date_indexes.keys()]
-output_template = pd.DataFrame(columns=tuples, index=master_df.index)
-output_template.index.name = 'Network_id'
-output_template.columns = pd.MultiIndex.from_tuples(tuples)
-# df = df.sort_index(1)
-
 if calculate_flow_stats:
-    output_Q99 = copy.deepcopy(output_template)
-    output_Q95 = copy.deepcopy(output_template)
-    output_Q50 = copy.deepcopy(output_template)
-    output_Q05 = copy.deepcopy(output_template)
-    output_Q01 = copy.deepcopy(output_template)
-    output_LTQ95 = copy.deepcopy(output_template)
-    output_LTQ99 = copy.deepcopy(output_template)
-    output_GTQ05 = copy.deepcopy(output_template)
-    output_GTQ01 = copy.deepcopy(output_template)
-    # output_GTbankfull = copy.deepcopy(output_template)
-
-    # Add outputs to a list for writing:
-    output_list.extend([output_Q99, output_Q95, output_Q50, output_Q05, output_Q01,
-                        output_LTQ95, output_LTQ99, output_GTQ05, output_GTQ01])  # output_GTbankfull
-    output_names.extend(["Q99", "Q95", "Q50", "Q05", "Q01", "LTQ95", "LTQ99", "GTQ05", "GTQ01"])
+    output_names.extend(["Q99", "Q95", "Q50", "Q05", "Q01", "LTQ95", "LTQ99", "GTQ05", "GTQ01"])  # "GTbankfull"
+
+# Return periods (years) of the ReturnPeriod_<years>yr outputs:
+return_periods = [3, 5, 10, 25, 50, 100]  # 2
 
 if calculate_return_periods:
-    # output_ReturnPeriod_2yr = copy.deepcopy(output_template)
-    output_ReturnPeriod_3yr = copy.deepcopy(output_template)
-    output_ReturnPeriod_5yr = copy.deepcopy(output_template)
-    output_ReturnPeriod_10yr = copy.deepcopy(output_template)
-    output_ReturnPeriod_25yr = copy.deepcopy(output_template)
-    output_ReturnPeriod_50yr = copy.deepcopy(output_template)
-    output_ReturnPeriod_100yr = copy.deepcopy(output_template)
-
-    # Add outputs to a list for writing:
-    output_list.extend([# output_ReturnPeriod_2yr,
-                        output_ReturnPeriod_3yr, output_ReturnPeriod_5yr, output_ReturnPeriod_10yr,
-                        output_ReturnPeriod_25yr, output_ReturnPeriod_50yr, output_ReturnPeriod_100yr])
-    output_names.extend([# "ReturnPeriod_2yr",
-                         "ReturnPeriod_3yr", "ReturnPeriod_5yr", "ReturnPeriod_10yr",
-                         "ReturnPeriod_25yr", "ReturnPeriod_50yr", "ReturnPeriod_100yr"])
+    output_names.extend([f"ReturnPeriod_{years}yr" for years in return_periods])
 
 if calculate_drought_stats:
-    # Using periods of interests to droughts, calculate standardised metrics of:
-    dps = [x for x in range(len(output_template.columns)) if output_template.columns[x][1] in drought_periods]
-
-    output_drought_duration_mean = copy.deepcopy(output_template.iloc[:, dps])  # (not affected by standardisation)
-    output_drought_months = copy.deepcopy(output_template.iloc[:, dps])  # (not affected by standardisation)
-
-    output_deficit_max = copy.deepcopy(output_template.iloc[:, dps])
-    output_deficit_mean = copy.deepcopy(output_template.iloc[:, dps])
-    output_deficit_total = copy.deepcopy(output_template.iloc[:, dps])
-
-    # Calculate the same [standardised] metrics for only the moderate and major droughts:
-    output_drought_duration_mean_severe = copy.deepcopy(output_template.iloc[:, dps])
-    output_drought_months_severe = copy.deepcopy(output_template.iloc[:, dps])
-    output_deficit_mean_severe = copy.deepcopy(output_template.iloc[:, dps])
-
-    # Add outputs to a list for writing:
-    output_list.extend([output_drought_duration_mean, output_drought_months, output_drought_months_severe,
-                        output_deficit_max, output_deficit_mean, output_deficit_total,
-                        output_drought_duration_mean_severe, output_deficit_mean_severe])
-    output_names.extend(["drought_duration_mean", "drought_months", "drought_months_severe",
-                         "drought_deficit_max", "drought_deficit_mean", "drought_deficit_total",
-                         "drought_duration_mean_severe", "drought_deficit_mean_severe"])
+    # Standardised drought metrics (duration and months are not affected by standardisation), and the same metrics
+    # for only the moderate and major droughts (severe). These are only output for the drought periods:
+    output_names.extend(drought_output_names)
+
+# Settings of the analysis of each river cell, which is shared with the catchment scripts (see analyse_site_flows).
+# The flows of each cell are on its flow direction, so their absolute values are analysed:
+analysis_settings = {"outputs": output_names, "periods": period_table, "rcms": rcm_list,
+                     "drought_periods": drought_periods, "drought_baseline_date": drought_baseline_date,
+                     "threshold_above": threshold_above, "return_periods": return_periods, "count_decimals": 3,
+                     "absolute_flows": True, "skip_zero_flows": False, "days": 36000}
+
+# Settings that affect the results - checkpoints are only used if these (with the periods of their RCM) and the flow
+# output have not changed. The RCMs of the run and their periods are hashed per RCM (see hash_rcm_configs), so adding
+# an RCM to the run keeps the checkpoints of the others:
+analysis_config = {"model": model, "fit_version": fit_version, "periods": period_list,
+                   **{name: value for name, value in analysis_settings.items() if name not in ["periods", "rcms"]}}
+
+# Memory (bytes) used by the analysis of each river cell for each RCM loaded at once (its flows, and their absolute
+# values), for the sizes of the chunks of river cells:
+cell_flow_bytes = 2 * 36000 * 8
+
+# --- CATCHMENT ANALYSIS ------------------
+
+# Create a function for getting the path of the flow output of each RCM for a catchment:
+def get_flow_paths(catchment):
+    """
+    :param catchment: Catchment name.
+    :return: List of the flow output paths (in the order of rcm_list).
+    """
+    return [adapter["flow_path"].format(catchment=catchment, rcm=rcm) for rcm in rcm_list]
+
+
+# Create a function for calculating the statistics of the river cells in a catchment (or a chunk of them). This is run
+# by the worker processes, so it returns the results of the river cells rather than writing them into the result store:
+def analyse_catchment(catchment, river_ids, cell_thresholds, cell_faces, run_rcms):
+    """
+    :param catchment: Catchment to analyse.
+    :param river_ids: Network IDs of the river cells to analyse (all of the catchment's river cells, or a chunk).
+    :param cell_thresholds: Historical flow thresholds of each river cell (cell x threshold_columns).
+    :param cell_faces: Flow direction of each river cell from the direction index, or None to find them from each RCM
+                       output.
+    :param run_rcms: Positions of the RCMs to analyse (the others are left as NaN, e.g. as they are checkpointed).
+    :return: Array of the results of the river cells (output x cell x rcm x period) and a list of the positions of the
+             RCMs that could not be analysed because of an error.
+    """
+
+    river_cells = [int(x) - 1 for x in master_df.loc[river_ids, "River_Cell"]]
+
+    catchment_values = np.full((len(output_names), len(river_ids), len(rcm_list), len(period_list)), np.nan)
+    failed_rcms = []
+
+    # Load the flows of as many RCMs at once as fit in chunk_memory (or prefetch_memory if the river cells are not
+    # chunked). Only the river cells are read, on their flow direction (the face with the largest flow over the first
+    # 1000 days of the historical simulation, or of the RCM run if the cell is not in the direction index), and only
+    # up to the end of the climate data:
+    if chunk_memory is not None:
+        load_size = max(1, chunk_memory // (len(river_cells) * cell_flow_bytes))
+    else:
+        load_size = max(1, prefetch_memory // (len(river_cells) * 36000 * 8))
+    # The next RCMs are read in background threads while these are analysed:
+    rcm_batches = [run_rcms[start:start + load_size] for start in range(0, len(run_rcms), load_size)]
+    batch_flows = stream_site_flows(adapter, catchment, [[rcm_list[r] for r in batch] for batch in rcm_batches],
+                                    ahead=prefetch_files, max_memory=prefetch_memory, cells=river_cells,
+                                    faces=cell_faces, steps=36000)
+    for load_rcms, site_flows in zip(rcm_batches, batch_flows):
+
+        # Calculate the statistics of every river cell of the RCMs at once:
+        catchment_values, load_failed_rcms = analyse_site_flows(catchment, site_flows, load_rcms, cell_thresholds,
+                                                                analysis_settings, fit_cache=fit_cache,
+                                                                values=catchment_values)
+        failed_rcms.extend(load_failed_rcms)
+
+    return catchment_values, failed_rcms
+
+
+# Create a function for getting the path of the historical simulation of a catchment:
+def get_historical_path(catchment):
+    """
+    :param catchment: Catchment name.
+    :return: Path to the h5 output of the historical simulation, or None if the catchment is not in the model tracker.
+    """
+    if int(catchment) not in model_tracker.index:
+        return None
+    path = find_historical_simulation_path(catchment_name=catchment, catchment_tracker=model_tracker)
+    return convex + path + catchment + "/output_" + catchment + "_shegraph.h5"
+
+
+# --- RUN ANALYSIS -----------------------
+
+# The analysis is only run by the main process. The worker processes import the settings and functions above:
+if __name__ == "__main__":
+
+    print("Beginning analysis - if you have an output worksheet open, close it now!")
+
+    if not calculate_flow_stats and not calculate_drought_stats and not calculate_return_periods:
+        print("Check you are making outputs! 'Flow', 'Return Period' and 'Drought' stats are set to False.")
+
+    # Print the name of the output and path as a final check for the user
+    print(output_root_name)
+    print(master_folder_UKCP18)
+    # sleep(2)
+
+    # --- FIND FLOW DIRECTIONS ----------------
+    # The flow direction of each river cell is found once from the start of the historical simulation and saved next
+    # to the river network lookup, so only the flows on that face are read from the outputs. Delete the direction
+    # index to rebuild it (e.g. if the network or the historical simulations change).
+    catchment_faces = {}
+    if use_direction_index:
+        if os.path.exists(direction_index_path):
+            direction_index = pd.read_csv(direction_index_path, dtype={"Network_ID": str}, index_col="Network_ID")
+
+        else:
+            print("Finding the flow direction of the river cells from the historical simulations:")
+            direction_faces = {}
+
+            for catchment in catchment_list:
+                try:  # Try/Exception used to account for missing files.
+                    path = find_historical_simulation_path(catchment_name=catchment, catchment_tracker=model_tracker)
+                    path = convex + path + catchment + "/output_" + catchment + "_shegraph.h5"
+
+                    river_ids = master_df[master_df["Catchment"] == catchment].index
+                    river_cells = [int(x) - 1 for x in master_df[master_df["Catchment"] == catchment]["River_Cell"]]
+
+                    faces = find_flow_directions(path, river_cells, flow_key='  4 ovr_flow')
+                    if faces is not None:
+                        direction_faces.update(zip(river_ids, faces))
+
+                except Exception as e:
+                    print("EXCEPTION - Network ID: ", catchment, ":")
+                    print(e)
+                    continue
 
+            direction_index = pd.DataFrame({"Face": pd.Series(direction_faces, dtype=int)})
+            direction_index.index.name = "Network_ID"
+            # 0=north, 1=east, 2=south (negative), 3=west (negative):
+            direction_index["Sign"] = np.where(direction_index["Face"].isin([2, 3]), -1, 1)
+            direction_index.to_csv(direction_index_path)
 
-# --- CALCULATE FLOW STATISTICS -----------
+        # Catchments with river cells that are not in the index find their flow directions from each output:
+        for catchment in catchment_list:
+            river_ids = master_df[master_df["Catchment"] == catchment].index
+            if river_ids.isin(direction_index.index).all():
+                catchment_faces[catchment] = direction_index.loc[river_ids, "Face"].to_numpy()
+
+    # Start profiling the stages of the run:
+    profile = start_profile(use_cprofile) if profile_path is not None else None
+
+    # --- CALCULATE HISTORICAL STATISTICS -----
+    if calculate_flow_stats:
+        # The thresholds of the catchments without stored thresholds are calculated in parallel and stored. Only the
+        # river cells are read, on their flow direction, and the absolute values of the thresholds are used:
+        print("Finding the historical flow thresholds:")
+        catchment_cells = [master_df[master_df["Catchment"] == catchment] for catchment in catchment_list]
+        master_df[threshold_names] = get_historical_thresholds(
+            threshold_store_path, adapter, catchment_list,
+            [get_historical_path(catchment) for catchment in catchment_list],
+            series=[list(cells.index) for cells in catchment_cells],
+            read_options=[{"cells": [int(x) - 1 for x in cells["River_Cell"]], "faces": catchment_faces.get(catchment),
+                           "flow_key": '  4 ovr_flow'} for catchment, cells in zip(catchment_list, catchment_cells)],
+            absolute_flows=True, skip_zero_flows=False, workers=workers)
+
+    # Create a float array to hold all of the outputs (metric x river cell x rcm x period), on disk at
+    # result_store_path. The results of each chunk are added to this as they are returned and the output tables are
+    # only created (a block of river cells at a time) when they are written:
+    results = create_result_store(output_names, master_df.index, rcm_list, period_list, store_path=result_store_path)
+
+    # Look up the historical thresholds of the river cells of each catchment:
+    if calculate_flow_stats:
+        thresholds = [master_df.loc[master_df["Catchment"] == catchment, threshold_columns].to_numpy(
+            dtype=float, na_value=np.nan) for catchment in catchment_list]
+    else:
+        thresholds = [None] * len(catchment_list)
+
+    faces = [catchment_faces.get(catchment) for catchment in catchment_list]
+
+    # --- CHUNKS ------------------------------
+    # The river cells of each catchment are split into chunks that fit in chunk_memory. Each chunk is analysed,
+    # checkpointed and added to the result store on its own. Catchments that fit in one chunk keep the catchment name
+    # (and so their checkpoints), and the others are named <catchment>-<chunk>:
+    chunk_catchments, chunk_names, chunk_ids, chunk_thresholds, chunk_faces = [], [], [], [], []
+    for c, catchment in enumerate(catchment_list):
+        river_ids = master_df.index[master_df["Catchment"] == catchment]
+        cell_chunks = split_site_series(len(river_ids), cell_flow_bytes, chunk_memory)
+        for k, cells in enumerate(cell_chunks):
+            chunk_catchments.append(catchment)
+            chunk_names.append(catchment if len(cell_chunks) == 1 else f"{catchment}-{k + 1}")
+            chunk_ids.append(river_ids[cells])
+            chunk_thresholds.append(thresholds[c][cells] if thresholds[c] is not None else None)
+            chunk_faces.append(faces[c][cells] if faces[c] is not None else None)
+
+    if len(chunk_names) > len(catchment_list):
+        print(f"The river cells of the {len(catchment_list)} catchments are analysed in {len(chunk_names)} chunks.")
+
+    # --- CHECKPOINTS -------------------------
+    # Results saved by earlier runs are used where the flow output and the analysis settings have not changed:
+    if checkpoint_folder is not None:
+        checkpoints = open_checkpoints(checkpoint_folder)
+        catchment_identities = {catchment: [get_file_identity(path) for path in get_flow_paths(catchment)]
+                                for catchment in catchment_list}
+        flow_identities = [catchment_identities[catchment] for catchment in chunk_catchments]
+        configs = [hash_rcm_configs(period_table, analysis_config, list(chunk_ids[k]), chunk_thresholds[k],
+                                    chunk_faces[k])
+                   for k in range(len(chunk_names))]
+    else:
+        checkpoints, flow_identities, configs = None, None, None
 
-print("Calculating statistics for catchments:")
-test_time = time.time()
-# # Create counter for tracking progress:
-counter = 0
+    run_rcms = find_rcms_to_run(checkpoints, chunk_names, rcm_list, flow_identities, configs)
+    print(f"{sum((len(rcm_list) - len(rcms)) * len(ids) for rcms, ids in zip(run_rcms, chunk_ids))} river cell RCMs "
+          f"are already checkpointed.")
 
-# Run through each of the catchments that we intended to model:
-for catchment in catchment_list:
+    # --- CALCULATE FLOW STATISTICS -----------
 
-    counter += 1
+    print(f"Calculating statistics for catchments ({workers} workers):")
+    fit_cache_start = get_fit_cache_stats(fit_cache) if fit_cache is not None else None
+    test_time = time.time()
+    # Track the progress of the run in river cell RCMs, counting only the RCMs that are not checkpointed:
+    progress = start_progress(len(chunk_names), [len(rcms) * len(ids) for rcms, ids in zip(run_rcms, chunk_ids)],
+                              "river cell RCMs", progress_path, progress_interval, workers,
+                              {"output_root_name": output_root_name, "model": model_tab_name})
 
-    print(f"- {catchment} ({counter}/{len(catchment_list)})")
+    # Run through each chunk of the catchments that we intended to model. Results come back as each chunk finishes, and
+    # are stored by the positions of its river cells, so the outputs are the same as a serial run:
+    chunk_results = run_catchments(analyse_catchment, chunk_catchments, chunk_ids, chunk_thresholds, chunk_faces,
+                                   run_rcms, workers=workers, progress=progress)
 
-    # # Update tracker and print the counter:
-    # counter += 1
-    # if counter % 100 == 0:
-    #     print("--- ", counter, "/698 catchments processed.")
+    for k, (catchment_values, failed_rcms) in chunk_results:
 
-    # Run through each RCM run:
-    print("   rcm:")
+        # Save the newly analysed RCMs and fill in the others from their checkpoints:
+        if checkpoints is not None:
+            catchment_values = merge_checkpoints(checkpoints, chunk_names[k], rcm_list, run_rcms[k], failed_rcms,
+                                                 flow_identities[k], configs[k], catchment_values)
 
-    for r in range(len(rcm_list)):
+        # Add the results of the river cells to the result store as each chunk finishes (writing them to disk), so
+        # that only the results of the chunks being analysed are held in memory:
+        add_site_results(results, [results["sites"][river_id] for river_id in chunk_ids[k]], catchment_values)
 
-        rcm = rcm_list[r]
+    finish_progress(progress)
+    print("TIME: ", round(time.time() - test_time, 1))
+    if fit_cache is not None:
+        report_fit_cache_stats(fit_cache, fit_cache_start)
 
-        print("   - ", rcm)
+    # -----------------------------
+    # WRITE FLOW/DROUGHT STATISTICS
+    # -----------------------------
 
-        # Try to open the flow output:
-        try:
-            flow_path = os.path.join(master_folder_UKCP18 + rcm, str(catchment),
-                                     "output_" + str(catchment) + "_shegraph.h5")
+    print("Writing results.")
+    write_time = time.time()
 
-            if os.path.exists(flow_path):
-                with h5py.File(flow_path, 'r', driver='core') as hf:
-                    f_keys = hf["VARIABLES"].keys()
-                    f_key = [k for k in f_keys if 'ovr_flow' in k]
-                    flows = hf["VARIABLES"][f_key[0]]['value'][:]
+    # Drought outputs only contain the drought periods:
+    write_results(results, results_folder, model_tab_name, file_format=results_format,
+                  metric_periods={name: drought_periods for name in output_names if name.startswith("drought_")})
 
+    print("TIME: ", round(time.time() - write_time, 1))
 
-                # Check that the simulation completed 100 years, else skip calculations:
-                if flows.shape[2] < 36000:
-                    print("Catchment ", catchment, " skipped as incomplete.")
-                    continue
+    # Delete the result store file now that the results are written:
+    if result_store_path is not None:
+        os.remove(result_store_path)
 
-                # Sometimes the model outputs are 100yrs x 365 days instead of 100x360.
-                # This end period has no driving data, so should be trimmed off.
-                flows = flows[:, :, 0:min(36000, flows.shape[2])]
-
-            else:
-                continue
-
-        except Exception as e:
-            print("Exception - Catchment: ", catchment, ":")
-            print("... ", e)
-            continue
-
-        river_ids = master_df[master_df["Catchment"] == catchment].index
-        river_cells = [int(x) - 1 for x in master_df[master_df["Catchment"] == catchment]["River_Cell"]]
-
-        # Run through all the cells:
-        for cell in range(len(river_ids)):
-            river_cell = river_cells[cell]
-            river_id = river_ids[cell]
-
-            # Get the flow direction:
-            direction = np.argmax(abs(np.sum(flows[river_cell, :, 0:1000], axis=1)))
-            # Sayers et al. want the return periods to be negative if they flow those directions so make these negative.
-            # 0=north, 1=east, 2=south (negative), 3=west (negative)
-            sign = -1 if direction in [2, 3] else 1
-
-            # ---------------------------------------------------------
-            # CALCULATE FLOW QUANTILES AND COUNTS OVER/UNDER THRESHOLD:
-            # ---------------------------------------------------------
-
-            flow_df = abs(flows[river_cell, direction, :])
-
-            if calculate_flow_stats or calculate_return_periods:
-
-                # Run through each period:
-                for period in date_indexes.keys():
-
-                    # print(r, rcm, catchment, period)
-
-                    # Get the list of indexes/dates from the period dictionary:
-                    date_index = date_indexes[period]
-
-                    # If it is a warming period, calculate the correct dates for the period (capped at 2080):
-                    if "WL" in period:
-                        date_index = np.arange(360 * (date_index[r] - 1980),
-                                               min(360 * (date_index[r] - 1980 + 30), 360 * 100))
-                    else:
-                        # Translate the period string into a list of indexes for the period:
-                        date_index = np.arange(date_index[0], date_index[1], 1)
-
-                    temp_data = flow_df[date_index]
-
-                    if calculate_flow_stats:
-                        period_years = len(date_index) / 360
-
-                        # Calculate UKCP18 flow quantiles:
-                        output_Q99.loc[river_id, (rcm, period)] = form(np.quantile(temp_data, 0.01))  # Very low flow
-                        output_Q95.loc[river_id, (rcm, period)] = form(np.quantile(temp_data, 0.05))  # Low flow
-                        output_Q50.loc[river_id, (rcm, period)] = form(np.quantile(temp_data, 0.50))  # Median flow
-                        output_Q05.loc[river_id, (rcm, period)] = form(np.quantile(temp_data, 0.95))  # High flow
-                        output_Q01.loc[river_id, (rcm, period)] = form(np.quantile(temp_data, 0.99))  # Very high flow
-
-                        # Calculate counts under thresholds from HISTORICAL MODEL:
-                        output_LTQ99.loc[river_id, (rcm, period)] = form(remove_None(
-                            len(temp_data[temp_data < master_df.loc[river_id, 'hist_q99']])) / period_years)
-                        output_LTQ95.loc[river_id, (rcm, period)] = form(remove_None(
-                            len(temp_data[temp_data < master_df.loc[river_id, 'hist_q95']])) / period_years)
-
-                        # Calculate counts over thresholds from HISTORICAL MODEL:
-                        output_GTQ05.loc[river_id, (rcm, period)] = form(remove_None(
-                            len(temp_data[temp_data > master_df.loc[river_id, 'hist_q05']])) / period_years)
-                        output_GTQ01.loc[river_id, (rcm, period)] = form(remove_None(
-                            len(temp_data[temp_data > master_df.loc[river_id, 'hist_q01']])) / period_years)
-
-                        # # Calculate counts under thresholds from OBSERVED DATASET if there is a value:
-                        # if not np.isnan(master_df.loc[river_id, 'bankfull_flow']):
-                        #     output_GTbankfull.loc[river_id, (rcm, period)] = remove_None(
-                        #         len(temp_data.loc[temp_data > master_df.loc[river_id, 'bankfull_flow']])) / period_years
-
-                    if calculate_return_periods:
-                        # Calculate return periods UKCP18 Data:
-                        try:
-                            return_period_years, return_period_flows = calculate_return_events(
-                                temp_data, return_periods=[3, 5, 10, 25, 50, 100])  # 2
-                            # output_ReturnPeriod_2yr.loc[river_id, (rcm, period)] =   sign*round(return_period_flows[0], 2)
-                            output_ReturnPeriod_3yr.loc[river_id, (rcm, period)] =   sign*round(return_period_flows[0], 2)
-                            output_ReturnPeriod_5yr.loc[river_id, (rcm, period)] =   sign*round(return_period_flows[1], 2)
-                            output_ReturnPeriod_10yr.loc[river_id, (rcm, period)] =  sign*round(return_period_flows[2], 2)
-                            output_ReturnPeriod_25yr.loc[river_id, (rcm, period)] =  sign*round(return_period_flows[3], 2)
-                            output_ReturnPeriod_50yr.loc[river_id, (rcm, period)] =  sign*round(return_period_flows[4], 2)
-                            output_ReturnPeriod_100yr.loc[river_id, (rcm, period)] = sign*round(return_period_flows[5], 2)
-                        except:
-                            # output_ReturnPeriod_2yr.loc[river_id, (rcm, period)] = np.nan
-                            output_ReturnPeriod_3yr.loc[river_id, (rcm, period)] = np.nan
-                            output_ReturnPeriod_5yr.loc[river_id, (rcm, period)] = np.nan
-                            output_ReturnPeriod_10yr.loc[river_id, (rcm, period)] = np.nan
-                            output_ReturnPeriod_25yr.loc[river_id, (rcm, period)] = np.nan
-                            output_ReturnPeriod_50yr.loc[river_id, (rcm, period)] = np.nan
-                            output_ReturnPeriod_100yr.loc[river_id, (rcm, period)] = np.nan
-
-
-            # --------------------
-            # CEH Drought metrics:
-            # Commented out as this needs updating to fix the issue of overly long droughts extending
-            # outside of their period. Update this using the catchment level code.
-            # --------------------
-
-            # if calculate_drought_stats:
-            #
-            #     # >>> STEP 1 & 3 <<<
-            #     # (Create long term standardised mean monthly flows)
-            #
-            #     # --- Aggregate to monthly:
-            #     monthly_flow = aggregate_to_monthly(flow_df[:36000])  # The Climate data length
-            #
-            #     baseline_start = int(date_indexes[drought_baseline_date][0] / 30)
-            #     baseline_stop = int(date_indexes[drought_baseline_date][1] / 30)
-            #
-            #     # Calculate the mean monthly flow (i.e. Jan-Dec) for the baseline period:
-            #     mean_monthly_flow_baseline, mean_monthly_flow_baseline_std = mean_baseline_flow(
-            #         monthly_flow[baseline_start:baseline_stop])
-            #
-            #     # Calculate flow anomaly by removing mean monthly baseline flow from the full record:
-            #     monthly_flow_anomaly = calculate_flow_anomaly(monthly_flow, mean_monthly_flow_baseline)
-            #
-            #     # Normalise the anomaly by dividing by the mean month's standard deviation:
-            #     monthly_flow_anomaly_normalised = normalise_anomaly(monthly_flow_anomaly,
-            #                                                         mean_monthly_flow_baseline_std)
-            #
-            #     # Create list of flow deficits (i.e. negative normalised anomalies):
-            #     monthly_flow_deficit_stnd = [1 if m < 0 else 0 for m in monthly_flow_anomaly_normalised]
-            #
-            #     # >>> STEP 2 <<<
-            #     # (Calculate duration, intensity and severity of deficit of standardised timeseries)
-            #
-            #     # --- Create data table to hold all the drought data ---
-            #
-            #     # Start with columns for lengths for droughts and non-droughts:
-            #     drought_count = [(i, len(list(g))) for i, g in groupby(monthly_flow_deficit_stnd)]
-            #     master_drought_table = pd.DataFrame(drought_count, columns=['drought', 'length'])
-            #
-            #     # Add a column with indexes of months when each drought/non-drought ends:
-            #     master_drought_table["month"] = master_drought_table["length"].cumsum()
-            #
-            #     # Add columns with indexes for using with Python sub-setting:
-            #     master_drought_table["start_index"] = master_drought_table["month"] - master_drought_table["length"]
-            #     master_drought_table["end_index"] = master_drought_table["start_index"] + master_drought_table["length"]
-            #
-            #     # Subset the dataset to only drought periods:
-            #     master_drought_table = master_drought_table[master_drought_table["drought"] == 1]
-            #     master_drought_table = master_drought_table.reset_index()
-            #
-            #     # Add columns for intensity and severity:
-            #     master_drought_table[
-            #         ["intensity_total", "intensity_mean", "severity", "standardised_severity"]] = np.nan
-            #
-            #     # Run through each period for the catchment and calculate statistics:
-            #     for period in drought_periods:
-            #
-            #         # Get indexes from the date_index dictionary:
-            #         date_index = date_indexes[period]
-            #
-            #         # If it is a warming period, calculate the correct start/end months for the period.
-            #         # Capped at 2080, converting from days to months:
-            #         if "WL" in period:
-            #             date_index = [360 / 30 * (date_index[r] - 1980),
-            #                           min(360 / 30 * (date_index[r] - 1980 + 30), 12 * 100)]
-            #         else:
-            #             # Translate the period string into a start and end month for the period:
-            #             date_index = [date_index[0] / 30, date_index[1] / 30]
-            #
-            #         # IMPORTANT: some of the droughts will cross over between periods. This creates terrible results.
-            #         # We need to crop all droughts at their periods, so we will take a subset of the
-            #         # data (only containing data for the period), edit the start and end droughts, if needed,
-            #         # and then do analysis on that.
-            #
-            #         # Subset 1. Use filter rows inclusive of those that overlap the thresholds (d_start<p_end + d_end>p_start):
-            #         period_drought_table = master_drought_table[
-            #             (master_drought_table['start_index'] <= date_index[1]) &
-            #             (master_drought_table['end_index'] >= date_index[0])
-            #             ].copy()
-            #
-            #         # Subset 2. Edit the start of the first drought and the end of the last:
-            #         period_drought_table.at[period_drought_table.index[0], 'start_index'] = max(
-            #             [period_drought_table['start_index'].iloc[0], date_index[0]])
-            #         period_drought_table.at[period_drought_table.index[-1], 'end_index'] = min(
-            #             [period_drought_table['end_index'].iloc[-1], date_index[1]])
-            #
-            #         # Subset 3. Calculate new drought durations for the edited rows.
-            #         period_drought_table.at[period_drought_table.index[0], 'length'] = \
-            #         period_drought_table['end_index'].iloc[0] - period_drought_table['start_index'].iloc[0]
-            #         period_drought_table.at[period_drought_table.index[-1], 'length'] = \
-            #         period_drought_table['end_index'].iloc[-1] - period_drought_table['start_index'].iloc[-1]
-            #
-            #         # If step 3 means that there is an initial drought with 0 length, remove this:
-            #         period_drought_table = period_drought_table[period_drought_table['length'] != 0]
-            #
-            #         # --- Calculate the intensities & severities ---
-            #
-            #         # Run through each drought instance:
-            #         for row in period_drought_table.index:
-            #
-            #             # Create index for monthly flow time series based on the drought period:
-            #             # subset the monthly flow time series based on the drought period:
-            #             drought_instance = monthly_flow_anomaly_normalised[
-            #                                int(period_drought_table.loc[row, "start_index"]):
-            #                                int(period_drought_table.loc[row, "end_index"])]
-            #
-            #             # Calculate intensity (total deficit) and add this to the table:
-            #             period_drought_table.loc[row, "intensity_total"] = -drought_instance.sum()
-            #
-            #             # Calculate mean intensity (average deficit) and add this to the table:
-            #             period_drought_table.loc[row, "intensity_mean"] = -drought_instance.mean()
-            #
-            #             # Calculate Severity (mean intensity x duration):
-            #             # Note - I think that this is the same as intensity total, but that that is correct.
-            #             period_drought_table.loc[row, "severity"] = period_drought_table.loc[row, "intensity_mean"] * \
-            #                                                         period_drought_table.loc[
-            #                                                             row, "length"]
-            #
-            #             # Calculate Standardised Severity:
-            #             if period_drought_table.loc[row, "severity"] < 4:
-            #                 period_drought_table.loc[row, "standardised_severity"] = 0
-            #             if period_drought_table.loc[row, "severity"] >= 4:
-            #                 period_drought_table.loc[row, "standardised_severity"] = 1
-            #             if period_drought_table.loc[row, "severity"] >= 8:
-            #                 period_drought_table.loc[row, "standardised_severity"] = 2
-            #
-            #         # >>> STEP 4 & 5 <<<
-            #         # (Statistics; for droughts and severe droughts [Severity > 4 m3/s])
-            #
-            #         # --- Calculate Drought Statistics for Periods: ---
-            #
-            #         # # Run through each period for the catchment and calculate statistics:
-            #         period_drought_table_severe = period_drought_table[period_drought_table.standardised_severity > 0]
-            #
-            #         # Add the duration to the output dataset:
-            #         output_drought_duration_mean.loc[catchment, (rcm, period)] = round(
-            #             period_drought_table["length"].mean(skipna=True), 3)
-            #         output_drought_duration_mean_severe.loc[catchment, (rcm, period)] = round(
-            #             period_drought_table_severe["length"].mean(skipna=True), 3)
-            #
-            #         output_drought_months.loc[catchment, (rcm, period)] = round(
-            #             period_drought_table["length"].sum(skipna=True), 3)
-            #         output_drought_months_severe.loc[catchment, (rcm, period)] = round(
-            #             period_drought_table_severe["length"].sum(skipna=True), 3)
-            #
-            #         # Add intensity statistics to output dataset:
-            #         output_deficit_max.loc[catchment, (rcm, period)] = round(
-            #             period_drought_table["intensity_total"].max(skipna=True), 3)
-            #         output_deficit_mean.loc[catchment, (rcm, period)] = round(
-            #             period_drought_table["intensity_mean"].mean(skipna=True), 3)
-            #         output_deficit_total.loc[catchment, (rcm, period)] = round(
-            #             period_drought_table["intensity_total"].sum(skipna=True), 3)
-            #         output_deficit_mean_severe.loc[catchment, (rcm, period)] = round(
-            #             period_drought_table_severe["intensity_mean"].mean(skipna=True), 3)
-
-    # ---------------------------------------------
-    # Write partially Completed documents as backup
-    # ---------------------------------------------
-
-    # # Write evey 50 catchments:
-    # if counter % 50 == 0:
-    #     print("Writing PARTIAL Excel documents.")
-
-    #     for i in range(len(output_list)):
-    #         output_path = analysis_path + "Outputs/Partial_Backups/Partial_" + \
-    #                       output_root_name + "_RiverNet_" + output_names[i] + ".xlsx"
-    #         with pd.ExcelWriter(output_path) as writer:
-    #             output_list[i].to_excel(writer, sheet_name='SHETRAN-UK Autocalibrated')
-
-print("TIME: ", round(time.time() - test_time, 1))
-
-# -----------------------------
-# WRITE FLOW/DROUGHT STATISTICS
-# -----------------------------
-
-print("Writing Excel documents.")
-
-# for i in range(len(output_list)):
-#     output_path = analysis_path + "Outputs/" + output_root_name + "_RiverNet_" + output_names[i] + ".xlsx"
-#     with pd.ExcelWriter(output_path) as writer:
-#         output_list[i].to_excel(writer, sheet_name='SHETRAN-UK Autocalibrated')
-
-for i in range(len(output_list)):
-    output_path = f"{analysis_path}Outputs/02_River_Network/{output_root_name}_RiverNet_{output_names[i]}.xlsx"
-
-    # Crop down the Excel documents as these are very large:
-    if reduce_export:
-        output_list[i].dropna(inplace=True)
-
-    # Check whether to append or write new file:
-    if os.path.exists(output_path):
-        # Append data. This will overwrite sheets with the same name:
-        with pd.ExcelWriter(output_path, mode='a', if_sheet_exists='replace') as writer:
-            output_list[i].to_excel(writer, sheet_name=model_tab_name)
-    else:
-        # Write data to new workbook:
-        with pd.ExcelWriter(output_path, mode='w') as writer:
-            output_list[i].to_excel(writer, sheet_name=model_tab_name)
+    # Write the profile of the run:
+    if profile is not None:
+        write_profile(profile, profile_path, {"output_root_name": output_root_name, "model": model_tab_name,
+                                              "workers": workers, "catchments": len(catchment_list),
+                                              "rcms": len(rcm_list)})
 
+    print('Run "Hydrological Flow and Drought Analysis - Export Excel.py" to write the Excel workbooks.')
@@ -11,7 +11,7 @@ import h5py
 # Floods
 import copy
 from scipy.stats import genextreme
-from lmoments3 import distr
+from scipy.special import gammaln
 import warnings  # Suppresses warnings for return period, believed to be scipi bug.
 
 # Droughts
@@ -20,15 +20,533 @@ from itertools import groupby
 # For testing speed:
 import time
 
+# For checkpoints and the return period fit cache:
+import json
+import hashlib
+import sqlite3
+
+# For running the scenarios of a batch:
+import runpy
+
+# For profiling the analysis:
+import cProfile
+import pstats
+
+# For the memory use in the progress of a run (optional - the memory is not reported without either):
+try:
+    import psutil
+except ImportError:
+    psutil = None
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# For reading and running catchments in parallel:
+from collections import deque
+from functools import partial
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+
 # --- FUNCTIONS ---------------------------
 
+# Create a function for building the table of the start and end of each period for each RCM:
+def create_period_table(fixed_periods, rcms, warming_levels_path=None, warming_levels=(), days=36000,
+                        first_year=1980):
+    """
+    The table is built once for a run, so that the analysis of each catchment only takes (basic) slices of its flows
+    from it. Warming level periods start at the start of the year that each RCM reaches the warming level (from
+    Warming_levels_stripped.csv) and are 30 years long, capped at the end of the climate data (2080).
+    :param fixed_periods: Dictionary of the periods that are the same for every RCM - {name: [start day, end day]}.
+                          Dates start 01/12/1980 and there are 360 days in a climate year.
+    :param rcms: List of the RCMs, e.g. ["01", "04"] (these are "run01", "run04" in the warming level csv).
+    :param warming_levels_path: Path to the csv of the warming level start years of each RCM.
+    :param warming_levels: List of the warming level periods to add, e.g. ["WL1.5", "WL2.0"] (read from the
+                           "1.5 start" and "2.0 start" columns of the csv).
+    :param days: Length of the climate data.
+    :param first_year: Year that the climate data starts.
+    :return: Dictionary of the period names ("periods"), the start and end day ("days") and month ("months") of each
+             period (rcm x period x 2), the length of each period in years ("years", rcm x period) and the factors that
+             normalise totals over each period to 30 years ("thirty_year_factors", rcm x period).
+    """
+    periods = list(fixed_periods.keys()) + list(warming_levels)
+    period_days = np.zeros((len(rcms), len(periods), 2), dtype=int)
+    period_days[:, :len(fixed_periods)] = [fixed_periods[period] for period in fixed_periods]
+
+    if len(warming_levels) > 0:
+        start_years = pd.read_csv(warming_levels_path, index_col=0, encoding="utf-8-sig")
+        start_years.index = start_years.index.str.strip().str.replace("run", "")
+        for p, period in enumerate(warming_levels, start=len(fixed_periods)):
+            column = period.replace("WL", "") + " start"
+            missing = [rcm for rcm in rcms if rcm not in start_years.index]
+            if column not in start_years.columns or len(missing) > 0:
+                raise ValueError(f"The start years of {period} for RCMs {missing or rcms} are not in "
+                                 f"{warming_levels_path}")
+            starts = 360 * (start_years.loc[rcms, column].to_numpy(dtype=int) - first_year)
+            period_days[:, p, 0] = starts
+            period_days[:, p, 1] = np.minimum(starts + 360 * 30, days)
+
+    lengths = period_days[..., 1] - period_days[..., 0]
+    if (lengths <= 0).any() or (period_days < 0).any() or (period_days > days).any():
+        raise ValueError("Periods must start and end within the climate data, e.g. a warming level that starts after "
+                         f"{first_year + days // 360}: {periods}")
+
+    return {"periods": periods, "days": period_days, "months": period_days // 30, "years": lengths / 360,
+            "thirty_year_factors": 360 / (lengths // 30)}
+
+
+# Create a function for calculating the annual maximum and minimum flows:
+def calculate_annual_extremes(discharge, days_per_year=360, minimums=True):
+    """
+    :param discharge: Array of daily discharges, either a single series or a 2D array (series x days).
+    :param days_per_year: Length of the climate year. Any incomplete final year is ignored.
+    :param minimums: Set to False to only calculate the annual maximums (e.g. for the return periods), saving a pass
+                     over the flows.
+    :return: Arrays of the annual maximums and annual minimums (... x years). The minimums are None if not calculated.
+    """
+    discharge = np.asarray(discharge, dtype=float)
+    years = discharge.shape[-1] // days_per_year
+
+    # Reshape into years and reduce each year in one go:
+    annual_flows = discharge[..., :years * days_per_year].reshape(discharge.shape[:-1] + (years, days_per_year))
+
+    return annual_flows.max(axis=-1), annual_flows.min(axis=-1) if minimums else None
+
+
+# Create a function for sorting the flows of each period into a single block:
+def sort_period_flows(flow, period_days):
+    """
+    :param flow: Array of daily flows, either a single series or a 2D array (series x days).
+    :param period_days: List of [start day, end day] for each period.
+    :return: The sorted flows of each period (... x periods x days). Periods shorter than the longest period are
+             padded with NaN, which is sorted to the end of each row.
+    """
+    flow = np.asarray(flow, dtype=float)
+    longest = max(stop - start for start, stop in period_days)
+
+    period_flows = np.full(flow.shape[:-1] + (len(period_days), longest), np.nan)
+    for p, (start, stop) in enumerate(period_days):
+        period_flows[..., p, :stop - start] = flow[..., start:stop]
+
+    period_flows.sort(axis=-1)
+    return period_flows
+
+
+# Create a function for calculating several flow quantiles from a single sort:
+def calculate_quantiles(flows, quantiles, is_sorted=False):
+    """
+    Calculates the quantiles of each row using the same linear interpolation as np.quantile / pandas
+    Series.quantile, but from one sort of each row rather than one partition per quantile.
+    :param flows: Array of flows (... x days), e.g. periods x days or cells x days. NaN values are ignored, so rows
+                  of different lengths can be padded with NaN.
+    :param quantiles: List of the quantiles to calculate (0-1).
+    :param is_sorted: Set to True if the rows are already sorted (e.g. from sort_period_flows).
+    :return: Array of the quantiles of each row (... x quantiles). Rows without any values are NaN.
+    """
+    flows = np.asarray(flows, dtype=float)
+    if not is_sorted:
+        flows = np.sort(flows, axis=-1)
+
+    # Count the values in each row and find where each quantile sits in the sorted row:
+    n = (~np.isnan(flows)).sum(axis=-1)[..., None]
+    virtual_indexes = (n - 1) * np.asarray(quantiles, dtype=float)
+    previous_indexes = np.floor(virtual_indexes)
+    above_bounds = virtual_indexes >= n - 1
+    next_indexes = np.where(above_bounds, n - 1, previous_indexes + 1).clip(0).astype(np.intp)
+    previous_indexes = np.where(above_bounds, n - 1, previous_indexes).clip(0).astype(np.intp)
+    gamma = virtual_indexes - np.floor(virtual_indexes)
+
+    previous = np.take_along_axis(flows, previous_indexes, axis=-1)
+    following = np.take_along_axis(flows, next_indexes, axis=-1)
+
+    # Linear interpolation, matching numpy's (which interpolates back from the upper value when gamma >= 0.5):
+    difference = following - previous
+    quantile_values = np.where(gamma >= 0.5, following - difference * (1 - gamma), previous + difference * gamma)
+
+    return np.where(n > 0, quantile_values, np.nan)
+
+
+# Create a function for counting the flows under/over several thresholds:
+def count_threshold_exceedances(sorted_flows, thresholds, above):
+    """
+    Counts the days under or over each threshold using binary searches of the sorted flows, so any number of
+    thresholds can be counted without re-scanning the flows.
+    :param sorted_flows: Sorted flows (... x days), e.g. from sort_period_flows. NaN padding at the end of each row
+                         is ignored.
+    :param thresholds: Thresholds to count against (k). These can also be given per row as an array that broadcasts
+                       against the leading dimensions of sorted_flows (... x k), e.g. a column of a per-site
+                       threshold table.
+    :param above: List of booleans (k). True counts the days greater than the threshold, False the days less than it.
+    :return: Array of counts (... x k). Missing (NaN) thresholds have a count of 0.
+    """
+    sorted_flows = np.asarray(sorted_flows, dtype=float)
+    above = np.asarray(above, dtype=bool)
+    thresholds = np.broadcast_to(np.asarray(thresholds, dtype=float), sorted_flows.shape[:-1] + above.shape)
+
+    rows = sorted_flows.reshape(-1, sorted_flows.shape[-1])
+    row_thresholds = thresholds.reshape(-1, len(above))
+    counts = np.zeros(row_thresholds.shape)
+
+    for row in range(rows.shape[0]):
+        # Remove NaN padding (this is at the end of the sorted row):
+        values = rows[row, :np.searchsorted(rows[row], np.nan)] if np.isnan(rows[row, -1]) else rows[row]
+
+        # Days less than the threshold / days greater than the threshold:
+        less_than = np.searchsorted(values, row_thresholds[row], side='left')
+        greater_than = len(values) - np.searchsorted(values, row_thresholds[row], side='right')
+        counts[row] = np.where(above, greater_than, less_than)
+
+    counts[np.isnan(row_thresholds)] = 0
+
+    return counts.reshape(thresholds.shape)
+
+
+# Create a function for fitting GEV distributions to many series of annual maximums at once:
+def fit_gev_lmoments(annual_maximums):
+    """
+    Vectorised version of Lmoments3's distr.gev.lmom_fit, using Hosking's estimators (Hosking, 1997, PELGEV).
+    Sample probability weighted moments are calculated for every series together and converted to L-moments,
+    which are then converted to GEV parameters using Hosking's rational approximations (with Newton-Raphson
+    iteration for very negative L-skewness, as in Lmoments3).
+    :param annual_maximums: 2D array of annual maximums (series x years). NaN values are ignored, so series of
+                            different lengths can be fitted together by padding them with NaN.
+    :return: Masked arrays of the shape, loc and scale parameters (one value per series). Series that cannot be
+             fitted (fewer than 3 values, no variation - e.g. all 0 flows - or invalid L-moments) are masked.
+    """
+
+    # Constants from Hosking's PELGEV routine:
+    small = 1e-5
+    eps = 1e-6
+    max_iterations = 20
+    euler = 0.57721566
+    dl2 = np.log(2)
+    dl3 = np.log(3)
+    a0, a1, a2, a3, a4 = 0.28377530, -1.21096399, -2.50728214, -1.13455566, -0.07138022
+    b1, b2, b3 = 2.06189696, 1.31912239, 0.25077104
+    c1, c2, c3 = 1.59921491, -0.48832213, 0.01573152
+    d1, d2 = -0.64363929, 0.08985247
+
+    # Sort each series (NaN padding is sorted to the end of each row) and count the values in each:
+    x = np.sort(np.atleast_2d(np.asarray(annual_maximums, dtype=float)), axis=1)
+    valid = ~np.isnan(x)
+    x = np.where(valid, x, 0)
+    n = valid.sum(axis=1)
+
+    # Calculate the probability weighted moments (b0, b1, b2) of each series:
+    with np.errstate(divide='ignore', invalid='ignore'):
+        i = np.arange(x.shape[1])
+        w1 = i / (n[:, None] - 1)
+        w2 = w1 * (i - 1) / (n[:, None] - 2)
+        pwm_0 = x.sum(axis=1) / n
+        pwm_1 = (w1 * x).sum(axis=1) / n
+        pwm_2 = (w2 * x).sum(axis=1) / n
+
+        # Convert these to L-moments and L-skewness:
+        l1 = pwm_0
+        l2 = 2 * pwm_1 - pwm_0
+        t3 = (6 * pwm_2 - 6 * pwm_1 + pwm_0) / l2
+
+    # Series that cannot be fitted:
+    failed = (n < 3) | ~(l2 > 0) | ~(np.abs(t3) < 1)
+    t3 = np.where(failed, 0, t3)
+
+    # Negative L-skewness - rational approximation:
+    g_negative = (a0 + t3 * (a1 + t3 * (a2 + t3 * (a3 + t3 * a4)))) / (1 + t3 * (b1 + t3 * (b2 + t3 * b3)))
+
+    # Positive L-skewness - rational approximation:
+    z = 1 - t3
+    g_positive = (-1 + z * (c1 + z * (c2 + z * c3))) / (1 + z * (d1 + z * d2))
+
+    g = np.where(t3 <= 0, g_negative, g_positive)
+
+    # Very negative L-skewness (<-0.8) - refine the estimate using Newton-Raphson iteration:
+    iterate = ~failed & (t3 < -0.8)
+    if iterate.any():
+        g = np.where(iterate & (t3 <= -0.97), 1 - np.log(1 + t3) / dl2, g)
+        t0 = (t3 + 3) * 0.5
+        for _ in range(1, max_iterations):
+            x2 = 2 ** -g
+            x3 = 3 ** -g
+            xx2 = 1 - x2
+            xx3 = 1 - x3
+            deriv = (xx2 * x3 * dl3 - xx3 * x2 * dl2) / (xx2 ** 2)
+            g_old = g
+            g = np.where(iterate, g - (xx3 / xx2 - t0) / deriv, g)
+            iterate = iterate & ~(np.abs(g - g_old) <= eps * g)
+            if not iterate.any():
+                break
+        # Any series that have not converged cannot be fitted:
+        failed = failed | iterate
+
+    # Convert the shape parameter into loc and scale. Shapes close to 0 use the Gumbel limit:
+    gumbel = (t3 > 0) & (np.abs(g) < small)
+    g = np.where(gumbel | failed, 1, g)
+    gam = np.exp(gammaln(1 + g))
+    scale = l2 * g / (gam * (1 - 2 ** -g))
+    loc = l1 - scale * (1 - gam) / g
+
+    shape = np.where(gumbel, 0, g)
+    scale = np.where(gumbel, l2 / dl2, scale)
+    loc = np.where(gumbel, l1 - euler * l2 / dl2, loc)
+
+    return (np.ma.masked_array(shape, mask=failed),
+            np.ma.masked_array(loc, mask=failed),
+            np.ma.masked_array(scale, mask=failed))
+
+
+# Create a function for fitting GEV distributions to many series of annual maximums with either method:
+def _fit_gev(annual_maximums, method):
+    """
+    :param annual_maximums: 2D array of annual maximums (series x years), padded with NaN.
+    :param method: "lmo" - Lmoments (fit_gev_lmoments); "mle" - maximum likelihood (scipy's genextreme.fit).
+    :return: Masked arrays of the shape, loc and scale parameters. Series that cannot be fitted are masked.
+    """
+    if method == "lmo":
+        start = time.perf_counter()
+        shape, loc, scale = fit_gev_lmoments(annual_maximums)
+        profile_stage(None, fits=len(annual_maximums), fit_failures=int(np.ma.getmaskarray(shape).sum()),
+                      fit_seconds=time.perf_counter() - start)
+        return shape, loc, scale
+
+    start = time.perf_counter()
+    parameters = np.zeros((len(annual_maximums), 3))
+    failed = np.zeros(len(annual_maximums), dtype=bool)
+    for i, series in enumerate(annual_maximums):
+        try:
+            # Suppress a warning from the fit function that is understood to be a bug:
+            # RuntimeWarning: invalid value encountered in subtract -pex2+logpex2-logex2
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)
+                parameters[i] = genextreme.fit(series[~np.isnan(series)])
+        except Exception:
+            failed[i] = True
+    failed |= ~np.isfinite(parameters).all(axis=1)
+    profile_stage(None, fits=len(annual_maximums), fit_failures=int(failed.sum()),
+                  fit_seconds=time.perf_counter() - start)
+
+    return tuple(np.ma.masked_array(parameters[:, j], mask=failed) for j in range(3))
+
+
+# Version of the GEV fitting (fit_gev_lmoments and _fit_gev). Increase this if the fitting changes, so that the fits
+# in the fit cache are not reused (they are removed as the least recently used):
+fit_version = 1
+
+
+# Create a function for opening a cache of fitted GEV distributions (this is created if it does not exist):
+def open_fit_cache(cache_path, max_entries=500000):
+    """
+    The cache is a SQLite database of the GEV parameters fitted to each series of annual maximums, keyed on a hash of
+    the annual maximums, the fitting method and fit_version, so any return periods can be calculated from a cached
+    fit. Each process opens its own connection when it first uses the cache, so it can be shared by the worker
+    processes (keep it on a local disk - SQLite locking is not reliable on network drives). When the cache holds more
+    than max_entries fits, the least recently used fits are removed.
+    :param cache_path: Path to the cache database.
+    :param max_entries: Most fits to keep.
+    :return: Dictionary of the cache settings and the connection of this process.
+    """
+    if os.path.dirname(cache_path):
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    return {"path": cache_path, "max_entries": max_entries, "connection": None, "pid": None, "inserted": 0}
+
+
+# Create a function for getting the connection to the fit cache for this process:
+def _fit_cache_connection(fit_cache):
+    """
+    :param fit_cache: Cache from open_fit_cache.
+    :return: SQLite connection (a new one if the cache was opened by another process, e.g. before a fork).
+    """
+    if fit_cache["pid"] != os.getpid():
+        connection = sqlite3.connect(fit_cache["path"], timeout=120)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS fits (key TEXT PRIMARY KEY, shape REAL, loc REAL, scale REAL, "
+                           "failed INTEGER, last_used REAL)")
+        connection.execute("CREATE INDEX IF NOT EXISTS fits_last_used ON fits (last_used)")
+        connection.execute("CREATE TABLE IF NOT EXISTS stats (id INTEGER PRIMARY KEY, hits INTEGER, misses INTEGER, "
+                           "fit_seconds REAL, cache_seconds REAL)")
+        connection.execute("INSERT OR IGNORE INTO stats VALUES (0, 0, 0, 0, 0)")
+        connection.commit()
+        fit_cache.update(connection=connection, pid=os.getpid(), inserted=0)
+    return fit_cache["connection"]
+
+
+# Create a function for fitting GEV distributions to many series of annual maximums, reusing any cached fits:
+def fit_gev_cached(annual_maximums, method="lmo", fit_cache=None):
+    """
+    :param annual_maximums: 2D array of annual maximums (series x years). Series can be padded with NaN.
+    :param method: "lmo" - Lmoments (fit_gev_lmoments); "mle" - maximum likelihood (scipy's genextreme.fit).
+    :param fit_cache: Cache from open_fit_cache, or None to fit every series.
+    :return: Masked arrays of the shape, loc and scale parameters (one value per series). Series that cannot be
+             fitted are masked.
+    """
+    annual_maximums = np.atleast_2d(np.asarray(annual_maximums, dtype=float))
+    if fit_cache is None:
+        return _fit_gev(annual_maximums, method)
+
+    start = time.perf_counter()
+    connection = _fit_cache_connection(fit_cache)
+
+    # Look up the fits of the series (the NaN padding is not part of the key):
+    version = f"{method}:{fit_version}".encode()
+    keys = [hashlib.sha1(version + series[~np.isnan(series)].tobytes()).hexdigest() for series in annual_maximums]
+    unique_keys = list(dict.fromkeys(keys))
+    fits = {}
+    for i in range(0, len(unique_keys), 500):
+        chunk = unique_keys[i:i + 500]
+        rows = connection.execute(f"SELECT key, shape, loc, scale, failed FROM fits WHERE key IN "
+                                  f"({','.join('?' * len(chunk))})", chunk)
+        fits.update((row[0], row[1:]) for row in rows)
+    hit_keys = list(fits)
+    hits = sum(key in fits for key in keys)
+    profile_stage(None, cached_fits=hits)
+
+    # Fit the series that are not in the cache:
+    new_rows = {}
+    for i, key in enumerate(keys):
+        if key not in fits and key not in new_rows:
+            new_rows[key] = i
+    fit_seconds = 0
+    if new_rows:
+        fit_start = time.perf_counter()
+        shape, loc, scale = _fit_gev(annual_maximums[list(new_rows.values())], method)
+        fit_seconds = time.perf_counter() - fit_start
+        failed = np.ma.getmaskarray(shape)
+        for i, key in enumerate(new_rows):
+            # SQLite cannot store NaN, so failed fits are stored as 0s and flagged:
+            fits[key] = (0.0, 0.0, 0.0, 1) if failed[i] else (float(shape[i]), float(loc[i]), float(scale[i]), 0)
+
+    # Save the new fits, mark the hits as used and update the statistics:
+    now = time.time()
+    with connection:
+        connection.executemany("INSERT OR REPLACE INTO fits VALUES (?, ?, ?, ?, ?, ?)",
+                               [(key, *fits[key], now) for key in new_rows])
+        for i in range(0, len(hit_keys), 500):
+            chunk = hit_keys[i:i + 500]
+            connection.execute(f"UPDATE fits SET last_used = ? WHERE key IN ({','.join('?' * len(chunk))})",
+                               [now] + chunk)
+        connection.execute("UPDATE stats SET hits = hits + ?, misses = misses + ?, fit_seconds = fit_seconds + ?, "
+                           "cache_seconds = cache_seconds + ? WHERE id = 0",
+                           (hits, len(keys) - hits, fit_seconds, time.perf_counter() - start - fit_seconds))
+
+    # Remove the least recently used fits once the cache is full (this is checked every so often, as it is slow):
+    fit_cache["inserted"] += len(new_rows)
+    if fit_cache["inserted"] >= min(1000, max(1, fit_cache["max_entries"] // 100)):
+        fit_cache["inserted"] = 0
+        with connection:
+            count = connection.execute("SELECT COUNT(*) FROM fits").fetchone()[0]
+            if count > fit_cache["max_entries"]:
+                connection.execute("DELETE FROM fits WHERE key IN (SELECT key FROM fits ORDER BY last_used LIMIT ?)",
+                                   (count - fit_cache["max_entries"],))
+
+    parameters = np.array([fits[key] for key in keys], dtype=float).reshape(-1, 4)
+    failed = parameters[:, 3] == 1
+    return tuple(np.ma.masked_array(parameters[:, j], mask=failed) for j in range(3))
+
+
+# Create a function for getting the total hits, misses and times of the fit cache:
+def get_fit_cache_stats(fit_cache):
+    """
+    :param fit_cache: Cache from open_fit_cache.
+    :return: Dictionary of the number of hits and misses, and the time spent fitting and using the cache (seconds),
+             over every run that has used the cache.
+    """
+    row = _fit_cache_connection(fit_cache).execute(
+        "SELECT hits, misses, fit_seconds, cache_seconds FROM stats WHERE id = 0").fetchone()
+    return dict(zip(["hits", "misses", "fit_seconds", "cache_seconds"], row))
+
+
+# Create a function for printing how much the fit cache was used in a run:
+def report_fit_cache_stats(fit_cache, start_stats):
+    """
+    The time saved is estimated from the average time of the fits that were not in the cache.
+    :param fit_cache: Cache from open_fit_cache.
+    :param start_stats: Statistics from get_fit_cache_stats at the start of the run.
+    """
+    stats = get_fit_cache_stats(fit_cache)
+    run = {name: stats[name] - start_stats[name] for name in stats}
+    lookups = run["hits"] + run["misses"]
+    if lookups == 0:
+        return
+    fit_time = stats["fit_seconds"] / stats["misses"] if stats["misses"] else 0
+    print(f"Return period fit cache: {run['hits']}/{lookups} fits reused ({100 * run['hits'] / lookups:.1f}%), "
+          f"saving ~{run['hits'] * fit_time:.1f}s of fitting (the cache took {run['cache_seconds']:.1f}s).")
+
+
+# Create a function for calculating flow of return period events for many series at once:
+def calculate_return_events_batch(annual_maximums, return_periods=None, fit_cache=None):
+    """
+    :param annual_maximums: 2D array of annual maximums (series x years). Series can be padded with NaN.
+    :param return_periods: List of years that you want return flows calculating for.
+    :param fit_cache: Cache of fitted distributions from open_fit_cache (None to fit every series).
+    :return: The return period years and a masked array of flows (series x return periods). Series that could
+             not be fitted (e.g. many 0 values) are masked rather than raising an error.
+    """
+
+    # Set default return periods to output:
+    if return_periods is None:
+        return_periods = [3, 5, 10, 25, 50, 100]
+    return_periods = np.array(return_periods)
+
+    # Fit the GEV distribution to every series:
+    shape, loc, scale = fit_gev_cached(annual_maximums, method="lmo", fit_cache=fit_cache)
+
+    # Compute the return levels for several return periods (masked series are given dummy parameters):
+    start = time.perf_counter()
+    return_period_discharges = genextreme.isf(1 / return_periods[None, :],
+                                              shape.filled(0)[:, None],
+                                              loc.filled(0)[:, None],
+                                              scale.filled(1)[:, None])
+    profile_stage(None, isf_seconds=time.perf_counter() - start)
+    return_period_discharges = np.round(return_period_discharges, 2)
+
+    mask = np.repeat(np.ma.getmaskarray(shape)[:, None], len(return_periods), axis=1)
+
+    return return_periods, np.ma.masked_array(return_period_discharges, mask=mask)
+
+
+# Create a function for calculating the return period flows of several periods from the annual maximums:
+def calculate_period_return_events(annual_maximums, period_days, return_periods=None, fit_cache=None):
+    """
+    :param annual_maximums: Annual maximums for the whole simulation, from calculate_annual_extremes. Either a
+                            single series or a 2D array (series x years).
+    :param period_days: List of [start day, end day] for each period (these must be whole climate years).
+    :param return_periods: List of years that you want return flows calculating for.
+    :param fit_cache: Cache of fitted distributions from open_fit_cache (None to fit every series).
+    :return: The return period years and an array of flows (... x periods x return periods). As in
+             calculate_return_events, periods that cannot be fitted are set to 0 cumecs if more than 90% of the
+             annual maximums are 0, else NaN.
+    """
+    annual_maximums = np.asarray(annual_maximums, dtype=float)
+
+    # Slice the annual maximums of each period into a NaN padded block (... x periods x years):
+    period_years = [(start // 360, stop // 360) for start, stop in period_days]
+    longest = max(stop - start for start, stop in period_years)
+    period_maximums = np.full(annual_maximums.shape[:-1] + (len(period_years), longest), np.nan)
+    for p, (start, stop) in enumerate(period_years):
+        period_maximums[..., p, :stop - start] = annual_maximums[..., start:stop]
+
+    # Fit all the series and periods together:
+    block = period_maximums.reshape(-1, longest)
+    return_periods, return_period_discharges = calculate_return_events_batch(block, return_periods, fit_cache)
+
+    # Series that could not be fitted are set to 0 cumecs if they are mostly 0 flows, else NaN:
+    failed = np.ma.getmaskarray(return_period_discharges)[:, 0]
+    mostly_zero = (block == 0).sum(axis=1) > 0.9 * (~np.isnan(block)).sum(axis=1)
+    return_period_discharges = return_period_discharges.filled(np.nan)
+    return_period_discharges[failed & mostly_zero] = 0
+    profile_stage(None, zero_fallbacks=int((failed & mostly_zero).sum()),
+                  na_fallbacks=int((failed & ~mostly_zero).sum()))
+
+    return return_periods, return_period_discharges.reshape(period_maximums.shape[:-1] + (len(return_periods),))
+
+
 # Create a function for calculating flow of return period events:
-def calculate_return_events(discharge, method="lmo", return_periods=None):
+def calculate_return_events(discharge, method="lmo", return_periods=None, fit_cache=None):
     """
     :param discharge: List of daily discharges (360 days per year).
     :param method:  "lmo" - Lmoments (slower, more robust);
                     "mle" - mean likelihood estimation (faster, can create huge erroneous flows).
     :param return_periods: List of years that you want return flows calculating for.
+    :param fit_cache: Cache of fitted distributions from open_fit_cache (None to fit every series).
     :return: The return period years and flow value for each.
     """
 
@@ -38,30 +556,26 @@ def calculate_return_events(discharge, method="lmo", return_periods=None):
     return_periods = np.array(return_periods)
 
     # Get Annual maximums
-    annual_maximums = []
-    for year in range(len(discharge) // 360):
-        annual_maximums.append(discharge[(year * 360):((year + 1) * 360)].max())
+    annual_maximums, _ = calculate_annual_extremes(discharge, minimums=False)
 
     try:
         # Calculate the curve fits using the desired method (lmo/mle):
         if method == "lmo":
-            l_moms = distr.gev.lmom_fit(annual_maximums)
-            shape, loc, scale = l_moms.values()
+            # Use the batch fitter for the single series:
+            _, return_period_discharges = calculate_return_events_batch([annual_maximums], return_periods, fit_cache)
+            if np.ma.is_masked(return_period_discharges):
+                raise ValueError("L-Moments Invalid")
+            return_period_discharges = return_period_discharges.data[0]
 
         elif method == "mle":
-            # Suppress a warning from the fit function that is understood to be a bug:
-            # RuntimeWarning: invalid value encountered in subtract -pex2+logpex2-logex2
-            warnings.simplefilter('ignore', RuntimeWarning)
-
             # Fit the generalized extreme value distribution to the data.
-            shape, loc, scale = genextreme.fit(annual_maximums)
-
-            # Reset the warning settings:
-            warnings.resetwarnings()
+            shape, loc, scale = fit_gev_cached([annual_maximums], method="mle", fit_cache=fit_cache)
+            if np.ma.is_masked(shape):
+                raise ValueError("Maximum likelihood fit failed")
 
-        # Compute the return levels for several return periods.
-        return_period_discharges = genextreme.isf(1 / return_periods, shape, loc, scale)
-        return_period_discharges = np.round(return_period_discharges, 2)
+            # Compute the return levels for several return periods.
+            return_period_discharges = genextreme.isf(1 / return_periods, shape[0], loc[0], scale[0])
+            return_period_discharges = np.round(return_period_discharges, 2)
 
     # If there is an issue with the calculation (e.g. many 0 values), write the error and return NA/0 cumecs:
     except Exception as e:
@@ -76,87 +590,2061 @@ def calculate_return_events(discharge, method="lmo", return_periods=None):
     return return_periods, return_period_discharges
 
 
-# Create a function for swapping Nones with 0s
-# This is needed for the divisions later.
-def remove_None(val):
-    if val is None:
-        val = 0
-    return val
+# Create a function for creating a store to hold all of the results:
+def create_result_store(metric_names, sites, rcms, periods, store_path=None):
+    """
+    Creates a float array for every output metric (metric x site x rcm x period), filled with NaN, with dictionaries
+    that map the metric, site, rcm and period names to their positions in the array. Results are written straight
+    into the array; the labelled tables are only built when the outputs are written (result_store_to_dataframe).
+    If a store path is given, the array is instead a .npy file on disk (e.g. for the river network, whose results grow
+    with the length of the network). The file is only memory-mapped while results are added to it (add_site_results)
+    or read from it, so the results do not stay in memory.
+    :param metric_names: List of the output names, e.g. ["Q99", "ReturnPeriod_10yr"].
+    :param sites: List of the catchments or river Network IDs.
+    :param rcms: List of the RCMs.
+    :param periods: List of the periods.
+    :param store_path: Path of the .npy file to hold the array (None to hold it in memory). Any existing file is
+                       replaced.
+    :return: Dictionary of the results array ("values", None if it is on disk), the path of the array on disk ("path")
+             and the index dictionaries ("metrics", "sites", "rcms", "periods").
+    """
+    store = {
+        "metrics": {name: i for i, name in enumerate(metric_names)},
+        "sites": {site: i for i, site in enumerate(sites)},
+        "rcms": {rcm: i for i, rcm in enumerate(rcms)},
+        "periods": {period: i for i, period in enumerate(periods)},
+    }
+    shape = (len(store["metrics"]), len(store["sites"]), len(store["rcms"]), len(store["periods"]))
 
+    store["path"] = store_path
+    if store_path is None:
+        store["values"] = np.full(shape, np.nan)
+    else:
+        if os.path.dirname(store_path):
+            os.makedirs(os.path.dirname(store_path), exist_ok=True)
+        stored = np.lib.format.open_memmap(store_path, mode="w+", dtype=float, shape=shape)
+        offset, size = stored.offset, stored.size
+        del stored
 
-# Define a function for calculating the change in the statistic
-def calculate_change(period, reference_period):
-    if reference_period != 0 and reference_period is not None:
-        change = (period - reference_period) / reference_period * 100
-        return change
+        # Fill the array with NaN a block at a time, without mapping it (so that it is not held in memory):
+        block = np.full(2 ** 20, np.nan)
+        with open(store_path, "r+b") as store_file:
+            store_file.seek(offset)
+            for start in range(0, size, len(block)):
+                store_file.write(block[:min(len(block), size - start)].tobytes())
+        store["values"] = None
+    return store
+
+
+# Create a function for adding the results of some sites to the result store:
+def add_site_results(store, site_positions, values):
+    """
+    If the store is on disk, its file is only memory-mapped while the results are added, so they are written to disk
+    rather than held in memory.
+    :param store: Result store from create_result_store.
+    :param site_positions: Position of each site in the store (e.g. from store["sites"]), or the position of a site.
+    :param values: Results of the sites (metric x site x rcm x period, or metric x rcm x period for a single site).
+    """
+    if store["path"] is None:
+        store["values"][:, site_positions] = values
+    else:
+        stored = np.load(store["path"], mmap_mode="r+")
+        stored[:, site_positions] = values
+        stored.flush()
+        del stored
 
 
-def aggregate_to_monthly(flow_timeseries):
-    monthly_output = []
+# Create a function for reading the results of a metric for a range of sites from the result store:
+def _read_site_results(store, m, start=0, stop=None):
+    """
+    :param store: Result store from create_result_store.
+    :param m: Position of the metric.
+    :param start: Position of the first site.
+    :param stop: Position after the last site (None for the last site).
+    :return: Array of the results (site x rcm x period) - a copy if the store is on disk, so the file is not left
+             memory-mapped.
+    """
+    if store["path"] is None:
+        return store["values"][m, start:stop]
+    stored = np.load(store["path"], mmap_mode="r")
+    values = np.array(stored[m, start:stop])
+    del stored
+    return values
 
-    # Create an index of 1st day of each month:
-    month_starts = np.arange(start=0, stop=len(flow_timeseries) - 29, step=30)
 
-    # Cycle through each month of the dataset:
-    for month_start_day in month_starts:
-        # Get indexes of each month:
-        month_index = np.arange(start=month_start_day, stop=(month_start_day + 30), step=1)
+# Create a function for converting a metric in the result store into an output table:
+def result_store_to_dataframe(store, metric_name, index_name, periods=None):
+    """
+    :param store: Result store from create_result_store.
+    :param metric_name: Name of the metric to output.
+    :param index_name: Name for the index column (e.g. 'catchment' or 'Network_id').
+    :param periods: List of the periods to include (defaults to all of the periods).
+    :return: DataFrame in the layout of the output workbooks - a row for each site and (rcm, period) columns.
+    """
+    if periods is None:
+        periods = list(store["periods"])
 
-        # Take mean of the monthly flow:
-        monthly_output.append(flow_timeseries[month_index].mean())
+    values = _read_site_results(store, store["metrics"][metric_name])
+    values = values[:, :, [store["periods"][period] for period in periods]]
 
-    return monthly_output
+    columns = pd.MultiIndex.from_tuples([(rcm, period) for rcm in store["rcms"] for period in periods])
+    index = pd.Index(list(store["sites"]), name=index_name)
 
+    return pd.DataFrame(values.reshape(len(index), len(columns)), index=index, columns=columns)
 
-def mean_baseline_flow(monthly_flow_timeseries):
-    # Calculate the mean monthly flow (starting with December) for the Baseline period:
-    mean_monthly_flow = []
-    mean_monthly_flow_std = []
 
-    # Run through January-December
-    for calendar_month in range(12):
-        # Create indexes of each Jan/Feb/.../Dec
-        month_indexes = np.arange(start=calendar_month,
-                                  stop=len(monthly_flow_timeseries),
-                                  step=12)
+# Create a function for writing the result store as long tables, partitioned by metric and model:
+def write_results(store, results_folder, model_tab_name, metric_periods=None, file_format="parquet",
+                  block_rows=2 ** 20):
+    """
+    Each metric is written to <results_folder>/metric=<name>/model=<model_tab_name>/results.<parquet|feather>, with a
+    row for every site, rcm and period (columns "site", "rcm", "period" and "value"). The results of the same metric
+    and model are replaced; those of other models are kept. Files are written to a temporary name and then moved,
+    so a crash does not leave a part written file. The rows are built and written a block of sites at a time, so the
+    table of a metric is never held in memory at once (with a store on disk, only a block is read at a time).
+    :param store: Result store from create_result_store.
+    :param results_folder: Folder for the results of the scenario, e.g. "Outputs/Results/01c_UKCP18_UDMbaseline".
+    :param model_tab_name: Name of the model, as used for the tabs of the Excel outputs.
+    :param metric_periods: Dictionary of the periods to write for each metric (metrics not in this use all the
+                           periods), e.g. to only write the drought periods of the drought metrics.
+    :param file_format: "parquet" or "feather".
+    :param block_rows: Most rows to build and write at once.
+    :return: List of the paths written.
+    """
+    import pyarrow
+    import pyarrow.parquet
 
-        # Extract a list of flows for Jan/Feb/.../Dec
-        calendar_month_flow_list = [monthly_flow_timeseries[month] for month in month_indexes]
+    if file_format not in ["parquet", "feather"]:
+        raise ValueError(f"Unknown results format '{file_format}' - use 'parquet' or 'feather'.")
+    if metric_periods is None:
+        metric_periods = {}
+    start = time.perf_counter()
 
-        # Calculate the standard deviation of the timeseries of calendar months:
-        calendar_month_mean_flow_std = np.std(calendar_month_flow_list)
+    sites = np.array(list(store["sites"]))
+    rcms = list(store["rcms"])
+    paths = []
 
-        # Calculate the mean flow for each month (Jan/Feb/.../Dec):
-        calendar_month_mean_flow = sum(calendar_month_flow_list) / len(calendar_month_flow_list)
+    for metric_name, m in store["metrics"].items():
+        periods = list(metric_periods.get(metric_name, store["periods"]))
+        period_positions = [store["periods"][period] for period in periods]
+        n_rcms, n_periods = len(rcms), len(periods)
+        block = max(1, block_rows // max(1, n_rcms * n_periods))
 
-        # Add these values to the lists above:
-        mean_monthly_flow.append(calendar_month_mean_flow)
-        mean_monthly_flow_std.append(calendar_month_mean_flow_std)
+        folder = os.path.join(results_folder, f"metric={metric_name}", f"model={model_tab_name}")
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, f"results.{file_format}")
 
-    # Convert the lists to numpy arrays and return them:
-    return np.array(mean_monthly_flow), np.array(mean_monthly_flow_std)
+        writer = None
+        try:
+            for site_start in range(0, max(1, len(sites)), block):
+                values = _read_site_results(store, m, site_start, site_start + block)[:, :, period_positions]
 
+                # Site, rcm and period of every row (rows in the order of the result store):
+                n_sites = values.shape[0]
+                output = pd.DataFrame({
+                    "site": np.repeat(sites[site_start:site_start + block], n_rcms * n_periods),
+                    "rcm": pd.Categorical.from_codes(np.tile(np.repeat(np.arange(n_rcms), n_periods), n_sites), rcms),
+                    "period": pd.Categorical.from_codes(np.tile(np.arange(n_periods), n_sites * n_rcms), periods),
+                    "value": values.reshape(-1)})
+                table = pyarrow.Table.from_pandas(output, preserve_index=False)
 
-def calculate_flow_anomaly(monthly_flow_timeseries, mean_flow_timeseries):
-    # Repeat the mean monthly timeseries so that it covers the full period:
-    mean_flow_timeseries_repeated = np.tile(mean_flow_timeseries, 100)
+                if writer is None and file_format == "parquet":
+                    writer = pyarrow.parquet.ParquetWriter(path + ".partial", table.schema)
+                elif writer is None:
+                    writer = pyarrow.ipc.new_file(path + ".partial", table.schema,
+                                                  options=pyarrow.ipc.IpcWriteOptions(compression="lz4"))
+                writer.write_table(table)
+        finally:
+            if writer is not None:
+                writer.close()
 
-    # Crop any end months if needed:
-    mean_flow_timeseries_repeated = mean_flow_timeseries_repeated[0:len(monthly_flow_timeseries)]
+        # Remove the results of the model in the other format, so there is only ever one copy:
+        for old_path in [os.path.join(folder, "results.parquet"), os.path.join(folder, "results.feather")]:
+            if old_path != path and os.path.exists(old_path):
+                os.remove(old_path)
 
-    # Output anomaly (i.e. monthly flow - mean flow for that month):
-    return np.subtract(monthly_flow_timeseries, mean_flow_timeseries_repeated)
+        os.replace(path + ".partial", path)
+        paths.append(path)
 
+    profile_stage("write", start, unit=[])
+    return paths
 
-def normalise_anomaly(anomaly_to_normalise, monthly_standard_deviations):
-    # Repeat the standard deviation timeseries so that it covers the full period:
-    monthly_std_repeated = np.tile(monthly_standard_deviations, 100)
-    monthly_std_repeated[monthly_std_repeated == 0] = 0.0000001
 
-    # Crop any end months if needed:
-    monthly_std_repeated = monthly_std_repeated[0:len(anomaly_to_normalise)]
+# Create a function for listing the metrics and models in a results folder:
+def list_results(results_folder):
+    """
+    :param results_folder: Folder written by write_results.
+    :return: Dictionary of the models of each metric, with the path of each, e.g. {"Q99": {"HBV": path}}.
+    """
+    results = {}
+    if not os.path.isdir(results_folder):
+        return results
+
+    for metric_folder in sorted(os.listdir(results_folder)):
+        if not metric_folder.startswith("metric="):
+            continue
+        metric_path = os.path.join(results_folder, metric_folder)
+        for model_folder in sorted(os.listdir(metric_path)):
+            if not model_folder.startswith("model="):
+                continue
+            for file_name in ["results.parquet", "results.feather"]:
+                path = os.path.join(metric_path, model_folder, file_name)
+                if os.path.exists(path):
+                    results.setdefault(metric_folder[len("metric="):], {})[model_folder[len("model="):]] = path
+
+    return results
+
+
+# Create a function for reading results written by write_results:
+def read_results(results_folder, metrics=None, models=None, columns=None):
+    """
+    Only the partitions of the requested metrics and models are opened, and only the requested columns are read.
+    :param results_folder: Folder written by write_results.
+    :param metrics: List of the metrics to read (defaults to all of them).
+    :param models: List of the models (tab names) to read (defaults to all of them).
+    :param columns: List of the columns to read from "site", "rcm", "period" and "value" (defaults to all of them).
+    :return: DataFrame of the results with "metric" and "model" columns, or an empty DataFrame if there are none.
+    """
+    tables = []
+    for metric_name, metric_models in list_results(results_folder).items():
+        if metrics is not None and metric_name not in metrics:
+            continue
+        for model_tab_name, path in metric_models.items():
+            if models is not None and model_tab_name not in models:
+                continue
+
+            if path.endswith(".parquet"):
+                table = pd.read_parquet(path, columns=columns)
+            else:
+                table = pd.read_feather(path, columns=columns)
+
+            table["metric"] = metric_name
+            table["model"] = model_tab_name
+            tables.append(table)
+
+    if len(tables) == 0:
+        return pd.DataFrame()
+    return pd.concat(tables, ignore_index=True)
+
+
+# Create a function for converting the results of a metric and model into the layout of the Excel outputs:
+def results_to_excel_table(results, index_name):
+    """
+    :param results: DataFrame of a single metric and model from read_results.
+    :param index_name: Name for the index column (e.g. 'catchment' or 'Network_id').
+    :return: DataFrame with a row for each site and (rcm, period) columns, as from result_store_to_dataframe.
+    """
+    rcms = list(results["rcm"].cat.categories) if isinstance(results["rcm"].dtype, pd.CategoricalDtype) \
+        else list(pd.unique(results["rcm"]))
+    periods = list(results["period"].cat.categories) if isinstance(results["period"].dtype, pd.CategoricalDtype) \
+        else list(pd.unique(results["period"]))
+
+    table = results.pivot_table(index="site", columns=["rcm", "period"], values="value", dropna=False,
+                                observed=False, sort=False, aggfunc="first")
+    columns = pd.MultiIndex.from_tuples([(rcm, period) for rcm in rcms for period in periods])
+    table = table.reindex(index=pd.unique(results["site"]), columns=columns)
+    table.index.name = index_name
+    return table
+
+
+# Create a function for writing a table to a worksheet in the layout of the Excel outputs, a row at a time:
+def _write_excel_sheet(workbook, sheet_name, table):
+    """
+    Writes the same cells as DataFrame.to_excel - the rcm headers (merged over their periods), the period headers,
+    the index name and then a row for each site, leaving missing values blank. Rows are written in order, so this
+    can be used with a constant memory workbook.
+    :param workbook: xlsxwriter Workbook.
+    :param sheet_name: Name of the tab.
+    :param table: DataFrame from results_to_excel_table.
+    """
+    worksheet = workbook.add_worksheet(sheet_name)
+
+    column = 1
+    for rcm, rcm_columns in groupby(table.columns.get_level_values(0)):
+        n_columns = len(list(rcm_columns))
+        if n_columns > 1:
+            worksheet.merge_range(0, column, 0, column + n_columns - 1, rcm)
+        else:
+            worksheet.write(0, column, rcm)
+        column += n_columns
+    worksheet.write_row(1, 1, list(table.columns.get_level_values(1)))
+    worksheet.write(2, 0, table.index.name)
+
+    values = table.to_numpy(dtype=float)
+    finite = np.isfinite(values)
+    for row, (site, site_values, site_finite, site_nan) in enumerate(
+            zip(table.index.tolist(), values.tolist(), finite.tolist(), np.isnan(values).tolist()), start=3):
+        worksheet.write(row, 0, site)
+        for column, (value, is_finite, is_nan) in enumerate(zip(site_values, site_finite, site_nan), start=1):
+            if is_finite:
+                worksheet.write_number(row, column, value)
+            elif not is_nan:
+                # Infinite values are written as text, as pandas does:
+                worksheet.write_string(row, column, "inf" if value > 0 else "-inf")
+
+
+# Create a function for writing the workbook of a metric:
+def _export_workbook(results_folder, output_path, metric_name, model_tab_names, index_name, reduce_export, append):
+    """
+    :param results_folder: Folder written by write_results.
+    :param output_path: Path of the workbook.
+    :param metric_name: Name of the metric.
+    :param model_tab_names: List of the models to write, in the order of the tabs.
+    :param index_name: Name for the index column (e.g. 'catchment' or 'Network_id').
+    :param reduce_export: Drop the sites without results in every column.
+    :param append: Add the tabs to an existing workbook (replacing those of the same model) rather than replacing it.
+    :return: Path of the workbook.
+    """
+    tables = {}
+    for model_tab_name in model_tab_names:
+        results = read_results(results_folder, metrics=[metric_name], models=[model_tab_name],
+                               columns=["site", "rcm", "period", "value"])
+        tables[model_tab_name] = results_to_excel_table(results, index_name)
+        if reduce_export:
+            tables[model_tab_name] = tables[model_tab_name].dropna()
+
+    if append and os.path.exists(output_path):
+        # Append data. This will overwrite sheets with the same name (this re-writes the whole workbook):
+        with pd.ExcelWriter(output_path, engine="openpyxl", mode='a', if_sheet_exists='replace') as writer:
+            for model_tab_name, table in tables.items():
+                table.to_excel(writer, sheet_name=model_tab_name)
+        return output_path
+
+    # Write the workbook in one pass, holding only the current row of each tab in memory (xlsxwriter is imported
+    # here as it is only needed for the exports):
+    import xlsxwriter
+    workbook = xlsxwriter.Workbook(output_path + ".partial", {"constant_memory": True})
+    for model_tab_name, table in tables.items():
+        _write_excel_sheet(workbook, model_tab_name, table)
+    workbook.close()
+    os.replace(output_path + ".partial", output_path)
+    return output_path
+
+
+# Create a function for writing the legacy Excel outputs from the results:
+def export_results_to_excel(results_folder, output_prefix, index_name, metrics=None, models=None,
+                            reduce_export=False, append=False, workers=4):
+    """
+    Writes a workbook for each metric (<output_prefix><metric>.xlsx) with a tab for each model in the results. Each
+    workbook is written in one pass with a constant memory writer, replacing any existing workbook - so every model
+    that should be in the workbooks needs to be in the results. Set append to add the tabs to existing workbooks
+    instead (as the analysis scripts used to), keeping the tabs of models that are not in the results; this is much
+    slower as the whole workbook is loaded and re-written. The workbooks are written in parallel processes (the Excel
+    writers are pure Python, so threads would take turns), so call this from within if __name__ == "__main__".
+    :param results_folder: Folder written by write_results.
+    :param output_prefix: Start of the workbook paths, e.g. "Outputs/01_Catchments/01c_UKCP18_UDMbaseline_".
+    :param index_name: Name for the index column (e.g. 'catchment' or 'Network_id').
+    :param metrics: List of the metrics to export (defaults to all of them).
+    :param models: List of the models (tab names) to export, in the order of the tabs (defaults to all of them).
+    :param reduce_export: Drop the sites without results in every column (makes the river network outputs quicker
+                          to write and open).
+    :param append: Add the tabs to the existing workbooks rather than replacing them.
+    :param workers: Number of workbooks to write at once (1 writes them in serial).
+    :return: List of the workbooks written.
+    """
+    exports = []
+    for metric_name, metric_models in list_results(results_folder).items():
+        if metrics is not None and metric_name not in metrics:
+            continue
+        model_tab_names = [m for m in (metric_models if models is None else models) if m in metric_models]
+        if len(model_tab_names) > 0:
+            exports.append((f"{output_prefix}{metric_name}.xlsx", metric_name, model_tab_names))
+
+    export = partial(_export_workbook, results_folder, index_name=index_name, reduce_export=reduce_export,
+                     append=append)
+    if workers <= 1:
+        return [export(output_path, metric_name, model_tab_names)
+                for output_path, metric_name, model_tab_names in exports]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(export, output_path, metric_name, model_tab_names)
+                   for output_path, metric_name, model_tab_names in exports]
+        return [future.result() for future in futures]
+
+
+# Create a function for reading a flow output, returning None if the file does not exist:
+def read_flow_file(flow_path, **read_options):
+    """
+    :param flow_path: Path to the flow output (a text or csv file with a single column of flows, unless usecols is
+                      given in the read options).
+    :param read_options: Any further options for pd.read_csv, e.g. header=None, usecols=[3].
+    :return: Series of the flows, or None if the file does not exist.
+    """
+    if not os.path.exists(flow_path):
+        return None
+    return pd.read_csv(flow_path, **read_options).squeeze()
+
+
+# Create a function for reading a single column of a discharge output into a float array:
+def _read_discharge_column(flow_path, fallback_options, **loadtxt_options):
+    """
+    np.loadtxt only converts the column that is needed, which is quicker than pd.read_csv on these simple outputs.
+    Values are correctly rounded, so they match pandas for outputs written to 12 or fewer significant figures.
+    Files that numpy cannot parse (e.g. blank values) are read with pandas instead, as read_flow_file would.
+    :param flow_path: Path to the flow output (which must exist).
+    :param fallback_options: Options for pd.read_csv if numpy cannot parse the file.
+    :param loadtxt_options: Options for np.loadtxt, e.g. skiprows=1, usecols=3.
+    :return: Array of the flows.
+    """
+    try:
+        return np.loadtxt(flow_path, dtype=float, ndmin=1, **loadtxt_options)
+    except ValueError:
+        return np.array(read_flow_file(flow_path, **fallback_options), dtype=float, ndmin=1)
+
+
+# Create a function for reading a SHETRAN regular timestep discharge output (a header then one flow per line):
+def read_shetran_discharge(flow_path):
+    """
+    :param flow_path: Path to the output_<catchment>_discharge_sim_regulartimestep.txt file.
+    :return: Series of the flows, or None if the file does not exist.
+    """
+    if not os.path.exists(flow_path):
+        return None
+    return pd.Series(_read_discharge_column(flow_path, {}, skiprows=1), copy=False)
+
+
+# Create a function for reading an HBV discharge output (whitespace separated, no header, flows in column 3):
+def read_hbv_discharge(flow_path):
+    """
+    :param flow_path: Path to the HBV <catchment>.dat file.
+    :return: Series of the flows, or None if the file does not exist.
+    """
+    if not os.path.exists(flow_path):
+        return None
+    flows = _read_discharge_column(flow_path, {"header": None, "sep": r"\s+", "usecols": [3]}, usecols=3)
+    return pd.Series(flows, copy=False)
+
+
+# Create a function for reading an LSTM discharge output (a csv with a Discharge_mmd column):
+def read_lstm_discharge(flow_path, catchment_area=None, flow_column="Discharge_mmd"):
+    """
+    :param flow_path: Path to the LSTM <catchment>.csv file.
+    :param catchment_area: Catchment area (km2) to convert the flows to cumecs, or None to leave them in mm/day.
+    :param flow_column: Name of the discharge column.
+    :return: Series of the flows, or None if the file does not exist.
+    """
+    if not os.path.exists(flow_path):
+        return None
+    with open(flow_path) as flow_file:
+        header = [name.strip().strip('"') for name in flow_file.readline().split(",")]
+    flows = _read_discharge_column(flow_path, {"usecols": [flow_column]}, delimiter=",", skiprows=1,
+                                   usecols=header.index(flow_column))
+
+    # The array has just been read, so it can be converted in place:
+    if catchment_area is not None:
+        convert_mm_per_day_to_cumecs(flows, catchment_area, in_place=True)
+    return pd.Series(flows, copy=False)
+
+
+# Create a function for converting LSTM discharge from mm/day to cumecs:
+def convert_mm_per_day_to_cumecs(flows, catchment_area, in_place=False):
+    """
+    The steps are the same as ((flows / 1000.0) / 86400.0) * (catchment_area * 1000000.0), so the results are
+    identical, but in place they do not create a new array at each step.
+    :param flows: Series or array of flows in mm/day (must be a writeable float array if in_place).
+    :param catchment_area: Catchment area in km2.
+    :param in_place: Whether to overwrite the flows (they cannot be if they are read from a flow store).
+    :return: The flows in cumecs.
+    """
+    if not in_place:
+        return ((flows / 1000.0) / 86400.0) * (catchment_area * 1000000.0)
+    np.divide(flows, 1000.0, out=flows)
+    np.divide(flows, 86400.0, out=flows)
+    np.multiply(flows, catchment_area * 1000000.0, out=flows)
+    return flows
+
+
+# Create a function for finding the flow direction of river cells from the first flows in a SHETRAN h5 dataset:
+def _find_flow_faces(dataset, sorted_cells, direction_steps):
+    """
+    :param dataset: The h5py flow dataset (element x face x time).
+    :param sorted_cells: Array of the element index of each river cell, in increasing order.
+    :param direction_steps: Number of time steps used to find the flow direction.
+    :return: Array of the face with the largest total flow for each cell.
+    """
+    first_flows = dataset[sorted_cells, :, 0:min(direction_steps, dataset.shape[2])]
+    return np.argmax(abs(np.sum(first_flows, axis=2)), axis=1)
+
+
+# Create a function for finding the flow direction of river cells from a SHETRAN h5 output:
+def find_flow_directions(flow_path, cells, direction_steps=1000, flow_key="ovr_flow"):
+    """
+    The flows of all of the cells are reduced together, so only the first direction_steps of each cell are read.
+    :param flow_path: Path to the SHETRAN h5 output.
+    :param cells: List of the element index of each river cell (from 0, i.e. River_Cell - 1).
+    :param direction_steps: Number of time steps used to find the flow direction.
+    :param flow_key: Text in the name of the flow variable (e.g. '  4 ovr_flow').
+    :return: Array of the face of each cell (0=north, 1=east, 2=south, 3=west), or None if the file does not exist.
+    """
+    if not os.path.exists(flow_path):
+        return None
+    unique_cells, cell_rows = np.unique(np.asarray(cells, dtype=int), return_inverse=True)
+    with h5py.File(flow_path, 'r') as hf:
+        f_key = [k for k in hf["VARIABLES"].keys() if flow_key in k]
+        return _find_flow_faces(hf["VARIABLES"][f_key[0]]['value'], unique_cells, direction_steps)[cell_rows]
+
+
+# Create a function for reading the flows of river cells from a SHETRAN h5 output, returning None if it does not exist:
+def read_river_cell_flows(flow_path, cells, faces=None, steps=None, direction_steps=1000, flow_key="ovr_flow"):
+    """
+    Only the rows of the river cells are read, rather than every element of the catchment, and only one face of each
+    cell. If the faces are not given, the flow direction of each cell is the face with the largest total flow over
+    the first direction_steps, and only that face is then read for the whole series. Each read is a single selection
+    of the sorted cells, so HDF5 reads each chunk of the dataset once per selection, and the chunk cache holds the
+    chunks that are shared by the direction and flow reads.
+    :param flow_path: Path to the SHETRAN h5 output.
+    :param cells: List of the element index of each river cell (from 0, i.e. River_Cell - 1).
+    :param faces: List of the face to read for each cell (e.g. from a direction index), or None to find them.
+    :param steps: Number of time steps to read (None for all of them), e.g. 36000 to skip the steps after the end of
+                  the climate data.
+    :param direction_steps: Number of time steps used to find the flow direction of each cell.
+    :param flow_key: Text in the name of the flow variable (e.g. '  4 ovr_flow').
+    :return: Tuple of the flows of each cell on its flow direction (cell x time) and the face of each cell
+             (0=north, 1=east, 2=south, 3=west), or None if the file does not exist.
+    """
+    if not os.path.exists(flow_path):
+        return None
+
+    # h5py selections must be in increasing order, so read the sorted cells and reorder them afterwards:
+    unique_cells, unique_rows, cell_rows = np.unique(np.asarray(cells, dtype=int), return_index=True,
+                                                     return_inverse=True)
+
+    with h5py.File(flow_path, 'r', rdcc_nbytes=64 * 1024 ** 2) as hf:
+        f_key = [k for k in hf["VARIABLES"].keys() if flow_key in k]
+        dataset = hf["VARIABLES"][f_key[0]]['value']
+        steps = dataset.shape[2] if steps is None else min(steps, dataset.shape[2])
+
+        # Get the flow direction of each cell:
+        if faces is None:
+            unique_faces = _find_flow_faces(dataset, unique_cells, direction_steps)
+        else:
+            unique_faces = np.asarray(faces, dtype=int)[unique_rows]
+
+        # Read the flows of the cells on each face in turn:
+        flows = np.empty((len(unique_cells), steps), dtype=dataset.dtype)
+        for face in np.unique(unique_faces):
+            face_rows = np.flatnonzero(unique_faces == face)
+            flows[face_rows] = dataset[unique_cells[face_rows], face, 0:steps]
+
+    return flows[cell_rows], unique_faces[cell_rows]
+
+
+# Create a function for getting the size of an input (an array, or a tuple of arrays) in bytes:
+def _data_size(data):
+    """
+    :param data: Data returned by a read function.
+    :return: Size of the data in bytes (0 if it is not an array, e.g. None).
+    """
+    if isinstance(data, tuple):
+        return sum(_data_size(item) for item in data)
+    return getattr(data, "nbytes", 0)
+
+
+# Create a function for reading inputs in background threads, ahead of them being used:
+def prefetch_inputs(read_function, items, ahead=4, max_memory=None):
+    """
+    Up to 'ahead' reads run at once. Reads that have finished but not yet been used count towards max_memory, and
+    reads still running are counted at the size of the largest read so far; no new reads are started while this
+    would go over max_memory (the next item is always read, so large files are still processed one at a time).
+    :param read_function: Function that takes an item (e.g. a flow path) and returns its data.
+    :param items: List of the items to read, in the order that they will be used.
+    :param ahead: Maximum number of items to read at once.
+    :param max_memory: Maximum bytes of data to hold in memory ahead of its use (None for no limit).
+    :return: Generator of a future for each item, in the order of the items. Call .result() to get the data - this
+             waits for the read to finish and raises any exception from the read.
+    """
+    items = list(items)
+    pending = deque()
+    largest = 0
+
+    def in_flight():
+        size = 0
+        for future in pending:
+            if future.done() and future.exception() is None:
+                size += _data_size(future.result())
+            else:
+                size += largest
+        return size
+
+    with ThreadPoolExecutor(max_workers=ahead) as pool:
+        next_item = 0
+
+        # Start reading the next items, up to the number and memory limits:
+        def start_reads(always_next):
+            nonlocal next_item
+            while next_item < len(items) and len(pending) < ahead and (
+                    (always_next and not pending) or max_memory is None or in_flight() + largest <= max_memory):
+                pending.append(pool.submit(read_function, items[next_item]))
+                next_item += 1
+
+        while next_item < len(items) or pending:
+            start_reads(True)
+            future = pending.popleft()
+
+            # Keep 'ahead' reads going while this item is used (e.g. the next RCMs while a batch is analysed):
+            start_reads(False)
+            if future.exception() is None:
+                largest = max(largest, _data_size(future.result()))
+            yield future
+
+
+# Create a function for converting the flow outputs of a scenario into a single memory-mapped array:
+def ingest_flow_store(store_path, catchments, rcms, flow_path_template, read_function=read_flow_file, days=36000,
+                      ahead=4):
+    """
+    The flows are written to <store_path>.npy (catchment x rcm x day, NaN where there is no flow) with an index of the
+    catchments, RCMs and series lengths in <store_path>_index.csv. The index also holds the size and modification time
+    of each flow output when it was ingested, so checkpoints can tell which series have changed. Flows past the end of
+    the climate data (days) are not stored, as these are trimmed off by the analysis. Flow outputs that cannot be read
+    are left out of the store (with a length of -1) and their error is recorded in the index. Both files are written as
+    .partial files and only replace the existing store once the ingest has finished, so an interrupted ingest leaves the
+    old store.
+    :param store_path: Path for the store, without an extension.
+    :param catchments: List of the catchments.
+    :param rcms: List of the RCMs.
+    :param flow_path_template: Path of the flow outputs, with {catchment} and {rcm} in place of their names,
+                               e.g. ".../bcm_{rcm}/{catchment}/output_{catchment}_discharge_sim_regulartimestep.txt".
+    :param read_function: Function that reads a flow output, returning None if it does not exist.
+    :param days: Number of days to store for each series.
+    :param ahead: Number of flow outputs to read at once.
+    :return: DataFrame of the store index.
+    """
+    pairs = [(catchment, rcm) for catchment in catchments for rcm in rcms]
+    flow_paths = [flow_path_template.format(catchment=catchment, rcm=rcm) for catchment, rcm in pairs]
+
+    # Identity of each flow output, taken before it is read (so an output changed during the ingest is seen as changed):
+    identities = [get_file_identity(path) for path in flow_paths]
+
+    values = np.lib.format.open_memmap(store_path + ".npy.partial", mode="w+", dtype=float,
+                                       shape=(len(catchments), len(rcms), days))
+    values[:] = np.nan
+
+    # Lengths of the original series (-1 where the flow output does not exist or cannot be read):
+    lengths = np.full(len(pairs), -1)
+    errors = [""] * len(pairs)
+
+    for i, future in enumerate(prefetch_inputs(read_function, flow_paths, ahead=ahead)):
+        try:  # Try/Exception used to account for flow outputs that cannot be read.
+            flow = future.result()
+        except Exception as e:
+            print("EXCEPTION - Flow output: ", flow_paths[i], ":")
+            print(e)
+            errors[i] = str(e)
+            continue
+        if flow is None:
+            continue
+        flow = np.asarray(flow, dtype=float)
+        lengths[i] = len(flow)
+        values[i // len(rcms), i % len(rcms), :min(days, len(flow))] = flow[:days]
+
+    values.flush()
+    del values
+
+    index = pd.DataFrame({"catchment": [str(catchment) for catchment, rcm in pairs],
+                          "rcm": [str(rcm) for catchment, rcm in pairs],
+                          "length": lengths,
+                          "path": flow_paths,
+                          "size": [size for _, size, _ in identities],
+                          "mtime": [mtime for _, _, mtime in identities],
+                          "error": errors})
+    index.to_csv(store_path + "_index.csv.partial", index=False)
+
+    # Remove the old index before replacing the flows, so that the new flows are never opened with the old index:
+    if os.path.exists(store_path + "_index.csv"):
+        os.remove(store_path + "_index.csv")
+    os.replace(store_path + ".npy.partial", store_path + ".npy")
+    os.replace(store_path + "_index.csv.partial", store_path + "_index.csv")
+
+    return index
+
+
+# Create a function for opening a flow store made by ingest_flow_store:
+def open_flow_store(store_path):
+    """
+    :param store_path: Path of the store, without an extension.
+    :return: Dictionary of the memory-mapped flows ("values"), the positions of the catchments and RCMs ("catchments",
+             "rcms"), the length of each series ("lengths", catchment x rcm) and the identity of the flow output of
+             each series when it was ingested ("identities", {(catchment, rcm): (path, size, mtime)}). Nothing is read
+             from the flows until they are used.
+    """
+    index = pd.read_csv(store_path + "_index.csv", dtype={"catchment": str, "rcm": str})
+    catchments = list(dict.fromkeys(index["catchment"]))
+    rcms = list(dict.fromkeys(index["rcm"]))
+
+    return {
+        "values": np.load(store_path + ".npy", mmap_mode="r"),
+        "catchments": {catchment: i for i, catchment in enumerate(catchments)},
+        "rcms": {rcm: i for i, rcm in enumerate(rcms)},
+        "lengths": index["length"].to_numpy().reshape(len(catchments), len(rcms)),
+        "identities": {(catchment, rcm): (path, int(size), int(mtime)) for catchment, rcm, path, size, mtime in
+                       index[["catchment", "rcm", "path", "size", "mtime"]].itertuples(index=False)}
+        if "mtime" in index.columns else {},
+        "path": store_path,
+    }
+
+
+# Create a function for getting the identity of a series in a flow store, for the checkpoints:
+def get_stored_flow_identity(store, catchment, rcm):
+    """
+    :param store: Flow store from open_flow_store.
+    :param catchment: Name of the catchment.
+    :param rcm: Name of the RCM.
+    :return: Identity of the flow output that the series was ingested from (as get_file_identity), so re-ingesting
+             only changes the identities of the series whose flow outputs changed. Stores made before the identities
+             were indexed use the identity of the whole store.
+    """
+    identity = store["identities"].get((str(catchment), str(rcm)))
+    return identity if identity is not None else get_file_identity(store["path"] + ".npy")
+
+
+# Create a function for reading a flow series from a flow store, returning None if it does not exist:
+def read_stored_flows(store, catchment, rcm):
+    """
+    :param store: Flow store from open_flow_store.
+    :param catchment: Name of the catchment.
+    :param rcm: Name of the RCM.
+    :return: Series of the flows (a view of the memory map, not a copy), or None if there is no flow output.
+    """
+    c = store["catchments"].get(str(catchment))
+    r = store["rcms"].get(str(rcm))
+    if c is None or r is None or store["lengths"][c, r] < 0:
+        return None
+    return pd.Series(store["values"][c, r, :min(store["lengths"][c, r], store["values"].shape[2])], copy=False)
+
+
+# Create a function for getting the adapter of a model - where its flow outputs are and how they are read:
+def get_model_adapter(model, master_folder_UKCP18, master_folder_historical=None, UDM_Folder_name=None):
+    """
+    :param model: "SHETRAN" | "HBV" | "LSTM" for the catchment outlet flows, or "SHETRAN-RiverNet" for the flows of
+                  the river cells in the SHETRAN h5 outputs.
+    :param master_folder_UKCP18: Start of the path of the RCM outputs (the RCM name is added to this).
+    :param master_folder_historical: Folder of the historical simulations (not used for the river network, where
+                                     these are found from the model tracker).
+    :param UDM_Folder_name: Name of the UDM scenario folder (HBV only).
+    :return: Dictionary of the model, the path templates of the flow outputs and historical simulations (with
+             {catchment} and {rcm} in place of their names), their read function (which returns None if the file
+             does not exist) and the units of the flows ("cumecs" or "mm/day").
+    """
+    if model == "SHETRAN":
+        flow_path = master_folder_UKCP18 + "{rcm}/{catchment}/output_{catchment}_discharge_sim_regulartimestep.txt"
+        historical_path = "output_{catchment}_discharge_sim_regulartimestep.txt"
+        read_function, units = read_shetran_discharge, "cumecs"
+    elif model == "HBV":
+        flow_path = master_folder_UKCP18 + "{rcm}/" + UDM_Folder_name + "/SIMULATED/STANDARD/DISCHARGE/{catchment}.dat"
+        historical_path = "{catchment}.dat"
+        read_function, units = read_hbv_discharge, "cumecs"
+    elif model == "LSTM":
+        flow_path = master_folder_UKCP18 + "{rcm}/test/model_epoch030/csv/{catchment}.csv"
+        historical_path = "{catchment}.csv"
+        read_function, units = read_lstm_discharge, "mm/day"
+    elif model == "SHETRAN-RiverNet":
+        flow_path = master_folder_UKCP18 + "{rcm}/{catchment}/output_{catchment}_shegraph.h5"
+        historical_path = None
+        read_function, units = read_river_cell_flows, "cumecs"
+    else:
+        raise ValueError(f"There is no adapter for the model '{model}'.")
+
+    if historical_path is not None and master_folder_historical is not None:
+        historical_path = master_folder_historical + historical_path
+
+    return {"model": model, "flow_path": flow_path, "historical_path": historical_path, "read": read_function,
+            "units": units}
+
+
+# Create a function for splitting the series of a site into chunks that fit in a memory budget:
+def split_site_series(n_series, series_bytes, max_memory=None):
+    """
+    The series are split evenly, into as few chunks as fit in the budget (at least one series is in each chunk).
+    :param n_series: Number of series of the site, e.g. river cells.
+    :param series_bytes: Memory (bytes) used by the analysis of each series.
+    :param max_memory: Most memory (bytes) for the analysis of a chunk to use (None for a single chunk).
+    :return: List of the slice of the series in each chunk.
+    """
+    if max_memory is None or n_series == 0:
+        return [slice(0, n_series)]
+    n_chunks = -(-n_series // max(1, max_memory // series_bytes))
+    bounds = [n_series * k // n_chunks for k in range(n_chunks + 1)]
+    return [slice(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+# Create a function for loading the flows of several RCMs of a site into one array:
+def load_site_flows(adapter, site, rcms, days=36000, flow_store=None, ahead=4, max_memory=None, catchment_area=None,
+                    **read_options):
+    """
+    The flow outputs are read in background threads (or taken from the flow store, where the RCMs that are stored
+    together are a view of the memory map rather than a copy), so every RCM of a site can be analysed at once.
+    :param adapter: Model adapter from get_model_adapter.
+    :param site: Name of the site (catchment).
+    :param rcms: List of the RCM names to load.
+    :param days: Number of days to load - longer series are trimmed (the end has no driving data).
+    :param flow_store: Flow store from open_flow_store to load the flows from, or None to read the flow outputs.
+    :param ahead: Maximum number of flow outputs to read at once.
+    :param max_memory: Maximum bytes of flows to hold ahead of them being copied into the array (None for no limit).
+    :param catchment_area: Catchment area (km2), for models with flows in mm/day - these are converted to cumecs.
+    :param read_options: Any further options for the read function, e.g. the cells and faces of the river network.
+    :return: Dictionary of the flows ("flows", rcm x series x days, NaN where there are none), the length of each
+             original series ("lengths", -1 where there is no flow output), the exceptions raised reading any RCM
+             ("errors", {rcm position: exception}) and the sign of the flow direction of each series ("signs",
+             rcm x series, river network only - else None).
+    """
+    return next(stream_site_flows(adapter, site, [rcms], days=days, flow_store=flow_store, ahead=ahead,
+                                  max_memory=max_memory, catchment_area=catchment_area, **read_options))
+
+
+# Create a function for loading the flows of a site a batch of RCMs at a time, reading the next batch in the meantime:
+def stream_site_flows(adapter, site, rcm_batches, days=36000, flow_store=None, ahead=4, max_memory=None,
+                      catchment_area=None, **read_options):
+    """
+    The flow outputs of every batch are read by one set of background threads, so the first flow outputs of the next
+    batch are read while the current batch is being analysed (up to 'ahead' files and max_memory bytes).
+    :param adapter: Model adapter from get_model_adapter.
+    :param site: Name of the site (catchment).
+    :param rcm_batches: List of lists of the RCM names to load together.
+    :param days: Number of days to load - longer series are trimmed (the end has no driving data).
+    :param flow_store: Flow store from open_flow_store to load the flows from, or None to read the flow outputs.
+    :param ahead: Maximum number of flow outputs to read at once.
+    :param max_memory: Maximum bytes of flows to hold ahead of them being copied into the array (None for no limit).
+    :param catchment_area: Catchment area (km2), for models with flows in mm/day - these are converted to cumecs.
+    :param read_options: Any further options for the read function, e.g. the cells and faces of the river network.
+    :return: Generator of the flows of each batch, as returned by load_site_flows.
+    """
+    rcm_batches = [list(rcms) for rcms in rcm_batches]
+    if flow_store is None:
+        flow_paths = [adapter["flow_path"].format(catchment=site, rcm=rcm) for rcms in rcm_batches for rcm in rcms]
+        flow_reads = prefetch_inputs(partial(adapter["read"], **read_options), flow_paths, ahead=ahead,
+                                     max_memory=max_memory)
+
+    for rcms in rcm_batches:
+        if flow_store is not None:
+            site_flows = _take_stored_flows(flow_store, site, rcms, days)
+        else:
+            site_flows = _take_read_flows(flow_reads, site, rcms, days)
+
+        # Convert flows in mm/day to cumecs (the flows read from the files are a new array, so are converted in place):
+        if adapter["units"] == "mm/day" and catchment_area is not None:
+            site_flows["flows"] = convert_mm_per_day_to_cumecs(site_flows["flows"], catchment_area,
+                                                               in_place=flow_store is None)
+        yield site_flows
+
+
+# Create a function for taking the flows of several RCMs of a site from the flow store:
+def _take_stored_flows(flow_store, site, rcms, days):
+    start = time.perf_counter()
+    c = flow_store["catchments"].get(str(site))
+    positions = [flow_store["rcms"].get(str(rcm)) if c is not None else None for rcm in rcms]
+
+    # RCMs stored next to each other are a slice of the memory map (a view), else they are copied:
+    if len(rcms) > 0 and None not in positions and positions == list(range(positions[0], positions[0] + len(rcms))):
+        flows = flow_store["values"][c, positions[0]:positions[0] + len(rcms), :days][:, None]
+        lengths = flow_store["lengths"][c, positions[0]:positions[0] + len(rcms)]
+    else:
+        flows = np.full((len(rcms), 1, days), np.nan)
+        lengths = np.full(len(rcms), -1)
+        for i, r in enumerate(positions):
+            if r is not None:
+                flows[i, 0] = flow_store["values"][c, r, :days]
+                lengths[i] = flow_store["lengths"][c, r]
+    profile_stage("read", start, unit=[(str(site), str(rcm)) for rcm in rcms])
+
+    return {"flows": flows, "lengths": np.asarray(lengths), "errors": {}, "signs": None}
+
+
+# Create a function for copying the next flow outputs read by prefetch_inputs into one array:
+def _take_read_flows(flow_reads, site, rcms, days):
+    errors = {}
+    signs = None
+    flows, lengths = None, np.full(len(rcms), -1)
+
+    for i, future in zip(range(len(rcms)), flow_reads):
+        start = time.perf_counter()
+        try:
+            data = future.result()
+        except Exception as e:
+            errors[i] = e
+            continue
+        if data is None:
+            continue
+
+        # The river network readers also return the flow direction of each cell:
+        if isinstance(data, tuple):
+            data, directions = data
+            if signs is None:
+                signs = np.ones((len(rcms), len(directions)))
+            signs[i] = np.where(np.isin(directions, [2, 3]), -1, 1)
+
+        # Copy the flows into the array of every RCM (series x days):
+        data = np.asarray(data, dtype=float)
+        data = data.reshape(-1, data.shape[-1])
+        if flows is None:
+            flows = np.full((len(rcms), data.shape[0], days), np.nan)
+        lengths[i] = data.shape[1]
+        flows[i, :, :min(days, data.shape[1])] = data[:, :days]
+        profile_stage("read", start, unit=(str(site), str(rcms[i])), bytes_read=data.nbytes, files_read=1)
+
+    if flows is None:
+        flows = np.full((len(rcms), 1, days), np.nan)
+
+    return {"flows": flows, "lengths": np.asarray(lengths), "errors": errors, "signs": signs}
+
+
+# Profile of the stages of the analysis in this process (see start_profile):
+_profile = None
+
+
+# Create a function for starting a profile of the stages of the analysis:
+def start_profile(use_cprofile=False):
+    """
+    Once started, the analysis functions add the time of each stage (reading, quantiles, exceedances, return periods,
+    droughts, historical thresholds, writing) and their counts (bytes and files read, GEV fits, fit failures and
+    cached fits, fallbacks to 0 or NA, and the time in the fits and in genextreme.isf) to the profile, both in total
+    and for each (site, rcm). The worker processes of run_catchments profile their catchments and return their
+    profiles with the results. When no profile has been started, profile_stage returns straight away.
+    :param use_cprofile: Set to True to also run cProfile in this process (this does not include worker processes, so
+                         set the workers to 1 to profile the analysis itself).
+    :return: The profile.
+    """
+    global _profile
+    _profile = _create_profile()
+    _profile["started"] = time.strftime("%Y-%m-%d %H:%M:%S")
+    if use_cprofile:
+        _profile["cprofile"] = cProfile.Profile()
+        _profile["cprofile"].enable()
+    return _profile
+
+
+# Create a function for creating an empty profile for this process:
+def _create_profile():
+    """
+    :return: Dictionary of the process ID, the (site, rcm) being analysed ("unit"), the time and calls of each stage
+             ("stages", {stage: [seconds, calls]}), the total counts ("counts") and the times and counts of each
+             (site, rcm) ("units").
+    """
+    return {"pid": os.getpid(), "unit": None, "stages": {}, "counts": {}, "units": {}, "start": time.perf_counter(),
+            "cprofile": None}
+
+
+# Create a function for setting the (site, rcm) that the profiled stages are added to:
+def set_profile_unit(site, rcm=None):
+    """
+    :param site: Name of the site (None to not add the stages to a site).
+    :param rcm: Name of the RCM.
+    """
+    if _profile is not None:
+        _profile["unit"] = (str(site), str(rcm)) if site is not None else None
+
+
+# Create a function for adding the time of a stage, and any counts, to the profile of this process:
+def profile_stage(stage, start=None, unit=None, **counts):
+    """
+    This does nothing unless a profile has been started, so it can be left in the analysis.
+    :param stage: Name of the stage, e.g. "quantiles" (None to only add the counts).
+    :param start: time.perf_counter() at the start of the stage.
+    :param unit: (site, rcm) to add the stage to, or a list of these to share its time between (e.g. the RCMs whose
+                 droughts are found together - the counts are added to each). Defaults to the unit set by
+                 set_profile_unit.
+    :param counts: Counts to add, e.g. fits=10.
+    """
+    if _profile is None:
+        return
+    units = [_profile["unit"]] if unit is None else unit if isinstance(unit, list) else [unit]
+    units = [unit for unit in units if unit is not None]
+
+    if stage is not None:
+        seconds = time.perf_counter() - start
+        totals = _profile["stages"].setdefault(stage, [0.0, 0])
+        totals[0] += seconds
+        totals[1] += 1
+    for name, count in counts.items():
+        _profile["counts"][name] = _profile["counts"].get(name, 0) + count
+
+    for unit in units:
+        unit_counts = _profile["units"].setdefault(unit, {})
+        if stage is not None:
+            unit_counts[stage + "_seconds"] = unit_counts.get(stage + "_seconds", 0) + seconds / len(units)
+        for name, count in counts.items():
+            unit_counts[name] = unit_counts.get(name, 0) + count
+
+
+# Create a function for taking the stages and counts recorded by this process since they were last taken:
+def _take_profile():
+    """
+    :return: Dictionary of the stages, counts and units of the profile (these are reset).
+    """
+    taken = {name: _profile[name] for name in ["stages", "counts", "units"]}
+    _profile.update(stages={}, counts={}, units={})
+    return taken
+
+
+# Create a function for adding the stages and counts of another process to the profile of this process:
+def _merge_profile(taken):
+    """
+    :param taken: Stages, counts and units from _take_profile.
+    """
+    for stage, (seconds, calls) in taken["stages"].items():
+        totals = _profile["stages"].setdefault(stage, [0.0, 0])
+        totals[0] += seconds
+        totals[1] += calls
+    for name, count in taken["counts"].items():
+        _profile["counts"][name] = _profile["counts"].get(name, 0) + count
+    for unit, unit_counts in taken["units"].items():
+        merged = _profile["units"].setdefault(unit, {})
+        for name, count in unit_counts.items():
+            merged[name] = merged.get(name, 0) + count
+
+
+# Create a function for writing a profile as a JSON summary and a CSV of each (site, rcm):
+def write_profile(profile, profile_path, details=None):
+    """
+    Writes profile_path + ".json" (the wall time of the run, and the time and calls of each stage and the total
+    counts, which include the worker processes) and profile_path + ".csv" (the times and counts of each site and rcm).
+    If cProfile was used, its statistics are written to profile_path + ".prof" (open them with pstats or snakeviz).
+    :param profile: Profile from start_profile.
+    :param profile_path: Path to write the profile to, without an extension.
+    :param details: Dictionary of any details of the run to add to the summary, e.g. the scenario and workers.
+    :return: Dictionary of the summary.
+    """
+    global _profile
+    if os.path.dirname(profile_path):
+        os.makedirs(os.path.dirname(profile_path), exist_ok=True)
+
+    stage_seconds = sum(seconds for seconds, _ in profile["stages"].values())
+    summary = {"started": profile.get("started"), "seconds": round(time.perf_counter() - profile["start"], 3),
+               **(details or {}),
+               "stages": {stage: {"seconds": round(seconds, 3), "calls": calls,
+                                  "share": round(seconds / stage_seconds, 4) if stage_seconds else 0}
+                          for stage, (seconds, calls) in profile["stages"].items()},
+               "counts": {name: round(count, 3) if isinstance(count, float) else count
+                          for name, count in profile["counts"].items()}}
+    with open(profile_path + ".json", "w") as profile_file:
+        json.dump(summary, profile_file, indent=2, default=str)
+
+    units = pd.DataFrame.from_dict(profile["units"], orient="index").fillna(0)
+    if len(units) > 0:
+        units.index = pd.MultiIndex.from_tuples(units.index, names=["site", "rcm"])
+        units.sort_index(axis=1).to_csv(profile_path + ".csv")
+
+    if profile["cprofile"] is not None:
+        profile["cprofile"].disable()
+        profile["cprofile"].dump_stats(profile_path + ".prof")
+        pstats.Stats(profile_path + ".prof").sort_stats("cumulative").print_stats(15)
+
+    print("Profile: " + ", ".join(f"{stage} {times['seconds']:.1f}s" for stage, times in summary["stages"].items())
+          + f" ({summary['seconds']:.1f}s in total). Written to {profile_path}.json")
+    if _profile is profile:
+        _profile = None
+    return summary
+
+
+# Create a function for starting to track the progress of a run:
+def start_progress(total, weights=None, unit_name="catchment RCMs", status_path=None, interval=10, workers=1,
+                   details=None):
+    """
+    The progress is updated as each item (e.g. catchment) is finished, which only adds to a few counts. Every interval
+    seconds, a line of the progress (items and units done, units per second, the estimated time of completion, the
+    utilisation of the workers and the memory in use) is printed and written to the status file, for other tools to
+    poll. The status file is replaced in one step, so it is never read part written.
+    :param total: Number of items to run.
+    :param weights: List of the units of work in each item (e.g. the number of RCMs of each catchment that are not
+                    checkpointed), used for the rate and time of completion. Defaults to 1 for each item.
+    :param unit_name: Name of the units of work, for the printed progress.
+    :param status_path: Path of the JSON status file (None to only print the progress).
+    :param interval: Seconds between the progress updates.
+    :param workers: Number of worker processes.
+    :param details: Dictionary of any details of the run to add to the status, e.g. the scenario.
+    :return: Dictionary of the progress.
+    """
+    weights = list(weights) if weights is not None else [1] * total
+    progress = {"total": total, "weights": weights, "units_total": sum(weights), "unit_name": unit_name,
+                "status_path": status_path, "interval": interval, "workers": workers, "details": details or {},
+                "done": 0, "units_done": 0, "busy_seconds": 0.0, "item": None,
+                "started": time.strftime("%Y-%m-%d %H:%M:%S"), "start": time.perf_counter()}
+    progress["next_report"] = progress["start"] + interval
+    if status_path is not None and os.path.dirname(status_path):
+        os.makedirs(os.path.dirname(status_path), exist_ok=True)
+    report_progress(progress)
+    return progress
+
+
+# Create a function for adding a finished item to the progress, reporting it if it is time to:
+def update_progress(progress, item=None, busy_seconds=0.0, position=None):
+    """
+    :param progress: Progress from start_progress.
+    :param item: Name of the finished item, e.g. the catchment.
+    :param busy_seconds: Time the worker spent on the item, for the utilisation of the workers.
+    :param position: Position of the finished item in the weights, if the items finish out of order.
+    """
+    position = progress["done"] if position is None else position
+    if position < progress["total"]:
+        progress["units_done"] += progress["weights"][position]
+    progress["done"] += 1
+    progress["busy_seconds"] += busy_seconds
+    progress["item"] = item
+    if time.perf_counter() >= progress["next_report"]:
+        report_progress(progress)
+
+
+# Create a function for getting the memory in use by this process and its workers (MB):
+def _memory_in_use():
+    """
+    :return: Memory in use (MB) by this process and its worker processes if psutil is installed, else the peak memory
+             of this process if the resource module is available (i.e. not Windows), else None.
+    """
+    if psutil is not None:
+        process = psutil.Process()
+        in_use = process.memory_info().rss
+        for child in process.children(recursive=True):
+            try:
+                in_use += child.memory_info().rss
+            except psutil.Error:
+                pass
+        return round(in_use / 2 ** 20, 1)
+    if resource is not None:
+        return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10, 1)
+    return None
+
+
+# Create a function for printing the progress and writing it to the status file:
+def report_progress(progress, state="running"):
+    """
+    :param progress: Progress from start_progress.
+    :param state: State of the run for the status file, e.g. "running" or "finished".
+    :return: Dictionary of the status.
+    """
+    now = time.perf_counter()
+    elapsed = now - progress["start"]
+    progress["next_report"] = now + progress["interval"]
+
+    # The rate and time of completion are in units of work, so items that are already checkpointed are not counted:
+    rate = progress["units_done"] / elapsed if elapsed > 0 else 0
+    remaining = progress["units_total"] - progress["units_done"]
+    eta_seconds = remaining / rate if rate > 0 else None
+    utilisation = progress["busy_seconds"] / (progress["workers"] * elapsed) if elapsed > 0 else 0
+
+    status = {"state": state, "started": progress["started"], "updated": time.strftime("%Y-%m-%d %H:%M:%S"),
+              "elapsed_seconds": round(elapsed, 1), **progress["details"], "done": progress["done"],
+              "total": progress["total"], "units_done": progress["units_done"],
+              "units_total": progress["units_total"], "unit_name": progress["unit_name"],
+              "units_per_second": round(rate, 3), "items_per_second": round(progress["done"] / elapsed, 3)
+              if elapsed > 0 else 0, "eta_seconds": round(eta_seconds, 1) if eta_seconds is not None else None,
+              "eta": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(time.time() + eta_seconds))
+              if eta_seconds is not None else None, "workers": progress["workers"],
+              "worker_utilisation": round(utilisation, 3), "memory_mb": _memory_in_use(),
+              "last_item": progress["item"]}
+
+    if progress["status_path"] is not None:
+        temporary_path = progress["status_path"] + ".tmp"
+        with open(temporary_path, "w") as status_file:
+            json.dump(status, status_file, indent=2, default=str)
+        os.replace(temporary_path, progress["status_path"])
+
+    print(f"- {progress['done']}/{progress['total']} done ({progress['units_done']}/{progress['units_total']} "
+          f"{progress['unit_name']}, {rate:.2f}/s)"
+          + (f", ETA {status['eta'][11:]} ({eta_seconds / 60:.1f} min)" if eta_seconds is not None and remaining
+             else "")
+          + f", workers {100 * utilisation:.0f}% busy"
+          + (f", {status['memory_mb']:.0f} MB" if status["memory_mb"] is not None else ""))
+    return status
+
+
+# Create a function for reporting the end of a run:
+def finish_progress(progress):
+    """
+    :param progress: Progress from start_progress.
+    :return: Dictionary of the final status.
+    """
+    return report_progress(progress, state="finished")
+
+
+# Create a function for running the analysis of a catchment, returning its profile and the time it took:
+def _run_measured(analysis_function, profiled, *arguments):
+    """
+    :param analysis_function: Function that analyses a catchment.
+    :param profiled: Whether a profile has been started (the stages and counts are then returned).
+    :param arguments: Arguments of the analysis function.
+    :return: The result of the analysis function, the stages and counts that it added to the profile (None if not
+             profiled) and the time it took (s).
+    """
+    global _profile
+    start = time.perf_counter()
+    if profiled and (_profile is None or _profile["pid"] != os.getpid()):
+        _profile = _create_profile()
+    result = analysis_function(*arguments)
+    if profiled:
+        _profile["unit"] = None
+    return result, _take_profile() if profiled else None, time.perf_counter() - start
+
+
+# Create a function for running the analysis of each catchment, in parallel if there is more than one worker:
+def run_catchments(analysis_function, catchments, *arguments, workers=1, progress=None, window=None):
+    """
+    With more than one worker, the results of each catchment are returned as soon as it finishes, so a slow catchment
+    does not hold up the others. Only 'window' catchments are given to the worker processes at once (the next ones
+    as they finish), so the results waiting to be returned are bounded. The analysis function must be defined at the
+    top level of the script (and the script's analysis must be inside an 'if __name__ == "__main__":' block) so that
+    Windows can start the worker processes.
+    :param analysis_function: Function that takes a catchment (and any further arguments) and returns its results.
+    :param catchments: List of the catchments to analyse.
+    :param arguments: Lists of any further arguments to the analysis function, with an entry for each catchment.
+    :param workers: Number of processes to use. 1 runs the catchments in serial, in this process.
+    :param progress: Progress from start_progress, which is updated as the results of each catchment are returned.
+    :param window: Maximum number of catchments given to the worker processes at once (None for twice the workers).
+    :return: Generator of the position of each catchment in the list and its results, in the order the catchments
+             finish (the order of the list in a serial run).
+    """
+    # If a profile has been started, each catchment is profiled (in its worker process) and its profile is added to
+    # this one as its results are returned. The time each catchment took is returned too, for the progress:
+    profiled = _profile is not None
+    measured = profiled or progress is not None
+    if measured:
+        analysis_function = partial(_run_measured, analysis_function, profiled)
+
+    def finished(position, result):
+        if measured:
+            result, taken, seconds = result
+            if profiled:
+                _merge_profile(taken)
+            if progress is not None:
+                update_progress(progress, catchments[position], seconds, position)
+        return position, result
+
+    calls = enumerate(zip(catchments, *arguments))
+    if workers <= 1:
+        for position, call in calls:
+            yield finished(position, analysis_function(*call))
+        return
+
+    pool = ProcessPoolExecutor(max_workers=workers)
+    try:
+        running = {pool.submit(analysis_function, *call): position
+                   for position, call in islice(calls, window or 2 * workers)}
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+
+                # Give the next catchment to the workers before returning these results:
+                position = running.pop(future)
+                for next_position, call in islice(calls, 1):
+                    running[pool.submit(analysis_function, *call)] = next_position
+                yield finished(position, future.result())
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+
+# Create a function for hashing the analysis settings, so that checkpoints are only reused with the same settings:
+def hash_analysis_config(*settings):
+    """
+    :param settings: Any settings that affect the results, e.g. a dictionary of the outputs and periods, and the
+                     thresholds of a catchment. Arrays are hashed by their values.
+    :return: Text hash of the settings.
+    """
+    config = json.dumps(settings, sort_keys=True, default=lambda value: np.asarray(value).tolist())
+    return hashlib.sha1(config.encode()).hexdigest()
+
+
+# Create a function for hashing the analysis settings of each RCM of a site, for its checkpoints:
+def hash_rcm_configs(period_table, *settings):
+    """
+    Each RCM's hash only includes its own periods (not those of the other RCMs of the run), so adding an RCM to a run
+    does not change the hashes of the others and their checkpoints are still used.
+    :param period_table: Period table from create_period_table.
+    :param settings: Settings of the site that affect the results (as for hash_analysis_config), without the periods
+                     of the RCMs, e.g. a dictionary of the outputs and period names, and the thresholds of a catchment.
+    :return: List of the hash of the settings of each RCM (in the order of the period table).
+    """
+    site_config = hash_analysis_config(*settings)
+    return [hash_analysis_config(site_config, rcm_days) for rcm_days in period_table["days"]]
+
+
+# Create a function for getting the identity of an input file, to tell whether it has changed since it was analysed:
+def get_file_identity(path):
+    """
+    :param path: Path to the file.
+    :return: Tuple of the path, size (bytes) and modification time (ns). Missing files have a size and time of -1.
+    """
+    try:
+        stat = os.stat(path)
+        return str(path), stat.st_size, stat.st_mtime_ns
+    except OSError:
+        return str(path), -1, -1
+
+
+# Create a function for opening the checkpoints of a run, creating the folder if it does not exist:
+def open_checkpoints(checkpoint_folder):
+    """
+    The results of each (catchment, rcm) are saved as <catchment>_<rcm>.npy in the folder and recorded in
+    manifest.csv, with the identity of the flow output and the hash of the settings that they were analysed with.
+    Rows are added to the manifest as each result is saved, so it is kept if a run stops part way through. Where a
+    (catchment, rcm) is in the manifest more than once, the last row is used.
+    :param checkpoint_folder: Folder to hold the checkpoints.
+    :return: Dictionary of the folder and the manifest ({(catchment, rcm): (path, size, mtime, config)}).
+    """
+    os.makedirs(checkpoint_folder, exist_ok=True)
+    manifest_path = os.path.join(checkpoint_folder, "manifest.csv")
+
+    units = {}
+    if os.path.exists(manifest_path):
+        manifest = pd.read_csv(manifest_path, dtype=str, keep_default_na=False, on_bad_lines="skip")
+        for catchment, rcm, path, size, mtime, config in manifest[
+                ["catchment", "rcm", "path", "size", "mtime", "config"]].itertuples(index=False):
+            # Skip any row that was only partly written when a run stopped:
+            try:
+                units[(catchment, rcm)] = (path, int(size), int(mtime), config)
+            except ValueError:
+                continue
+
+    return {"folder": checkpoint_folder, "manifest_path": manifest_path, "units": units}
+
+
+# Create a function for getting the path of the checkpoint of a (catchment, rcm):
+def _checkpoint_path(checkpoints, catchment, rcm):
+    return os.path.join(checkpoints["folder"], f"{catchment}_{rcm}.npy")
+
+
+# Create a function for checking whether a (catchment, rcm) has been analysed with the same flow output and settings:
+def is_checkpointed(checkpoints, catchment, rcm, identity, config):
+    """
+    :param checkpoints: Checkpoints from open_checkpoints.
+    :param catchment: Catchment name.
+    :param rcm: RCM name.
+    :param identity: Identity of the flow output (from get_file_identity).
+    :param config: Hash of the analysis settings (from hash_analysis_config).
+    :return: True if the checkpoint can be used in place of analysing the (catchment, rcm).
+    """
+    unit = checkpoints["units"].get((str(catchment), str(rcm)))
+    return unit == (*identity, config) and os.path.exists(_checkpoint_path(checkpoints, catchment, rcm))
+
+
+# Create a function for saving the results of a (catchment, rcm) and adding them to the manifest:
+def save_checkpoint(checkpoints, catchment, rcm, identity, config, values):
+    """
+    :param checkpoints: Checkpoints from open_checkpoints.
+    :param catchment: Catchment name.
+    :param rcm: RCM name.
+    :param identity: Identity of the flow output (from get_file_identity).
+    :param config: Hash of the analysis settings (from hash_analysis_config).
+    :param values: Array of the results of the (catchment, rcm).
+    """
+    # Write to a temporary file first so that a run stopping part way through a write does not leave a broken
+    # checkpoint:
+    checkpoint_path = _checkpoint_path(checkpoints, catchment, rcm)
+    with open(checkpoint_path + ".partial", "wb") as checkpoint_file:
+        np.save(checkpoint_file, values)
+    os.replace(checkpoint_path + ".partial", checkpoint_path)
+
+    row = pd.DataFrame([[str(catchment), str(rcm), *identity, config]],
+                       columns=["catchment", "rcm", "path", "size", "mtime", "config"])
+    row.to_csv(checkpoints["manifest_path"], mode="a", index=False,
+               header=not os.path.exists(checkpoints["manifest_path"]))
+    checkpoints["units"][(str(catchment), str(rcm))] = (*identity, config)
+
+
+# Create a function for finding the RCMs of each catchment that need analysing (i.e. are not checkpointed):
+def find_rcms_to_run(checkpoints, catchments, rcms, identities, configs):
+    """
+    :param checkpoints: Checkpoints from open_checkpoints, or None to run every RCM.
+    :param catchments: List of the catchments.
+    :param rcms: List of the RCMs.
+    :param identities: Identities of the flow output of each catchment and RCM (catchment x rcm).
+    :param configs: Hash of the analysis settings of each catchment and RCM (catchment x rcm, from hash_rcm_configs).
+    :return: List of the positions of the RCMs to analyse for each catchment.
+    """
+    if checkpoints is None:
+        return [list(range(len(rcms))) for _ in catchments]
+    return [[r for r, rcm in enumerate(rcms)
+             if not is_checkpointed(checkpoints, catchment, rcm, identities[c][r], configs[c][r])]
+            for c, catchment in enumerate(catchments)]
+
+
+# Create a function for saving the newly analysed RCMs of a catchment and filling in the others from their checkpoints:
+def merge_checkpoints(checkpoints, catchment, rcms, run_rcms, failed_rcms, identities, configs, catchment_values):
+    """
+    :param checkpoints: Checkpoints from open_checkpoints.
+    :param catchment: Catchment name.
+    :param rcms: List of the RCMs.
+    :param run_rcms: Positions of the RCMs that were analysed.
+    :param failed_rcms: Positions of the RCMs that could not be analysed (e.g. the flows could not be read). These are
+                        not saved, so they are tried again in the next run.
+    :param identities: Identity of the flow output of each RCM.
+    :param configs: Hash of the analysis settings of each RCM (from hash_rcm_configs).
+    :param catchment_values: Array of the results of the catchment (... x rcm x period).
+    :return: The results of the catchment, including those from the checkpoints.
+    """
+    for r, rcm in enumerate(rcms):
+        if r not in run_rcms:
+            catchment_values[..., r, :] = np.load(_checkpoint_path(checkpoints, catchment, rcm))
+        elif r not in failed_rcms:
+            save_checkpoint(checkpoints, catchment, rcm, identities[r], configs[r], catchment_values[..., r, :])
+    return catchment_values
+
+
+# Name of the environment variable that passes the settings of a scenario from the batch runner to the analysis script
+# (and on to its worker processes):
+scenario_variable = "FLOW_ANALYSIS_SCENARIO"
+
+# Results shared by the scenarios of a batch run (e.g. the historical thresholds), kept for the life of the process:
+_shared_results = {}
+
+
+# Create a function for converting a setting from the scenario manifest to a Python value:
+def _parse_setting(value):
+    if value in ["True", "False", "None"]:
+        return {"True": True, "False": False, "None": None}[value]
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+# Create a function for reading the scenario manifest:
+def read_scenario_manifest(manifest_path):
+    """
+    The manifest is a csv with a row for each scenario. The 'run' column (True/False) sets whether the scenario is run
+    and the 'script' column is the analysis script that runs it (e.g. "Catchments - SHETRAN"). Every other column is
+    a setting of the script (e.g. output_root_name, master_folder_UKCP18, calculate_drought_stats) - blank cells keep
+    the setting in the script. Lines starting with # are ignored.
+    :param manifest_path: Path to the manifest.
+    :return: List of dictionaries of the run, script and settings of each scenario.
+    """
+    manifest = pd.read_csv(manifest_path, dtype=str, keep_default_na=False, comment="#", skipinitialspace=True)
+    for column in ["run", "script"]:
+        if column not in manifest.columns:
+            raise ValueError(f"The scenario manifest has no '{column}' column: {manifest_path}")
+
+    scenarios = []
+    for row in manifest.to_dict("records"):
+        settings = {name: _parse_setting(value.strip()) for name, value in row.items()
+                    if name not in ["run", "script"] and value.strip() != ""}
+        scenarios.append({"run": _parse_setting(row["run"].strip()) is True, "script": row["script"].strip(),
+                          "settings": settings})
+    return scenarios
+
+
+# Create a function for replacing the settings of an analysis script with those of the scenario being run:
+def apply_scenario_settings(namespace, convex=""):
+    """
+    Does nothing unless the script is run by run_scenarios. Settings starting with 'master_folder' are joined to
+    convex unless they are absolute paths (e.g. "I:/LSTM/").
+    :param namespace: Settings of the script (its globals()).
+    :param convex: Path of the drive that relative folders are in.
+    :return: Dictionary of the settings of the scenario, or None if no scenario is being run.
+    """
+    settings = os.environ.get(scenario_variable)
+    if settings is None:
+        return None
+
+    settings = json.loads(settings)
+    for name, value in settings.items():
+        if name.startswith("master_folder") and isinstance(value, str) and not (
+                os.path.isabs(value) or value[1:2] == ":"):
+            settings[name] = convex + value
+    namespace.update(settings)
+    return settings
+
+
+# Create a function for getting a result that is shared by the scenarios of a batch run, calculating it the first time:
+def get_shared_result(key, function, *args, **kwargs):
+    """
+    Results are kept in this process, so when run_scenarios runs several scenarios, those using the same inputs (e.g.
+    the same historical simulations) only calculate them once. Mutable results should be copied before changing them.
+    :param key: Key of the result - this must include every input that changes the result.
+    :param function: Function that calculates the result.
+    :param args: Arguments to the function.
+    :param kwargs: Keyword arguments to the function.
+    :return: The result.
+    """
+    if key not in _shared_results:
+        _shared_results[key] = function(*args, **kwargs)
+    return _shared_results[key]
+
+
+# Create a function for running the analysis scripts of many scenarios in this process:
+def run_scenarios(scenarios, script_folder):
+    """
+    Each scenario is run as if its script had been run on its own (with its settings replaced by those of the
+    scenario), but in this process, so the results from get_shared_result and any caches are shared. A scenario that
+    fails is reported and the others are still run.
+    :param scenarios: List of scenarios from read_scenario_manifest (only those set to run are run).
+    :param script_folder: Folder of the analysis scripts.
+    :return: DataFrame of the script, output name, status and time (seconds) of each scenario that was run.
+    """
+    summary = []
+    scenarios = [scenario for scenario in scenarios if scenario["run"]]
+
+    for s, scenario in enumerate(scenarios):
+        script_path = os.path.join(script_folder, f"Hydrological Flow and Drought Analysis - {scenario['script']}.py")
+        output_root_name = scenario["settings"].get("output_root_name", "")
+        print(f"=== Scenario {s + 1}/{len(scenarios)}: {scenario['script']} {output_root_name}")
+
+        start = time.time()
+        status = "completed"
+        os.environ[scenario_variable] = json.dumps(scenario["settings"])
+        try:
+            runpy.run_path(script_path, run_name="__main__")
+        except Exception as e:
+            print("EXCEPTION - Scenario: ", output_root_name, ":")
+            print(e)
+            status = f"failed: {e}"
+        finally:
+            del os.environ[scenario_variable]
+
+        summary.append([scenario["script"], output_root_name, status, round(time.time() - start, 1)])
+
+    return pd.DataFrame(summary, columns=["script", "output_root_name", "status", "seconds"])
+
+
+# Create a function for swapping Nones with 0s
+# This is needed for the divisions later.
+def remove_None(val):
+    if val is None:
+        val = 0
+    return val
+
+
+# Define a function for calculating the change in the statistic
+def calculate_change(period, reference_period):
+    if reference_period != 0 and reference_period is not None:
+        change = (period - reference_period) / reference_period * 100
+        return change
+
+
+# Create a function for calculating the mean flow of each month:
+def aggregate_to_monthly(flow_timeseries, days_per_month=30):
+    """
+    :param flow_timeseries: Daily flows, either a single series or a 2D array (series x days). Any incomplete final
+                            month is ignored.
+    :param days_per_month: Length of the climate month.
+    :return: Array of the mean flow of each month (... x months). Missing (NaN) days are skipped, as in pandas.
+    """
+    flows = np.asarray(flow_timeseries, dtype=float)
+    months = flows.shape[-1] // days_per_month
+    monthly_flows = flows[..., :months * days_per_month].reshape(flows.shape[:-1] + (months, days_per_month))
+
+    missing = np.isnan(monthly_flows)
+    if not missing.any():
+        return monthly_flows.sum(axis=-1) / days_per_month
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(missing, 0, monthly_flows).sum(axis=-1) / (days_per_month - missing.sum(axis=-1))
+
+
+# Create a function for calculating the mean and standard deviation of each calendar month (Jan-Dec):
+def mean_baseline_flow(monthly_flow_timeseries):
+    """
+    :param monthly_flow_timeseries: Monthly flows of the baseline, either a single series or a 2D array (series x
+                                    months), starting in the first calendar month. Can be any number of months.
+    :return: Arrays of the mean and (population) standard deviation of each calendar month (... x 12).
+    """
+    monthly_flows = np.asarray(monthly_flow_timeseries, dtype=float)
+    months = monthly_flows.shape[-1]
+    years = -(-months // 12)
+
+    # Arrange the months into (... x year x calendar month), padding an incomplete final year with 0s:
+    padded = np.zeros(monthly_flows.shape[:-1] + (years * 12,))
+    padded[..., :months] = monthly_flows
+    yearly_flows = padded.reshape(monthly_flows.shape[:-1] + (years, 12))
+    in_record = (np.arange(years * 12) < months).reshape(years, 12)
+    counts = in_record.sum(axis=0)
+
+    # The mean is summed a year at a time (as sum() does) and the standard deviation along each calendar month (as
+    # np.std does), so that these match the values of a loop over the calendar months:
+    mean_monthly_flow = yearly_flows.sum(axis=-2) / counts
+
+    calendar_flows = np.ascontiguousarray(np.swapaxes(yearly_flows, -1, -2))
+    deviations = calendar_flows - (calendar_flows.sum(axis=-1) / counts)[..., np.newaxis]
+    deviations[..., ~in_record.T] = 0
+    mean_monthly_flow_std = np.sqrt((deviations * deviations).sum(axis=-1) / counts)
+
+    return mean_monthly_flow, mean_monthly_flow_std
+
+
+# Create a function for calculating the anomaly of each month from the mean of its calendar month:
+def calculate_flow_anomaly(monthly_flow_timeseries, mean_flow_timeseries):
+    """
+    :param monthly_flow_timeseries: Monthly flows (... x months), starting in the first calendar month.
+    :param mean_flow_timeseries: Mean flow of each calendar month (... x 12).
+    :return: Array of the monthly flow minus the mean flow of that month (... x months).
+    """
+    monthly_flows = np.asarray(monthly_flow_timeseries, dtype=float)
+    calendar_months = np.arange(monthly_flows.shape[-1]) % 12
+    return monthly_flows - np.asarray(mean_flow_timeseries)[..., calendar_months]
+
+
+# Create a function for normalising the anomalies by the standard deviation of their calendar month:
+def normalise_anomaly(anomaly_to_normalise, monthly_standard_deviations):
+    """
+    :param anomaly_to_normalise: Monthly anomalies (... x months), starting in the first calendar month.
+    :param monthly_standard_deviations: Standard deviation of each calendar month (... x 12). Months with no variation
+                                        are divided by 0.0000001 instead.
+    :return: Array of the normalised anomalies (... x months).
+    """
+    monthly_std = np.where(np.asarray(monthly_standard_deviations) == 0, 0.0000001, monthly_standard_deviations)
+    calendar_months = np.arange(np.shape(anomaly_to_normalise)[-1]) % 12
+    return anomaly_to_normalise / monthly_std[..., calendar_months]
+
+
+# Create a function for standardising daily flows into normalised monthly anomalies, for the drought statistics:
+def standardise_monthly_flows(flows, baseline_months, days_per_month=30):
+    """
+    :param flows: Daily flows, either a single series or a 2D array (series x days), e.g. every RCM of a catchment or
+                  every cell of a river network. Any incomplete final month is ignored.
+    :param baseline_months: The start and end month of the baseline period, from which the mean and standard
+                            deviation of each calendar month are calculated.
+    :param days_per_month: Length of the climate month.
+    :return: Arrays of the monthly flows (... x months), the baseline mean and standard deviation of each calendar
+             month (... x 12), the anomalies and the normalised anomalies (... x months).
+    """
+    monthly_flow = aggregate_to_monthly(flows, days_per_month)
+
+    # Calculate the mean monthly flow (i.e. Jan-Dec) for the baseline period:
+    mean_monthly_flow_baseline, mean_monthly_flow_baseline_std = mean_baseline_flow(
+        monthly_flow[..., baseline_months[0]:baseline_months[1]])
+
+    # Calculate flow anomaly by removing mean monthly baseline flow from the full record:
+    monthly_flow_anomaly = calculate_flow_anomaly(monthly_flow, mean_monthly_flow_baseline)
+
+    # Normalise the anomaly by dividing by the mean month's standard deviation:
+    monthly_flow_anomaly_normalised = normalise_anomaly(monthly_flow_anomaly, mean_monthly_flow_baseline_std)
+
+    return (monthly_flow, mean_monthly_flow_baseline, mean_monthly_flow_baseline_std, monthly_flow_anomaly,
+            monthly_flow_anomaly_normalised)
+
+
+# Names of the outputs of calculate_period_drought_stats:
+drought_output_names = ["drought_duration_mean", "drought_months", "drought_months_severe", "drought_deficit_max",
+                        "drought_deficit_mean", "drought_deficit_total", "drought_duration_mean_severe",
+                        "drought_deficit_mean_severe"]
+
+
+# Create a function for calculating the drought statistics of the standardised monthly flow anomalies:
+def calculate_period_drought_stats(anomalies, period_months, severity_classes=(4, 8), thirty_year_factors=None):
+    """
+    Droughts are runs of months with negative anomalies. Droughts are cropped to each period that they overlap, and
+    the severity of each is its total deficit (the negative of the sum of its anomalies) within the period. Severe
+    droughts are those with a severity class above 0. All the droughts of all the series are found, cropped and
+    summed together as arrays, rather than a table for each series.
+    :param anomalies: Standardised monthly flow anomalies, either a single series or a 2D array (series x months), e.g.
+                      the RCMs of a catchment or the cells of a river network. Missing (NaN) months are not droughts.
+    :param period_months: Start and end month of each period, either (periods x 2) or, where these differ between the
+                          series (e.g. the warming levels of each RCM), (series x periods x 2).
+    :param severity_classes: Severities at which each severity class starts (droughts below the first are class 0).
+    :param thirty_year_factors: Factors that normalise the totals of each period to 30 years, in the same shape as
+                                period_months without its last dimension (e.g. from create_period_table). By default
+                                these are found from period_months.
+    :return: Dictionary of each of the drought_output_names (... x periods), rounded to 3dp. The drought months and
+             total deficit are normalised to 30 years. Periods without droughts have 0 drought months and total
+             deficit, and NaN durations, maximums and means.
+    """
+    anomalies = np.asarray(anomalies, dtype=float)
+    series = anomalies.reshape(-1, anomalies.shape[-1])
+    n_series, n_months = series.shape
+    period_months = np.asarray(period_months, dtype=float)
+    period_months = np.broadcast_to(period_months, (n_series,) + period_months.shape[-2:])
+    n_periods = period_months.shape[1]
+    if thirty_year_factors is None:
+        thirty_year_factors = 360 / (period_months[..., 1] - period_months[..., 0])
+    thirty_year_factors = np.broadcast_to(thirty_year_factors, (n_series, n_periods))
+
+    # Run-length encode the deficits - the first and (exclusive) last month of every drought in every series:
+    deficit = np.zeros((n_series, n_months + 2), dtype=np.int8)
+    deficit[:, 1:-1] = series < 0
+    changes = np.diff(deficit, axis=1)
+    drought_series, drought_starts = np.nonzero(changes == 1)
+    drought_ends = np.nonzero(changes == -1)[1]
+
+    # Flatten the anomalies so that the deficits of every drought can be summed in one go (with an extra month so that
+    # droughts can end at the end of the last series):
+    flat_anomalies = np.append(series.reshape(-1), 0.0)
+    offsets = drought_series * n_months
+
+    outputs = {name: np.full((n_series, n_periods), np.nan) for name in drought_output_names}
+    for name in ["drought_months", "drought_months_severe", "drought_deficit_total"]:
+        outputs[name][:] = 0
+
+    for p in range(n_periods):
+        period_start = period_months[drought_series, p, 0]
+        period_end = period_months[drought_series, p, 1]
+
+        # Crop the droughts that overlap the period to the period, dropping those left with no months:
+        starts = np.maximum(drought_starts, period_start)
+        ends = np.minimum(drought_ends, period_end)
+        lengths = ends - starts
+        in_period = (drought_starts <= period_end) & (drought_ends >= period_start) & (lengths != 0)
+        if not in_period.any():
+            continue
+        event_series, lengths = drought_series[in_period], lengths[in_period]
+        first_months = offsets[in_period] + starts[in_period].astype(int)
+        last_months = offsets[in_period] + ends[in_period].astype(int)
+
+        # Severity (total deficit) of each drought, summing every drought at once:
+        bounds = np.empty(2 * len(first_months), dtype=np.intp)
+        bounds[0::2], bounds[1::2] = first_months, last_months
+        severities = -np.add.reduceat(flat_anomalies, bounds)[0::2]
+        severities[first_months == last_months] = -0.0
+        severity_class = np.digitize(severities, severity_classes)
+
+        # Factors that normalise the counts and totals of the period to 30 years:
+        thirty_yrs = thirty_year_factors[:, p]
+
+        # Statistics of the droughts of each series (the droughts of each series are together, in order):
+        for suffix, events in [("", slice(None)), ("_severe", severity_class > 0)]:
+            series_with_droughts, group_starts, counts = np.unique(event_series[events], return_index=True,
+                                                                   return_counts=True)
+            if len(series_with_droughts) == 0:
+                continue
+            total_lengths = np.add.reduceat(lengths[events], group_starts)
+            total_severities = np.add.reduceat(severities[events], group_starts)
+
+            outputs["drought_duration_mean" + suffix][series_with_droughts, p] = total_lengths / counts
+            outputs["drought_months" + suffix][series_with_droughts, p] = \
+                total_lengths * thirty_yrs[series_with_droughts]
+            outputs["drought_deficit_mean" + suffix][series_with_droughts, p] = total_severities / counts
+            if suffix == "":
+                outputs["drought_deficit_total"][series_with_droughts, p] = \
+                    total_severities * thirty_yrs[series_with_droughts]
+                outputs["drought_deficit_max"][series_with_droughts, p] = \
+                    np.maximum.reduceat(severities, group_starts)
+
+    return {name: np.round(values, 3).reshape(anomalies.shape[:-1] + (n_periods,))
+            for name, values in outputs.items()}
+
+
+# Create a function for calculating the flow and drought statistics of the RCMs of a site, for any model:
+def analyse_site_flows(site, site_flows, rcm_positions, thresholds, settings, fit_cache=None, values=None):
+    """
+    This is the analysis shared by the model scripts - they only differ in how the flows are loaded. The statistics of
+    every series of an RCM (e.g. the river cells of a catchment) are calculated together, and the droughts of several
+    RCMs together.
+    :param site: Name of the site (catchment), for messages.
+    :param site_flows: Flows of the RCMs from load_site_flows.
+    :param rcm_positions: Positions in the RCM list of the RCMs in site_flows.
+    :param thresholds: Historical flow thresholds of each series (series x thresholds), or None if the flow statistics
+                       are not calculated.
+    :param settings: Dictionary of the analysis settings - the output names ("outputs"), periods ("periods", the period
+                     table from create_period_table), RCM names ("rcms"), drought periods and baseline
+                     ("drought_periods", "drought_baseline_date"), whether the thresholds count days above
+                     ("threshold_above"), return periods ("return_periods", output as ReturnPeriod_<years>yr), decimal
+                     places of the threshold counts ("count_decimals"), whether to analyse the absolute flows
+                     ("absolute_flows"), whether to skip RCMs without flows greater than 0 ("skip_zero_flows") and the
+                     length of the climate data ("days").
+    :param fit_cache: Cache of the fitted return period distributions from open_fit_cache (None to fit every series).
+    :param values: Array of the results to add to (output x series x rcm x period), or None to create one.
+    :return: Array of the results (output x series x rcm x period, NaN where not analysed) and a list of the positions
+             of the RCMs that could not be analysed because of an error.
+    """
+    metric = {name: m for m, name in enumerate(settings["outputs"])}
+    period_table = settings["periods"]
+    periods = period_table["periods"]
+    days = settings["days"]
+    n_series = site_flows["flows"].shape[1]
+
+    if values is None:
+        values = np.full((len(metric), n_series, len(settings["rcms"]), len(periods)), np.nan)
+    failed_rcms = []
+
+    calculate_flow_stats = "Q99" in metric
+    return_period_names = [f"ReturnPeriod_{years}yr" for years in settings["return_periods"]]
+    calculate_return_periods = return_period_names[0] in metric if return_period_names else False
+    calculate_drought_stats = drought_output_names[0] in metric
+
+    if calculate_flow_stats:
+        thresholds = np.asarray(thresholds, dtype=float).reshape(n_series, 1, -1)
+
+    # The flows of several RCMs are standardised and their droughts found together, up to this many series at once:
+    drought_rcms, drought_flows = [], []
+    drought_block = max(1, 2 ** 26 // (days * 8))
+
+    # The baseline period is the same for every RCM:
+    baseline_months = period_table["months"][0, periods.index(settings["drought_baseline_date"])]
+    drought_positions = [periods.index(period) for period in settings["drought_periods"]]
+
+    def add_drought_stats():
+        start = time.perf_counter()
+
+        # >>> STEP 1 & 3 <<<
+        # (Create long term standardised mean monthly flows, for every series at once)
+        anomalies = standardise_monthly_flows(np.concatenate(drought_flows), baseline_months)[-1]
+
+        # >>> STEP 2, 4 & 5 <<<
+        # Find the droughts (runs of negative anomalies) of every series, crop them to each drought period and
+        # calculate their statistics, all at once:
+        period_rows = np.ix_(drought_rcms, drought_positions)
+        drought_stats = calculate_period_drought_stats(
+            anomalies, np.repeat(period_table["months"][period_rows], n_series, axis=0),
+            thirty_year_factors=np.repeat(period_table["thirty_year_factors"][period_rows], n_series, axis=0))
+
+        # Add the statistics to the output dataset:  [drought months and total deficit are normalised to 30 years]
+        positions = np.ix_(range(n_series), drought_rcms, drought_positions)
+        for name, drought_values in drought_stats.items():
+            values[metric[name]][positions] = drought_values.reshape(
+                len(drought_rcms), n_series, -1).transpose(1, 0, 2)
+
+        # (The time of the droughts is shared between the RCMs that were found together)
+        profile_stage("droughts", start, unit=[(str(site), str(settings["rcms"][r])) for r in drought_rcms])
+        drought_rcms.clear()
+        drought_flows.clear()
+
+    # Run through each RCM run:
+    for i, r in enumerate(rcm_positions):
+
+        set_profile_unit(site, settings["rcms"][r])
+
+        if i in site_flows["errors"]:
+            print("Exception - Catchment: ", site, ":")
+            print("... ", site_flows["errors"][i])
+            failed_rcms.append(r)
+            continue
+
+        if site_flows["lengths"][i] < 0:
+            continue
+
+        # Check that the simulation completed 100 years, else skip calculations:
+        if site_flows["lengths"][i] < days:
+            print("Catchment ", site, " skipped as incomplete.")
+            continue
+
+        # Sometimes the model outputs are 100yrs x 365 days instead of 100x360. This end period has no driving data,
+        # so is not loaded.
+        flows = np.abs(site_flows["flows"][i]) if settings["absolute_flows"] else site_flows["flows"][i]
+
+        if settings["skip_zero_flows"] and np.max(flows) == 0:
+            print(f"- Catchment {site} skipped as no values greater than 0.")
+            continue
+
+        # ---------------------------------------------------------
+        # CALCULATE FLOW QUANTILES AND COUNTS OVER/UNDER THRESHOLD:
+        # ---------------------------------------------------------
+
+        # Get the start and end days of each period from the period table (warming periods are capped at 2080):
+        period_days, period_years = period_table["days"][r], period_table["years"][r]
+
+        if calculate_flow_stats:
+            # Sort the flows of every period once and calculate all the quantiles and counts from this. The series
+            # are sorted in blocks, so that the sorted flows of many river cells are not all held at once:
+            block = max(1, 2 ** 26 // (len(periods) * days * 8))
+            for start in range(0, n_series, block):
+                stop = min(start + block, n_series)
+                stage_start = time.perf_counter()
+                period_flows = sort_period_flows(flows[start:stop], period_days)
+                period_quantiles = calculate_quantiles(period_flows, [0.01, 0.05, 0.50, 0.95, 0.99], is_sorted=True)
+                profile_stage("quantiles", stage_start)
+                stage_start = time.perf_counter()
+                period_counts = count_threshold_exceedances(period_flows, thresholds[start:stop],
+                                                            settings["threshold_above"])
+                profile_stage("exceedances", stage_start)
+
+                # Calculate UKCP18 flow quantiles:
+                values[metric["Q99"], start:stop, r] = np.round(period_quantiles[..., 0], 3)  # Very low flow
+                values[metric["Q95"], start:stop, r] = np.round(period_quantiles[..., 1], 3)  # Low flow
+                values[metric["Q50"], start:stop, r] = np.round(period_quantiles[..., 2], 3)  # Median flow
+                values[metric["Q05"], start:stop, r] = np.round(period_quantiles[..., 3], 3)  # High flow
+                values[metric["Q01"], start:stop, r] = np.round(period_quantiles[..., 4], 3)  # Very high flow
+
+                # Calculate counts under/over thresholds from HISTORICAL MODEL:
+                for name, k in [("LTQ99", 0), ("LTQ95", 1), ("GTQ05", 2), ("GTQ01", 3)]:
+                    values[metric[name], start:stop, r] = np.round(period_counts[..., k] / period_years,
+                                                                   settings["count_decimals"])
+
+                # Calculate counts over thresholds from OBSERVED DATASET (if "bankfull_flow" is in threshold_columns):
+                # values[metric["GTbankfull"], start:stop, r] = period_counts[..., 4] / period_years
+
+        if calculate_return_periods:
+            # Calculate the annual maximums once and fit the return periods of every series and period together:
+            stage_start = time.perf_counter()
+            annual_maximums, _ = calculate_annual_extremes(flows, minimums=False)
+            return_period_years, period_return_flows = calculate_period_return_events(
+                annual_maximums, period_days, return_periods=settings["return_periods"], fit_cache=fit_cache)
+
+            # Sayers et al. want the return periods of the river cells to be negative if they flow south or west:
+            if site_flows["signs"] is not None:
+                period_return_flows = site_flows["signs"][i][:, None, None] * period_return_flows
+
+            for n, name in enumerate(return_period_names):
+                values[metric[name], :, r] = period_return_flows[..., n]
+            profile_stage("return periods", stage_start)
+
+        if calculate_drought_stats:
+            drought_rcms.append(r)
+            drought_flows.append(flows)
+            if len(drought_rcms) * n_series >= drought_block:
+                add_drought_stats()
+
+    # --------------------
+    # CEH Drought metrics:
+    # --------------------
+
+    if len(drought_rcms) > 0:
+        add_drought_stats()
+
+    set_profile_unit(None)
+    return values, failed_rcms
+
+
+# Names of the historical flow thresholds:
+threshold_names = ["hist_q99", "hist_q95", "hist_q05", "hist_q01"]
+
+# Version of the historical threshold calculation. Increase this if the calculation changes, so that the thresholds
+# stored by get_historical_thresholds are recalculated:
+threshold_version = 1
+
+
+# Create a function for calculating the flow thresholds of the series of a site from its historical simulation:
+def calculate_site_thresholds(adapter, historical_path, catchment_area=None, absolute_flows=False,
+                              skip_zero_flows=True, **read_options):
+    """
+    Historical simulations run from 01/01/1980 to 01/01/2011. We will cut off the first 5 years of the simulation.
+    :param adapter: Model adapter from get_model_adapter.
+    :param historical_path: Path to the historical simulation of the site.
+    :param catchment_area: Catchment area (km2), for models with flows in mm/day.
+    :param absolute_flows: Set to True to use the absolute values of the thresholds (e.g. the river cell flows, which
+                           are on the flow direction of each cell).
+    :param skip_zero_flows: Set to True to skip simulations without flows greater than 0.
+    :param read_options: Any further options for the read function, e.g. the cells and faces of the river network.
+    :return: Array of the thresholds of each series of the site (series x threshold_names), or None if the simulation
+             does not exist, is incomplete or is skipped.
+    """
+    if adapter["units"] == "mm/day" and catchment_area is None:
+        raise ValueError(f"There is no catchment area to convert the flows of {historical_path} from mm/day.")
+
+    start = time.perf_counter()
+    flows = adapter["read"](historical_path, **read_options)
+    if flows is None:
+        print("- Historical simulation not found: ", historical_path)
+        return None
+    profile_stage("read", start, bytes_read=_data_size(flows), files_read=1)
+    start = time.perf_counter()
+
+    # The river network readers also return the flow direction of each cell:
+    if isinstance(flows, tuple):
+        flows = flows[0]
+    flows = np.asarray(flows, dtype=float)
+    flows = flows.reshape(-1, flows.shape[-1])
+    if adapter["units"] == "mm/day":
+        flows = convert_mm_per_day_to_cumecs(flows, catchment_area, in_place=True)
+
+    # Check that the simulation completed (within 10%), else pass:
+    if flows.shape[1] < (11324 * 0.9):
+        return None
+
+    if skip_zero_flows and np.max(flows) == 0:
+        print(f"- Historical simulation {historical_path} skipped as no values greater than 0.")
+        return None
+
+    # Calculate flow quantiles for the historical simulation (Q99 and Q95 are low flows, Q05 and Q01 high flows):
+    thresholds = np.round(calculate_quantiles(flows[:, 365 * 5:], [0.01, 0.05, 0.95, 0.99]), 3)
+    profile_stage("historical thresholds", start)
+    return np.abs(thresholds) if absolute_flows else thresholds
+
+
+# Create a function for calculating the thresholds of a site in a worker process, catching any errors:
+def _calculate_site_thresholds_safely(site, historical_path, read_options, catchment_area, adapter, absolute_flows,
+                                      skip_zero_flows):
+    """
+    :return: The thresholds from calculate_site_thresholds and whether they were calculated without an error (the
+             thresholds of sites with errors are not stored, so that they are tried again).
+    """
+    if historical_path is None:
+        print(f"- Historical simulation of {site} not found.")
+        return None, True
+    set_profile_unit(site, "historical")
+    try:  # Try/Exception used to account for missing and unreadable files.
+        return calculate_site_thresholds(adapter, historical_path, catchment_area, absolute_flows, skip_zero_flows,
+                                         **read_options), True
+    except Exception as e:
+        print("EXCEPTION - Catchment: ", site, ":")
+        print(e)
+        return None, False
+
+
+# Create a function for getting the historical flow thresholds of many sites, only calculating those not yet stored:
+def get_historical_thresholds(store_path, adapter, sites, historical_paths, series=None, read_options=None,
+                              catchment_areas=None, absolute_flows=False, skip_zero_flows=True, workers=1):
+    """
+    The thresholds do not change between the scenarios of a model, so they are calculated once (in parallel) and
+    stored in a table with a row for each series, which every later run reuses. The thresholds of a site are only
+    recalculated if its historical simulation changes (path, size or modification time), its settings change (e.g.
+    its river cells) or threshold_version is increased. The table is replaced in one step, so it is not left half
+    written if a run stops.
+    :param store_path: Path to the table of stored thresholds (a parquet file), or None to calculate every site and
+                       not store them.
+    :param adapter: Model adapter from get_model_adapter.
+    :param sites: List of the sites (catchments).
+    :param historical_paths: Path to the historical simulation of each site (None where there is none).
+    :param series: List of the IDs of the series of each site, e.g. the river cells of a catchment (by default, each
+                   site is a single series with the ID of the site).
+    :param read_options: List of any further options for the read function for each site, e.g. the cells and faces of
+                         the river network.
+    :param catchment_areas: List of the catchment area (km2) of each site, for models with flows in mm/day.
+    :param absolute_flows: Set to True to use the absolute values of the thresholds (see calculate_site_thresholds).
+    :param skip_zero_flows: Set to True to skip simulations without flows greater than 0.
+    :param workers: Number of processes used to calculate the thresholds (1 calculates them in serial).
+    :return: DataFrame of the thresholds of each series (index of the series IDs, columns of threshold_names), NaN
+             where the simulation is not usable.
+    """
+    if series is None:
+        series = [[site] for site in sites]
+    if read_options is None:
+        read_options = [{}] * len(sites)
+    if catchment_areas is None:
+        catchment_areas = [None] * len(sites)
+
+    # Identify the inputs and settings of each site, to check them against those of the stored thresholds:
+    identities = [get_file_identity(path) if path is not None else ("", -1, -1) for path in historical_paths]
+    configs = [hash_analysis_config(adapter["model"], [str(s) for s in site_series], options, area, absolute_flows,
+                                    skip_zero_flows)
+               for site_series, options, area in zip(series, read_options, catchment_areas)]
+
+    stored = None
+    if store_path is not None and os.path.exists(store_path):
+        stored = pd.read_parquet(store_path)
+        stored_sites = stored.drop_duplicates("site").set_index("site")
+    site_thresholds = [None] * len(sites)
+    run_sites = []
+    for i, site in enumerate(sites):
+        if stored is not None and str(site) in stored_sites.index:
+            unit = stored_sites.loc[str(site), ["path", "size", "mtime", "config", "version"]]
+            if tuple(unit) == (*identities[i], configs[i], threshold_version):
+                site_thresholds[i] = stored.loc[stored["site"] == str(site)].set_index("series").loc[
+                    [str(s) for s in series[i]], threshold_names].to_numpy(dtype=float)
+                continue
+        run_sites.append(i)
+    print(f"- {len(sites) - len(run_sites)} of the {len(sites)} sites have stored historical thresholds.")
+
+    # Calculate the thresholds of the other sites:
+    calculated = []
+    site_results = run_catchments(
+        partial(_calculate_site_thresholds_safely, adapter=adapter, absolute_flows=absolute_flows,
+                skip_zero_flows=skip_zero_flows),
+        [sites[i] for i in run_sites], [historical_paths[i] for i in run_sites], [read_options[i] for i in run_sites],
+        [catchment_areas[i] for i in run_sites], workers=min(workers, len(run_sites)))
+    for counter, (k, (thresholds, stored_ok)) in enumerate(site_results, start=1):
+        i = run_sites[k]
+        print(f"- {sites[i]} ({counter}/{len(run_sites)})")
+        if thresholds is None:
+            thresholds = np.full((len(series[i]), len(threshold_names)), np.nan)
+        site_thresholds[i] = thresholds
+        if stored_ok:
+            calculated.append(i)
+
+    # Replace the stored thresholds of the calculated sites (in the order of the sites, as they finish in any order):
+    calculated.sort()
+    if store_path is not None and len(calculated) > 0:
+        rows = pd.DataFrame({
+            "site": np.repeat([str(sites[i]) for i in calculated], [len(series[i]) for i in calculated]),
+            "series": [str(s) for i in calculated for s in series[i]],
+            **dict(zip(threshold_names, np.concatenate([site_thresholds[i] for i in calculated]).T)),
+            "path": np.repeat([identities[i][0] for i in calculated], [len(series[i]) for i in calculated]),
+            "size": np.repeat([identities[i][1] for i in calculated], [len(series[i]) for i in calculated]),
+            "mtime": np.repeat([identities[i][2] for i in calculated], [len(series[i]) for i in calculated]),
+            "config": np.repeat([configs[i] for i in calculated], [len(series[i]) for i in calculated]),
+            "version": threshold_version})
+        if stored is not None:
+            rows = pd.concat([stored[~stored["site"].isin(rows["site"])], rows], ignore_index=True)
+        if os.path.dirname(store_path):
+            os.makedirs(os.path.dirname(store_path), exist_ok=True)
+        rows.to_parquet(store_path + ".tmp", index=False)
+        os.replace(store_path + ".tmp", store_path)
 
-    return anomaly_to_normalise / monthly_std_repeated
+    return pd.DataFrame(np.concatenate(site_thresholds).reshape(-1, len(threshold_names)),
+                        index=pd.Index([s for site_series in series for s in site_series]), columns=threshold_names)
 
 
 def find_historical_simulation_path(catchment_name, catchment_tracker):